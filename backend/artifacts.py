@@ -0,0 +1,231 @@
+"""On-disk store for invoice artifacts.
+
+Generating an invoice only writes its rendered HTML. The PDF is produced on
+first use (download or send) and kept as a cache entry: PDFs are LRU-evicted
+once they exceed ``max_bytes`` in total and are simply re-rendered from the
+HTML when needed again. Files are sharded into ``<root>/<2 hex>/`` so no
+single directory grows unbounded.
+
+Sends work from memory: recently generated HTML is kept in a small in-process
+cache, the renderer returns PDF bytes, and the PDF is written to disk in the
+background after the bytes have been handed to the caller.
+
+Paths handed out by ``ensure_pdf`` are pinned until the caller ``unpin``s
+them, so eviction never deletes a file that is still being streamed.
+
+Files from before sharding (``<root>/<invoice_number>.pdf|html``) are still
+found, but never evicted.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactNotFound(Exception):
+    pass
+
+
+class ArtifactNotPersisted(Exception):
+    """The PDF was rendered but could not be written to disk; ``pdf`` holds it."""
+
+    def __init__(self, invoice_number: str, pdf: bytes):
+        super().__init__(f"Could not store PDF for {invoice_number}")
+        self.pdf = pdf
+
+
+class ArtifactStore:
+    def __init__(self, root: str = "./invoices", max_bytes: int = 1024 * 1024 * 1024,
+                 html_cache_size: int = 256):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.html_cache_size = html_cache_size
+        self._pdfs = OrderedDict()  # path -> size, least recently used first
+        self._total = 0
+        self._pins = Counter()  # path -> callers still reading it
+        self._recent_html = OrderedDict()  # invoice_number -> html, newest last
+        self._rendering = {}
+        self._persisting = {}
+
+    # ============ PATHS ============
+
+    def shard(self, invoice_number: str) -> str:
+        return hashlib.sha1(invoice_number.encode()).hexdigest()[:2]
+
+    def path(self, invoice_number: str, ext: str) -> str:
+        return os.path.join(self.root, self.shard(invoice_number), f"{invoice_number}.{ext}")
+
+    def _legacy_path(self, invoice_number: str, ext: str) -> str:
+        return os.path.join(self.root, f"{invoice_number}.{ext}")
+
+    def html_path(self, invoice_number: str) -> Optional[str]:
+        for path in (self.path(invoice_number, "html"), self._legacy_path(invoice_number, "html")):
+            if os.path.exists(path):
+                return path
+        return None
+
+    # ============ INDEX ============
+
+    def scan(self):
+        """Rebuild the LRU index from disk, oldest modification time first."""
+        entries = []
+        for shard in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for entry in os.scandir(shard_dir):
+                if entry.name.endswith(".pdf"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        self._pdfs = OrderedDict((path, size) for _, path, size in entries)
+        self._total = sum(self._pdfs.values())
+        self._evict()
+
+    @property
+    def disk_usage(self) -> int:
+        return self._total
+
+    def _touch(self, path: str):
+        if path in self._pdfs:
+            self._pdfs.move_to_end(path)
+            try:
+                # Recency survives restarts through mtime
+                os.utime(path)
+            except OSError:
+                pass
+
+    def _add(self, path: str, size: int):
+        self._total += size - self._pdfs.get(path, 0)
+        self._pdfs[path] = size
+        self._pdfs.move_to_end(path)
+        self._evict(keep=path)
+
+    def _evict(self, keep: Optional[str] = None):
+        if self._total <= self.max_bytes:
+            return
+        for path, size in list(self._pdfs.items()):
+            if self._total <= self.max_bytes:
+                break
+            if path == keep or self._pins[path]:
+                continue
+            del self._pdfs[path]
+            self._total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not evict %s: %s", path, e)
+
+    def _pin(self, path: str) -> str:
+        self._pins[path] += 1
+        return path
+
+    def unpin(self, path: str):
+        self._pins[path] -= 1
+        if self._pins[path] <= 0:
+            del self._pins[path]
+
+    # ============ ARTIFACTS ============
+
+    def _remember_html(self, invoice_number: str, html_content: str):
+        self._recent_html[invoice_number] = html_content
+        self._recent_html.move_to_end(invoice_number)
+        while len(self._recent_html) > self.html_cache_size:
+            self._recent_html.popitem(last=False)
+
+    async def write_html(self, invoice_number: str, html_content: str) -> str:
+        path = self.path(invoice_number, "html")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        async with aiofiles.open(path, 'w', encoding='utf-8') as f:
+            await f.write(html_content)
+        self._remember_html(invoice_number, html_content)
+        return path
+
+    async def read_html(self, invoice_number: str) -> str:
+        if invoice_number in self._recent_html:
+            return self._recent_html[invoice_number]
+        path = self.html_path(invoice_number)
+        if not path:
+            raise ArtifactNotFound(invoice_number)
+        async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+            return await f.read()
+
+    def _existing_pdf(self, invoice_number: str) -> Optional[str]:
+        path = self.path(invoice_number, "pdf")
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+        legacy = self._legacy_path(invoice_number, "pdf")
+        if os.path.exists(legacy):
+            return legacy
+        return None
+
+    async def pdf_bytes(self, invoice_number: str, render: Callable[[str], Awaitable[bytes]]) -> bytes:
+        """Return the invoice PDF, rendering it from the stored HTML if needed.
+
+        A fresh render is returned immediately and written to disk in the
+        background.
+        """
+        path = self._existing_pdf(invoice_number)
+        if path:
+            async with aiofiles.open(path, 'rb') as f:
+                return await f.read()
+
+        # Concurrent requests for the same invoice share one render
+        pending = self._rendering.get(invoice_number)
+        if pending is None:
+            pending = asyncio.ensure_future(self._render(invoice_number, render))
+            self._rendering[invoice_number] = pending
+            pending.add_done_callback(lambda _: self._rendering.pop(invoice_number, None))
+        return await asyncio.shield(pending)
+
+    async def ensure_pdf(self, invoice_number: str, render: Callable[[str], Awaitable[bytes]]) -> str:
+        """Return a pinned path to the invoice PDF on disk, rendering it if needed.
+
+        Call ``unpin`` once the file has been read. Raises
+        ``ArtifactNotPersisted`` when the PDF could not be written.
+        """
+        path = self._existing_pdf(invoice_number)
+        if path:
+            return self._pin(path)
+        pdf = await self.pdf_bytes(invoice_number, render)
+        persisting = self._persisting.get(invoice_number)
+        if persisting is not None:
+            await asyncio.shield(persisting)
+        path = self._existing_pdf(invoice_number)
+        if path is None:
+            raise ArtifactNotPersisted(invoice_number, pdf)
+        return self._pin(path)
+
+    async def _render(self, invoice_number: str, render) -> bytes:
+        html_content = await self.read_html(invoice_number)
+        pdf = await render(html_content)
+        task = asyncio.ensure_future(self._persist(invoice_number, pdf))
+        self._persisting[invoice_number] = task
+        task.add_done_callback(lambda _: self._persisting.pop(invoice_number, None))
+        return pdf
+
+    async def _persist(self, invoice_number: str, pdf: bytes):
+        path = self.path(invoice_number, "pdf")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                await f.write(pdf)
+            # Readers never see a half-written PDF
+            os.replace(tmp_path, path)
+            self._add(path, len(pdf))
+        except OSError as e:
+            logger.warning("Could not persist %s: %s", path, e)
+
+    async def drain(self):
+        if self._persisting:
+            await asyncio.gather(*self._persisting.values(), return_exceptions=True)
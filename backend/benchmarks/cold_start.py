@@ -0,0 +1,109 @@
+"""Cold-start profile of the API.
+
+Run from ``backend/``::
+
+    python -m benchmarks.cold_start --budget 1.5
+
+Two fresh interpreters are started. The first imports ``server`` under
+``python -X importtime`` and reports the slowest modules it pulls in. The
+second runs the app's startup and background warmup (mongomock-motor unless
+``--mongo-url`` is given, whose ``--db-name`` database is dropped afterwards)
+and returns the ``/api/system/startup`` report. With ``--budget`` the exit
+status is 1 when the time until the app serves requests (imports + module
+init + startup) exceeds the budget, so CI can hold it.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+READY_SCRIPT = """
+import asyncio, json, os, sys, tempfile
+sys.path.insert(0, {backend!r})
+if not os.environ.get("COLD_START_MONGO"):
+    import motor.motor_asyncio
+    from mongomock_motor import AsyncMongoMockClient
+    motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+os.chdir(tempfile.mkdtemp(prefix="wifi-billing-cold-"))
+import server
+
+async def main():
+    await server.app.router.startup()
+    await asyncio.gather(*server.warmup_tasks)
+    report = server.startup_profile.report()
+    if os.environ.get("COLD_START_MONGO"):
+        await server.client.drop_database(os.environ["DB_NAME"])
+    await server.app.router.shutdown()
+    return report
+
+print(json.dumps(asyncio.run(main())))
+"""
+
+
+def import_times(env: dict, top: int) -> dict:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"],
+                            cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"import server failed:\n{result.stderr[-2000:]}")
+    total, modules = None, []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 0 and name.strip() == "server":
+            total = seconds
+        elif depth == 1:
+            # Direct imports; their cumulative time includes everything they pull in
+            modules.append({"module": name.strip(), "seconds": round(seconds, 4)})
+    modules.sort(key=lambda m: m["seconds"], reverse=True)
+    return {"total_seconds": None if total is None else round(total, 4), "slowest": modules[:top]}
+
+
+def startup_report(env: dict) -> dict:
+    result = subprocess.run([sys.executable, "-c", READY_SCRIPT.format(backend=BACKEND_DIR)],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"startup failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import and startup cost of the API")
+    parser.add_argument("--mongo-url", help="local mongod to use instead of the in-process fake")
+    parser.add_argument("--db-name", default="wifi_billing_cold_start")
+    parser.add_argument("--top", type=int, default=15, help="slowest direct imports to list")
+    parser.add_argument("--budget", type=float, help="fail when ready_after_seconds exceeds this")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url or "mongodb://localhost:27017",
+        "DB_NAME": args.db_name,
+        "COLD_START_MONGO": "1" if args.mongo_url else ""
+    }
+    report = {"imports": import_times(env, args.top), "startup": startup_report(env)}
+    ready = report["startup"]["ready_after_seconds"]
+    if args.budget is not None:
+        report["budget_seconds"] = args.budget
+        report["within_budget"] = ready is not None and ready <= args.budget
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.budget is not None and not report["within_budget"]:
+        print(f"Cold start {ready}s is over the {args.budget}s budget", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,360 @@
+"""Benchmarks for the billing API hot paths.
+
+Run from ``backend/``::
+
+    python -m benchmarks.run --sizes 10000,100000 --output bench.json
+
+The FastAPI app is driven in-process through ``httpx.ASGITransport``. MongoDB
+is a local mongod when ``--mongo-url`` is given (the ``--db-name`` database is
+dropped before and after the run) and an in-process mongomock-motor fake
+otherwise. WhatsApp is always the stub in ``benchmarks.wa_stub``; PDF
+rendering uses the real worker pool when wkhtmltopdf is on PATH, or a stub
+with ``--stub-renderer``. The stand-ins used are recorded in the output so
+results are only compared like for like. mongomock scans collections in
+Python, so use a real mongod for the 100k figures; the fake is meant for
+quick, small-size runs.
+
+For every size the run measures customer import rows/sec, list endpoints
+(first page, deep keyset page, search), dashboard stats latency with the
+cache disabled, ``/invoices/generate`` latency and bulk-send throughput.
+Results are written as JSON.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_PDF = b"%PDF-1.4\n% benchmark stub\n" + b"0" * 30000 + b"\n%%EOF\n"
+
+
+class StubRenderer:
+    """Drop-in for PdfRenderer that returns a fixed document after ``latency``."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.queue_depth = 0
+        self.in_flight = 0
+
+    async def start(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def render(self, html: str) -> bytes:
+        await asyncio.sleep(self.latency)
+        return STUB_PDF
+
+
+# ============ HELPERS ============
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def latency_summary(samples: list) -> dict:
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p90_ms": round(percentile(samples, 90) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3)
+    }
+
+
+async def measure(call, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await call()
+        samples.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latency_summary(samples)
+
+
+def customer_csv(size: int) -> bytes:
+    out = io.StringIO()
+    out.write("customer_id,name,address,package,start_date,next_due_date,phone_whatsapp,wifi_id,status\n")
+    names = ["Budi", "Siti", "Agus", "Dewi", "Rudi", "Wati", "Joko", "Ani"]
+    for i in range(size):
+        status = "inactive" if i % 10 == 0 else "active"
+        out.write(f"C{i:07d},{names[i % len(names)]} Santoso {i},Jl. Merdeka {i},10 Mbps,"
+                  f"2024-01-01,2025-{1 + i % 12:02d}-{1 + i % 28:02d},62812{i:08d},WIFI{i:07d},{status}\n")
+    return out.getvalue().encode()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+# ============ SETUP ============
+
+def load_server(args, workdir: str):
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["WA_MAX_PER_SECOND"] = str(args.wa_rate)
+    if not args.mongo_url:
+        try:
+            import motor.motor_asyncio
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("Without --mongo-url the benchmark needs mongomock-motor (pip install mongomock-motor)")
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+
+    # The app keeps invoices/ and templates/ relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+
+    if args.stub_renderer:
+        server.pdf_renderer = StubRenderer(args.render_latency)
+    return server
+
+
+async def seed_invoices(server, customers: list, size: int):
+    statuses = ["generated", "pending", "sent", "paid", "paid"]
+    today = date.today()
+    created = datetime.now(timezone.utc) - timedelta(seconds=size)
+    batch = []
+    for i in range(size):
+        customer = customers[i % len(customers)]
+        batch.append({
+            "id": f"bench-{i:08d}",
+            "customer_id": customer["id"],
+            "invoice_number": f"INV-BENCH-{i:08d}",
+            "amount": 150000.0,
+            "due_date": (today + timedelta(days=i % 90 - 45)).isoformat(),
+            "status": statuses[i % len(statuses)],
+            "pdf_path": "",
+            "html_path": "",
+            "sent_at": "",
+            "paid_at": "",
+            "created_at": (created + timedelta(seconds=i)).isoformat()
+        })
+        if len(batch) == 5000:
+            await server.db.invoices.insert_many(batch)
+            batch = []
+    if batch:
+        await server.db.invoices.insert_many(batch)
+
+
+async def reset(server):
+    for name in ("customers", "invoices", "stats", "bulk_jobs"):
+        await server.db[name].delete_many({})
+    server.dashboard_stats.invalidate()
+
+
+# ============ BENCHMARKS ============
+
+async def bench_import(server, http, size: int) -> dict:
+    payload = customer_csv(size)
+    start = time.perf_counter()
+    response = await http.post("/api/customers/import",
+                               files={"file": ("customers.csv", payload, "text/csv")})
+    elapsed = time.perf_counter() - start
+    response.raise_for_status()
+    summary = response.json()
+    return {
+        "rows": size,
+        "imported": summary["imported"],
+        "errors": len(summary["errors"]),
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(size / elapsed, 1)
+    }
+
+
+async def bench_lists(server, http, repeat: int) -> dict:
+    mid_customer = (await server.db.customers.find({}, {"customer_id": 1}).sort(server.CUSTOMER_SORT)
+                    .skip(await server.db.customers.count_documents({}) // 2).to_list(1))[0]
+    mid_invoice = (await server.db.invoices.find({}, {"created_at": 1, "id": 1}).sort(server.INVOICE_SORT)
+                   .skip(await server.db.invoices.count_documents({}) // 2).to_list(1))[0]
+    # Cursors pointing half-way in, as a client paging that deep would hold
+    customer_cursor = server.encode_cursor([mid_customer["customer_id"]])
+    invoice_cursor = server.encode_cursor([mid_invoice["created_at"], mid_invoice["id"]])
+
+    return {
+        "customers_first_page": await measure(lambda: http.get("/api/customers"), repeat),
+        "customers_deep_page": await measure(
+            lambda: http.get("/api/customers", params={"after": customer_cursor}), repeat),
+        "customers_search": await measure(
+            lambda: http.get("/api/customers", params={"q": "siti"}), repeat),
+        "invoices_first_page": await measure(lambda: http.get("/api/invoices"), repeat),
+        "invoices_deep_page": await measure(
+            lambda: http.get("/api/invoices", params={"after": invoice_cursor}), repeat),
+        "invoices_by_status": await measure(
+            lambda: http.get("/api/invoices", params={"status": "sent"}), repeat),
+        "overdue_first_page": await measure(lambda: http.get("/api/dashboard/overdue"), repeat)
+    }
+
+
+async def bench_dashboard(server, http, repeat: int) -> dict:
+    ttl = server.dashboard_stats.ttl
+    server.dashboard_stats.ttl = 0
+    try:
+        uncached = await measure(lambda: http.get("/api/dashboard/stats"), repeat)
+    finally:
+        server.dashboard_stats.ttl = ttl
+    cached = await measure(lambda: http.get("/api/dashboard/stats"), repeat)
+    return {"uncached": uncached, "cached": cached, "materialized": server.dashboard_stats.materialized}
+
+
+async def bench_generate(http, customers: list, requests: int) -> dict:
+    due = (date.today() + timedelta(days=14)).isoformat()
+    picks = random.Random(0).choices(customers, k=requests)
+    calls = iter(picks)
+    return await measure(lambda: http.post("/api/invoices/generate", json={
+        "customer_id": next(calls)["id"], "amount": 150000, "due_date": due
+    }), requests)
+
+
+async def bench_bulk_send(http, customers: list, size: int, concurrency: int) -> dict:
+    due = (date.today() + timedelta(days=14)).isoformat()
+    ids = [c["id"] for c in customers[:size]]
+    start = time.perf_counter()
+    response = await http.post("/api/whatsapp/bulk-send", json={
+        "customer_ids": ids, "amount": 150000, "due_date": due, "concurrency": concurrency
+    })
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        job = (await http.get(f"/api/whatsapp/bulk-send/{job_id}")).json()
+        if job["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    return {
+        "customers": len(ids),
+        "concurrency": job["concurrency"],
+        "status": job["status"],
+        "succeeded": job["succeeded"],
+        "failed": job["failed"],
+        "seconds": round(elapsed, 3),
+        "sends_per_minute": round(job["succeeded"] / elapsed * 60, 1)
+    }
+
+
+async def run_size(server, http, size: int, args) -> dict:
+    await reset(server)
+    log(f"[{size}] importing customers")
+    result = {"size": size, "customer_import": await bench_import(server, http, size)}
+
+    customers = await server.db.customers.find({}, {"_id": 0, "id": 1}).to_list(None)
+    log(f"[{size}] seeding invoices")
+    await seed_invoices(server, customers, size)
+    if server.dashboard_stats.materialized:
+        await server.dashboard_stats.rebuild()
+
+    log(f"[{size}] list endpoints")
+    result["list_endpoints"] = await bench_lists(server, http, args.repeat)
+    log(f"[{size}] dashboard stats")
+    result["dashboard_stats"] = await bench_dashboard(server, http, args.repeat)
+    log(f"[{size}] generate invoice")
+    result["generate_invoice"] = await bench_generate(http, customers, args.requests)
+    log(f"[{size}] bulk send")
+    result["bulk_send"] = await bench_bulk_send(http, customers, min(args.bulk_size, size),
+                                                args.bulk_concurrency)
+    return result
+
+
+async def main(args) -> dict:
+    from benchmarks.wa_stub import create_app
+
+    workdir = tempfile.mkdtemp(prefix="wifi-billing-bench-")
+    server = load_server(args, workdir)
+    server.wa_client._client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=create_app(latency=args.wa_latency)),
+        base_url="http://wa-stub"
+    )
+    if args.mongo_url:
+        await server.client.drop_database(args.db_name)
+
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "mongo": "mongod" if args.mongo_url else "mongomock-motor",
+            "renderer": "stub" if args.stub_renderer else "worker-pool",
+            "wa_stub_latency_s": args.wa_latency,
+            "repeat": args.repeat,
+            "generate_requests": args.requests
+        },
+        "results": []
+    }
+
+    await server.app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app),
+                                     base_url="http://bench", timeout=None) as http:
+            for size in args.sizes:
+                report["results"].append(await run_size(server, http, size, args))
+    finally:
+        if args.mongo_url:
+            await server.client.drop_database(args.db_name)
+        await server.app.router.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the billing API against local stand-ins")
+    parser.add_argument("--sizes", default="10000,100000",
+                        type=lambda v: [int(s) for s in v.split(",") if s],
+                        help="comma-separated document counts (default: 10000,100000)")
+    parser.add_argument("--mongo-url", help="local mongod to use instead of the in-process fake")
+    parser.add_argument("--db-name", default="wifi_billing_bench",
+                        help="database to use; it is dropped before and after the run")
+    parser.add_argument("--repeat", type=int, default=50, help="requests per latency measurement")
+    parser.add_argument("--requests", type=int, default=200, help="generate_invoice requests")
+    parser.add_argument("--bulk-size", type=int, default=200, help="customers per bulk send")
+    parser.add_argument("--bulk-concurrency", type=int, default=4)
+    parser.add_argument("--wa-latency", type=float, default=0.05, help="stub upload delay in seconds")
+    parser.add_argument("--wa-rate", type=float, default=0,
+                        help="WhatsApp sends per second (WA_MAX_PER_SECOND); 0 measures the pipeline unthrottled")
+    parser.add_argument("--stub-renderer", action="store_true",
+                        help="skip wkhtmltopdf/weasyprint and return a fixed PDF")
+    parser.add_argument("--render-latency", type=float, default=0.2,
+                        help="delay of the stub renderer in seconds")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    if not args.stub_renderer and not shutil.which("wkhtmltopdf"):
+        log("wkhtmltopdf not found; using --stub-renderer")
+        args.stub_renderer = True
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,37 @@
+"""Stand-in for the Baileys WhatsApp service.
+
+Answers ``/health`` (and ``/status``) as connected and accepts
+``/send-document`` uploads after a fixed delay that approximates the real
+upload. It is mounted in-process through ``httpx.ASGITransport``, so no port
+is opened.
+"""
+import asyncio
+
+from fastapi import FastAPI, File, Form, UploadFile
+
+
+def create_app(latency: float = 0.05, connected: bool = True) -> FastAPI:
+    app = FastAPI()
+    app.state.documents = 0
+    app.state.bytes = 0
+
+    def status():
+        return {
+            "status": "connected" if connected else "disconnected",
+            "connected": connected,
+            "qr_available": False,
+            "phone": "6280000000000" if connected else None
+        }
+
+    app.get("/health")(status)
+    app.get("/status")(status)
+
+    @app.post("/send-document")
+    async def send_document(file: UploadFile = File(...), phone: str = Form(...), caption: str = Form("")):
+        content = await file.read()
+        await asyncio.sleep(latency)
+        app.state.documents += 1
+        app.state.bytes += len(content)
+        return {"success": True, "message": "Document sent successfully"}
+
+    return app
@@ -0,0 +1,363 @@
+"""Automatic invoicing and payment reminders.
+
+Each run (daily at ``cron_time``) does three passes:
+
+* invoicing: active customers whose ``next_due_date`` is at most
+  ``days_before_due`` days away (or already past, e.g. after downtime) get an
+  invoice for the latest cycle due within that window, and ``next_due_date``
+  moves one cycle past it. A stale date several cycles behind is billed once,
+  not once per run for every missed cycle; the cycles it jumps over are
+  counted as ``cycles_skipped`` and listed in the run's errors;
+* sending: scheduler invoices still in ``generated`` status (including ones
+  whose send failed in an earlier run) are queued in the WhatsApp outbox;
+* reminders: open invoices at least N days past due, for each N in
+  ``reminder_days``, are queued again with a reminder caption. Only the
+  largest N an invoice has reached is sent; smaller ones it skipped are
+  marked as done.
+
+Runs are idempotent. Scheduler invoices carry ``billing_key`` (customer id +
+due date) under a unique index, ``next_due_date`` only advances from the value
+that was billed, the outbox keeps one live message per invoice, and reminder
+days are claimed on the invoice (and released again if queuing fails).
+Delivery itself, with its retries, is the outbox's job.
+Customers are processed in batches with a pause in between and bounded
+concurrency inside a batch, so a large due window doesn't hit the renderer and
+WhatsApp in one burst.
+"""
+import asyncio
+import calendar
+import logging
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional, Tuple
+
+from apscheduler.triggers.cron import CronTrigger
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+JOB_ID = "billing-run"
+
+CYCLE_MONTHS = {
+    "monthly": 1,
+    "quarterly": 3,
+    "semiannual": 6,
+    "yearly": 12,
+    "annual": 12
+}
+
+MAX_RUN_ERRORS = 100
+
+
+def _parse_date(value) -> date:
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def advance_due_date(due_date: str, billing_cycle: str, anchor_day: Optional[int] = None) -> str:
+    current = _parse_date(due_date)
+    cycle = (billing_cycle or "monthly").lower()
+    if cycle == "weekly":
+        return (current + timedelta(days=7)).isoformat()
+
+    months = CYCLE_MONTHS.get(cycle, 1)
+    month_index = current.month - 1 + months
+    year, month = current.year + month_index // 12, month_index % 12 + 1
+    day = current.day
+    # A due date clamped to a short month's end (31st -> 28th) goes back to the billing day
+    if anchor_day and anchor_day > day == calendar.monthrange(current.year, current.month)[1]:
+        day = anchor_day
+    return date(year, month, min(day, calendar.monthrange(year, month)[1])).isoformat()
+
+
+def next_due_date(customer: dict, due_date: str) -> str:
+    # The start date's day is the billing day that clamped dates return to
+    try:
+        anchor_day = _parse_date(customer.get("start_date")).day
+    except (TypeError, ValueError):
+        anchor_day = None
+    return advance_due_date(due_date, customer.get("billing_cycle"), anchor_day)
+
+
+def current_cycle(customer: dict, window_end: str) -> Tuple[str, int]:
+    """The latest due date within the window, and how many earlier cycles it passes over."""
+    due, skipped = customer["next_due_date"], 0
+    following = next_due_date(customer, due)
+    while following <= window_end:
+        due, following, skipped = following, next_due_date(customer, following), skipped + 1
+    return due, skipped
+
+
+def billing_key(customer: dict, due_date: str) -> str:
+    return f"{customer['id']}:{due_date}"
+
+
+class BillingScheduler:
+    def __init__(self, db, scheduler,
+                 load_settings: Callable[[], Awaitable],
+                 get_template: Callable[[Optional[str]], Awaitable],
+                 build_invoice: Callable[..., Awaitable[dict]],
+                 enqueue: Callable[..., Awaitable[dict]],
+                 reserve_invoice_numbers: Optional[Callable[[int], Awaitable]] = None,
+                 customers_changed: Optional[Callable[[], None]] = None,
+                 batch_size: int = 100, concurrency: int = 4, batch_pause: float = 1.0):
+        self.db = db
+        self.scheduler = scheduler
+        self.load_settings = load_settings
+        self.get_template = get_template
+        self.build_invoice = build_invoice
+        self.enqueue = enqueue
+        self.reserve_invoice_numbers = reserve_invoice_numbers
+        self.customers_changed = customers_changed
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.batch_pause = batch_pause
+        self._running = None
+
+    # ============ SCHEDULING ============
+
+    def apply_settings(self, settings):
+        if self.scheduler.get_job(JOB_ID):
+            self.scheduler.remove_job(JOB_ID)
+        if not settings.enabled:
+            logger.info("Billing scheduler disabled")
+            return
+
+        hour, minute = (int(part) for part in settings.cron_time.split(':'))
+        self.scheduler.add_job(
+            self.run, CronTrigger(hour=hour, minute=minute), id=JOB_ID,
+            max_instances=1, coalesce=True, misfire_grace_time=3600
+        )
+        logger.info("Billing scheduler set for %02d:%02d daily", hour, minute)
+
+    async def run(self, today: Optional[date] = None) -> dict:
+        # A run already in progress in this process is joined, not duplicated
+        if self._running is not None and not self._running.done():
+            return await asyncio.shield(self._running)
+        self._running = asyncio.ensure_future(self._run(today or date.today()))
+        return await asyncio.shield(self._running)
+
+    # ============ RUN ============
+
+    def _new_log(self, today: date, settings) -> dict:
+        window_end = today + timedelta(days=settings.days_before_due)
+        return {
+            "id": str(uuid.uuid4()),
+            "run_date": today.isoformat(),
+            "status": "running",
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "finished_at": None,
+            "window": {"to": window_end.isoformat()},
+            # past_due: billed for a due date that had already gone by (missed runs, stale dates)
+            "invoices": {"due": 0, "past_due": 0, "cycles_skipped": 0, "generated": 0, "already_billed": 0,
+                         "no_price": 0, "failed": 0, "queued": 0, "queue_failed": 0},
+            "reminders": {"due": 0, "queued": 0, "failed": 0},
+            "timings": {},
+            "errors": []
+        }
+
+    def _record_error(self, log: dict, message: str):
+        if len(log["errors"]) < MAX_RUN_ERRORS:
+            log["errors"].append(message)
+
+    async def _run(self, today: date) -> dict:
+        settings = await self.load_settings()
+        log = self._new_log(today, settings)
+        await self.db.scheduler_runs.insert_one(dict(log))
+        started = time.perf_counter()
+        try:
+            phase = time.perf_counter()
+            try:
+                await self._invoice_due_customers(today, settings, log)
+            finally:
+                # next_due_date moved for the billed customers
+                if self.customers_changed:
+                    self.customers_changed()
+            log["timings"]["invoicing_seconds"] = round(time.perf_counter() - phase, 3)
+
+            # Queued even while WhatsApp is down; the outbox waits for it to reconnect
+            phase = time.perf_counter()
+            await self._queue_generated_invoices(log)
+            log["timings"]["sending_seconds"] = round(time.perf_counter() - phase, 3)
+
+            phase = time.perf_counter()
+            await self._queue_reminders(today, settings, log)
+            log["timings"]["reminders_seconds"] = round(time.perf_counter() - phase, 3)
+            log["status"] = "completed"
+        except Exception as e:
+            logger.exception("Billing run %s failed", log["id"])
+            log["status"] = "failed"
+            self._record_error(log, str(e))
+        finally:
+            log["timings"]["total_seconds"] = round(time.perf_counter() - started, 3)
+            log["finished_at"] = datetime.now(timezone.utc).isoformat()
+            await self.db.scheduler_runs.replace_one({"id": log["id"]}, log)
+        logger.info("Billing run %s %s: %s, reminders %s", log["id"], log["status"],
+                    log["invoices"], log["reminders"])
+        return log
+
+    async def _batches(self, collection, query: dict, projection: dict):
+        # Keyset over the unique id so rows updated mid-run are neither skipped nor repeated
+        last = None
+        while True:
+            batch_query = query if last is None else {**query, "id": {"$gt": last}}
+            batch = await collection.find(batch_query, projection) \
+                .sort("id", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not batch:
+                return
+            yield batch
+            if len(batch) < self.batch_size:
+                return
+            last = batch[-1]["id"]
+            await asyncio.sleep(self.batch_pause)
+
+    async def _invoice_due_customers(self, today: date, settings, log: dict):
+        template = await self.get_template(settings.template_id)
+        # No lower bound: a stale due date is billed for its current cycle only
+        query = {"status": "active", "next_due_date": {"$lte": log["window"]["to"]}}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bill(customer: dict, due_date: str, amount: Optional[float], numbers):
+            async with semaphore:
+                await self._bill_customer(customer, due_date, template, amount, log, numbers)
+
+        async for batch in self._batches(self.db.customers, query, {"_id": 0, "search_keys": 0}):
+            log["invoices"]["due"] += len(batch)
+            log["invoices"]["past_due"] += sum(1 for c in batch if c["next_due_date"] < today.isoformat())
+            to_bill = await self._to_bill(batch, settings, log)
+            numbers = None
+            billable = sum(1 for _, _, amount in to_bill if amount is not None)
+            if self.reserve_invoice_numbers and billable:
+                # One counter update per batch, for exactly the invoices it will create
+                numbers = await self.reserve_invoice_numbers(billable)
+            try:
+                await asyncio.gather(*(bill(customer, due_date, amount, numbers)
+                                       for customer, due_date, amount in to_bill))
+            finally:
+                if numbers is not None:
+                    # Numbers left by failed invoices go back to the counter
+                    await numbers.release()
+
+    async def _to_bill(self, batch: list, settings, log: dict) -> list:
+        """``(customer, due_date, amount)``; ``amount`` is None when already billed."""
+        cycles = [current_cycle(c, log["window"]["to"]) for c in batch]
+        keys = [billing_key(c, due_date) for c, (due_date, _) in zip(batch, cycles)]
+        billed = {inv["billing_key"] for inv in await self.db.invoices.find(
+            {"billing_key": {"$in": keys}}, {"_id": 0, "billing_key": 1}
+        ).to_list(None)}
+        to_bill = []
+        for customer, (due_date, skipped), key in zip(batch, cycles, keys):
+            if key in billed:
+                # Only the due date still has to move on
+                log["invoices"]["already_billed"] += 1
+                to_bill.append((customer, due_date, None))
+                continue
+            amount = settings.package_prices.get(customer.get("package"), settings.default_amount)
+            if amount is None:
+                # Left unbilled (and not advanced) until a price is configured
+                log["invoices"]["no_price"] += 1
+                self._record_error(log, f"{customer['customer_id']}: no price for package {customer.get('package')!r}")
+                continue
+            if skipped:
+                log["invoices"]["cycles_skipped"] += skipped
+                self._record_error(log, f"{customer['customer_id']}: {skipped} earlier cycle(s) from "
+                                        f"{customer['next_due_date']} not invoiced; billing {due_date}")
+            to_bill.append((customer, due_date, amount))
+        return to_bill
+
+    async def _bill_customer(self, customer: dict, due_date: str, template, amount: Optional[float], log: dict,
+                             numbers=None):
+        try:
+            if amount is not None:
+                try:
+                    await self.build_invoice(customer, template, amount, due_date,
+                                             billing_key=billing_key(customer, due_date), numbers=numbers)
+                    log["invoices"]["generated"] += 1
+                except DuplicateKeyError:
+                    # Billed concurrently by another worker
+                    log["invoices"]["already_billed"] += 1
+            await self._advance(customer, due_date)
+        except Exception as e:
+            log["invoices"]["failed"] += 1
+            self._record_error(log, f"{customer.get('customer_id')}: {e}")
+
+    async def _advance(self, customer: dict, due_date: str):
+        next_due = next_due_date(customer, due_date)
+        # Conditional on the date the run read, so a replayed run can't advance twice
+        await self.db.customers.update_one(
+            {"id": customer["id"], "next_due_date": customer["next_due_date"]},
+            {"$set": {"next_due_date": next_due}}
+        )
+
+    async def _queue_generated_invoices(self, log: dict):
+        # Sends claimed with status "sending" before the outbox existed go back in the queue
+        await self.db.invoices.update_many(
+            {"billing_key": {"$type": "string"}, "status": "sending"}, {"$set": {"status": "generated"}}
+        )
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def queue(invoice: dict):
+            async with semaphore:
+                try:
+                    # One live message per invoice: re-queuing one still pending is a no-op
+                    await self.enqueue(invoice["id"])
+                    log["invoices"]["queued"] += 1
+                except Exception as e:
+                    log["invoices"]["queue_failed"] += 1
+                    self._record_error(log, f"queue {invoice['invoice_number']}: {e}")
+
+        # Includes invoices from earlier runs whose send failed
+        query = {"billing_key": {"$type": "string"}, "status": "generated"}
+        async for invoices in self._batches(self.db.invoices, query, {"_id": 0, "id": 1, "invoice_number": 1}):
+            await asyncio.gather(*(queue(inv) for inv in invoices))
+
+    async def _queue_reminders(self, today: date, settings, log: dict):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        caption = ("Halo {name},\n\nPengingat: invoice {invoice_number} sebesar Rp {amount:,.0f} "
+                   "telah jatuh tempo pada {due_date} ({days} hari yang lalu).\n\n"
+                   "Mohon segera melakukan pembayaran. Terima kasih!")
+        reminder_days = sorted(set(settings.reminder_days), reverse=True)
+
+        async def remind(invoice: dict, customer: dict, days: int):
+            async with semaphore:
+                # Claim this reminder, and any shorter ones the invoice went past, before queuing
+                claimed_days = [d for d in reminder_days if d <= days and d not in invoice.get("reminders_sent", [])]
+                claimed = await self.db.invoices.update_one(
+                    # Status again: paid after the query ran means no reminder
+                    {"id": invoice["id"], "status": {"$in": ["pending", "sent"]}, "reminders_sent": {"$ne": days}},
+                    {"$addToSet": {"reminders_sent": {"$each": claimed_days}}}
+                )
+                if not claimed.modified_count:
+                    return
+                overdue = (today - _parse_date(invoice["due_date"])).days
+                try:
+                    await self.enqueue(invoice["id"], caption=caption.format(
+                        name=customer["name"], invoice_number=invoice["invoice_number"],
+                        amount=invoice["amount"], due_date=invoice["due_date"], days=overdue
+                    ), active_key=f"reminder:{invoice['id']}:{days}")
+                    log["reminders"]["queued"] += 1
+                except Exception as e:
+                    # Not queued: let the next run try again
+                    await self.db.invoices.update_one(
+                        {"id": invoice["id"]}, {"$pullAll": {"reminders_sent": claimed_days}}
+                    )
+                    log["reminders"]["failed"] += 1
+                    self._record_error(log, f"reminder {invoice['invoice_number']}: {e}")
+
+        # Longest first, so an invoice that missed several reminder days gets one message
+        for days in reminder_days:
+            query = {
+                "status": {"$in": ["pending", "sent"]},
+                # A range, not an exact day, so a day without a run doesn't lose the reminder
+                "due_date": {"$lte": (today - timedelta(days=days)).isoformat()},
+                "reminders_sent": {"$ne": days}
+            }
+            async for invoices in self._batches(self.db.invoices, query, {"_id": 0}):
+                customers = await self.db.customers.find(
+                    {"id": {"$in": list({inv["customer_id"] for inv in invoices})}}, {"_id": 0, "id": 1, "name": 1}
+                ).to_list(None)
+                customers_by_id = {c["id"]: c for c in customers}
+                due = [(inv, customers_by_id[inv["customer_id"]]) for inv in invoices
+                       if inv["customer_id"] in customers_by_id]
+                log["reminders"]["due"] += len(due)
+                await asyncio.gather(*(remind(inv, customer, days) for inv, customer in due))
@@ -0,0 +1,212 @@
+"""Chunked customer import from CSV/Excel uploads.
+
+The upload is read in chunks of ``chunk_size`` rows, each chunk is validated
+with column-wise checks, and valid rows are upserted on ``customer_id`` with
+one unordered ``bulk_write`` per chunk.
+
+pandas is imported on the first import request, not with the app: it is the
+single largest import in the backend.
+"""
+import asyncio
+import uuid
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from customer_search import search_keys
+from startup_profile import lazy_import
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+REQUIRED_COLUMNS = ['customer_id', 'name', 'address', 'package', 'start_date',
+                    'next_due_date', 'phone_whatsapp', 'wifi_id']
+
+OPTIONAL_COLUMNS = {
+    'billing_cycle': 'monthly',
+    'status': 'active',
+    'notes': ''
+}
+
+CUSTOMER_COLUMNS = REQUIRED_COLUMNS + list(OPTIONAL_COLUMNS)
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def detect_format(filename: str) -> Optional[str]:
+    filename = (filename or '').lower()
+    if filename.endswith('.csv'):
+        return 'csv'
+    if filename.endswith('.xlsx'):
+        return 'xlsx'
+    if filename.endswith('.xls'):
+        return 'xls'
+    return None
+
+
+# ============ READERS ============
+
+def iter_csv_chunks(fileobj, chunk_size: int) -> Iterator['pd.DataFrame']:
+    pd = lazy_import("pandas")
+    # dtype=str keeps phone numbers and ids exactly as written (no 62812... -> 6.28e+11)
+    yield from pd.read_csv(fileobj, chunksize=chunk_size, dtype=str, keep_default_na=False)
+
+
+def iter_xlsx_chunks(fileobj, chunk_size: int) -> Iterator['pd.DataFrame']:
+    import openpyxl
+
+    pd = lazy_import("pandas")
+    workbook = openpyxl.load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else '' for h in next(rows, ())]
+        buffer = []
+        for row in rows:
+            buffer.append(['' if v is None else str(v) for v in row[:len(header)]])
+            if len(buffer) == chunk_size:
+                yield pd.DataFrame(buffer, columns=header)
+                buffer = []
+        if buffer or not header:
+            yield pd.DataFrame(buffer, columns=header)
+    finally:
+        workbook.close()
+
+
+def iter_xls_chunks(fileobj, chunk_size: int) -> Iterator['pd.DataFrame']:
+    # Legacy .xls has no streaming reader; load once and slice
+    pd = lazy_import("pandas")
+    df = pd.read_excel(fileobj, dtype=str).fillna('')
+    if df.empty:
+        yield df
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+READERS = {
+    'csv': iter_csv_chunks,
+    'xlsx': iter_xlsx_chunks,
+    'xls': iter_xls_chunks
+}
+
+
+# ============ VALIDATION ============
+
+def _cell_text(values: 'pd.Series') -> 'pd.Series':
+    # Undo the quote our CSV export puts before formula-like text (+62812...)
+    return values.fillna('').astype(str).str.strip().str.replace(r"^'(?=[=+\-@])", "", regex=True)
+
+
+def validate_chunk(df: 'pd.DataFrame', first_row: int) -> tuple:
+    """Split a chunk into customer field dicts and per-row error messages.
+
+    ``first_row`` is the spreadsheet row number of the chunk's first data row.
+    """
+    pd = lazy_import("pandas")
+    df = df.reset_index(drop=True)
+    columns = {}
+    for col in REQUIRED_COLUMNS:
+        columns[col] = _cell_text(df[col])
+    for col, default in OPTIONAL_COLUMNS.items():
+        if col in df.columns:
+            values = _cell_text(df[col])
+            columns[col] = values.mask(values == '', default) if default else values
+        else:
+            columns[col] = pd.Series(default, index=df.index, dtype=object)
+    data = pd.DataFrame(columns)
+
+    missing = data[REQUIRED_COLUMNS] == ''
+    complete = ~missing.any(axis=1)
+    duplicated = data['customer_id'].where(complete).duplicated(keep='last') & complete
+    invalid = ~complete | duplicated
+
+    errors = []
+    for idx in invalid[invalid].index:
+        row_number = first_row + idx
+        missing_cols = [col for col in REQUIRED_COLUMNS if missing.at[idx, col]]
+        if missing_cols:
+            errors.append(f"Row {row_number}: missing {', '.join(missing_cols)}")
+        else:
+            errors.append(f"Row {row_number}: duplicate customer_id {data.at[idx, 'customer_id']} "
+                          f"(a later row wins)")
+
+    valid = data[~invalid]
+    rows = list(zip((first_row + idx for idx in valid.index), valid.to_dict('records')))
+    return rows, errors
+
+
+# ============ WRITER ============
+
+async def write_chunk(collection, rows: List[tuple]) -> dict:
+    now = datetime.now(timezone.utc).isoformat()
+    ops = [
+        UpdateOne(
+            {"customer_id": fields['customer_id']},
+            {"$set": {**fields, "search_keys": search_keys(fields)}, "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}},
+            upsert=True
+        )
+        for _, fields in rows
+    ]
+    if not ops:
+        return {"created": 0, "updated": 0, "errors": []}
+
+    try:
+        result = await collection.bulk_write(ops, ordered=False)
+        return {"created": result.upserted_count, "updated": result.matched_count, "errors": []}
+    except BulkWriteError as e:
+        details = e.details
+        errors = [
+            f"Row {rows[err['index']][0]}: {err.get('errmsg', 'write failed')}"
+            for err in details.get('writeErrors', [])
+        ]
+        return {"created": details.get('nUpserted', 0), "updated": details.get('nMatched', 0),
+                "errors": errors}
+
+
+async def import_customers_stream(collection, fileobj, file_format: str,
+                                  chunk_size: int = 1000) -> AsyncIterator[dict]:
+    """Return an async iterator of per-chunk progress events and a final summary.
+
+    Raises ImportFormatError before the first event if required columns are
+    missing, so callers can still answer with a plain 400.
+    """
+    reader = READERS[file_format](fileobj, chunk_size)
+    sentinel = object()
+
+    # Parsing is CPU/file bound; keep it off the event loop
+    first = await asyncio.to_thread(next, reader, sentinel)
+    if first is sentinel:
+        first = lazy_import("pandas").DataFrame()
+    missing_cols = [col for col in REQUIRED_COLUMNS if col not in first.columns]
+    if missing_cols:
+        reader.close()
+        raise ImportFormatError(f"Missing columns: {', '.join(missing_cols)}")
+
+    async def events():
+        summary = {"total_rows": 0, "imported": 0, "created": 0, "updated": 0, "errors": []}
+        chunk = first
+        next_row = 2  # row 1 is the header
+        while chunk is not sentinel:
+            rows, errors = validate_chunk(chunk, next_row)
+            written = await write_chunk(collection, rows)
+
+            next_row += len(chunk)
+            summary["total_rows"] += len(chunk)
+            summary["created"] += written["created"]
+            summary["updated"] += written["updated"]
+            summary["imported"] = summary["created"] + summary["updated"]
+            summary["errors"].extend(errors + written["errors"])
+            yield {
+                "event": "progress",
+                "processed_rows": summary["total_rows"],
+                "imported": summary["imported"],
+                "error_count": len(summary["errors"])
+            }
+            chunk = await asyncio.to_thread(next, reader, sentinel)
+
+        yield {"event": "done", "success": True, **summary}
+
+    return events()
@@ -0,0 +1,54 @@
+"""Normalized prefix search keys for customers.
+
+Each customer stores ``search_keys``: lowercased name words, the full name,
+customer_id, wifi_id and phone number variants. A search is an anchored,
+case-sensitive ``^prefix`` regex on that multikey-indexed array, which MongoDB
+answers with an index range scan instead of a collection scan.
+"""
+import re
+from typing import List
+
+SEARCH_FIELDS = ('name', 'customer_id', 'phone_whatsapp', 'wifi_id')
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _normalize(value) -> str:
+    return " ".join(str(value or '').lower().split())
+
+
+def _phone_variants(phone) -> List[str]:
+    digits = re.sub(r"\D", "", str(phone or ''))
+    if not digits:
+        return []
+    variants = [digits]
+    # 62812... is also searched as 0812... and 812...
+    if digits.startswith('62'):
+        variants += ['0' + digits[2:], digits[2:]]
+    elif digits.startswith('0'):
+        variants += ['62' + digits[1:], digits[1:]]
+    return variants
+
+
+def search_keys(customer: dict) -> List[str]:
+    keys = []
+    name = _normalize(customer.get('name'))
+    if name:
+        keys.append(name)
+        keys.extend(_WORD_RE.findall(name))
+    for field in ('customer_id', 'wifi_id'):
+        value = _normalize(customer.get(field))
+        if value:
+            keys.append(value)
+    keys.extend(_phone_variants(customer.get('phone_whatsapp')))
+    return list(dict.fromkeys(keys))
+
+
+def search_filter(q: str) -> dict:
+    term = _normalize(q)
+    if not term:
+        return {}
+    digits = re.sub(r"[\s\-+()]", "", term)
+    if digits.isdigit():
+        term = digits
+    return {"search_keys": {"$regex": "^" + re.escape(term)}}
@@ -0,0 +1,151 @@
+"""Dashboard statistics.
+
+Counters are computed with one ``$facet``/``$group`` aggregation per
+collection (run concurrently) and cached in-process for a short TTL. With
+``materialized=True`` they are also kept in a single ``stats`` document that
+write paths update with ``$inc``, so a dashboard load reads one document.
+
+Overdue invoices depend on the current date, so open (pending/sent) invoices
+are counted per due date and summed for dates before today.
+"""
+import asyncio
+import time
+from datetime import datetime
+
+OPEN_STATUSES = ["pending", "sent"]
+
+STATS_ID = "dashboard"
+
+
+def _empty_counters() -> dict:
+    return {"customers": {}, "invoices": {}, "revenue": 0, "open_due": {}}
+
+
+class DashboardStats:
+    def __init__(self, db, ttl: float = 5.0, materialized: bool = False):
+        self.db = db
+        self.ttl = ttl
+        self.materialized = materialized
+        self._cached = None
+        self._cached_at = 0.0
+
+    # ============ READ ============
+
+    async def aggregate_counters(self) -> dict:
+        customer_pipeline = [
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]
+        invoice_pipeline = [
+            {"$facet": {
+                "by_status": [
+                    {"$group": {"_id": "$status", "count": {"$sum": 1}, "amount": {"$sum": "$amount"}}}
+                ],
+                "open_due": [
+                    {"$match": {"status": {"$in": OPEN_STATUSES}}},
+                    {"$group": {"_id": "$due_date", "count": {"$sum": 1}}}
+                ]
+            }}
+        ]
+        customer_rows, invoice_rows = await asyncio.gather(
+            self.db.customers.aggregate(customer_pipeline).to_list(None),
+            self.db.invoices.aggregate(invoice_pipeline).to_list(1)
+        )
+        facets = invoice_rows[0] if invoice_rows else {"by_status": [], "open_due": []}
+
+        counters = _empty_counters()
+        counters["customers"] = {str(row["_id"]): row["count"] for row in customer_rows}
+        for row in facets["by_status"]:
+            counters["invoices"][str(row["_id"])] = row["count"]
+            if row["_id"] == "paid":
+                counters["revenue"] = row["amount"]
+        counters["open_due"] = {str(row["_id"]): row["count"] for row in facets["open_due"]}
+        return counters
+
+    async def _load_counters(self) -> dict:
+        if self.materialized:
+            doc = await self.db.stats.find_one({"_id": STATS_ID})
+            if doc:
+                return doc
+            return await self.rebuild()
+        return await self.aggregate_counters()
+
+    @staticmethod
+    def format(counters: dict, today: str) -> dict:
+        customers = counters.get("customers", {})
+        invoices = counters.get("invoices", {})
+        overdue = sum(n for due, n in counters.get("open_due", {}).items() if due < today)
+        return {
+            "customers": {
+                "total": sum(customers.values()),
+                "active": customers.get("active", 0)
+            },
+            "invoices": {
+                "total": sum(invoices.values()),
+                "pending": invoices.get("pending", 0),
+                "sent": invoices.get("sent", 0),
+                "paid": invoices.get("paid", 0),
+                "overdue": overdue
+            },
+            "revenue": counters.get("revenue", 0)
+        }
+
+    async def get(self) -> dict:
+        if self._cached is None or time.monotonic() - self._cached_at > self.ttl:
+            self._cached = await self._load_counters()
+            self._cached_at = time.monotonic()
+        return self.format(self._cached, datetime.now().strftime('%Y-%m-%d'))
+
+    def invalidate(self):
+        self._cached = None
+
+    # ============ MATERIALIZED UPDATES ============
+
+    async def rebuild(self) -> dict:
+        counters = await self.aggregate_counters()
+        if self.materialized:
+            await self.db.stats.replace_one({"_id": STATS_ID}, {"_id": STATS_ID, **counters}, upsert=True)
+        self.invalidate()
+        return counters
+
+    async def _inc(self, inc: dict):
+        inc = {k: v for k, v in inc.items() if v}
+        if not self.materialized or not inc:
+            return
+        await self.db.stats.update_one({"_id": STATS_ID}, {"$inc": inc})
+
+    async def customer_created(self, status: str, count: int = 1):
+        await self._inc({f"customers.{status}": count})
+
+    async def customer_deleted(self, status: str):
+        await self._inc({f"customers.{status}": -1})
+
+    async def customer_status_changed(self, old: str, new: str):
+        if old != new:
+            await self._inc({f"customers.{old}": -1, f"customers.{new}": 1})
+
+    async def invoice_created(self, status: str, due_date: str, amount: float):
+        await self.invoice_status_changed(None, status, due_date, amount)
+
+    @staticmethod
+    def _invoice_inc(inc: dict, old, new: str, due_date: str, amount: float):
+        if old == new:
+            return
+        inc[f"invoices.{new}"] = inc.get(f"invoices.{new}", 0) + 1
+        if old is not None:
+            inc[f"invoices.{old}"] = inc.get(f"invoices.{old}", 0) - 1
+        open_delta = (new in OPEN_STATUSES) - (old in OPEN_STATUSES)
+        inc[f"open_due.{due_date}"] = inc.get(f"open_due.{due_date}", 0) + open_delta
+        revenue = (amount if new == "paid" else 0) - (amount if old == "paid" else 0)
+        inc["revenue"] = inc.get("revenue", 0) + revenue
+
+    async def invoice_status_changed(self, old, new: str, due_date: str, amount: float):
+        inc = {}
+        self._invoice_inc(inc, old, new, due_date, amount)
+        await self._inc(inc)
+
+    async def invoice_statuses_changed(self, changes):
+        # (old, new, due_date, amount) tuples merged into a single $inc
+        inc = {}
+        for old, new, due_date, amount in changes:
+            self._invoice_inc(inc, old, new, due_date, amount)
+        await self._inc(inc)
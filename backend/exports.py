@@ -0,0 +1,192 @@
+"""Streaming exports.
+
+ZIP archives are written entry by entry into a small buffer that is flushed
+to the client after every chunk, so memory stays constant however many files
+the archive holds. PDFs are already compressed and are stored as-is.
+
+Tables are read from an async cursor of flat dicts. CSV is encoded and sent
+every ``batch_rows`` rows. XLSX goes through openpyxl's write-only mode, which
+keeps rows in a temporary file rather than in memory; the workbook can only
+be zipped once the last row is in, so it is spooled to disk and then streamed.
+"""
+import asyncio
+import csv
+import io
+import tempfile
+import zipfile
+from typing import AsyncIterator, List, Tuple, Union
+
+import aiofiles
+
+CHUNK_SIZE = 64 * 1024
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Spreadsheet apps evaluate CSV cells starting with these as formulas
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+class _ZipSink:
+    # Write-only, non-seekable target: zipfile then emits data descriptors
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+async def stream_zip(entries: AsyncIterator[Tuple[str, Union[str, bytes]]]) -> AsyncIterator[bytes]:
+    """Yield a ZIP archive as it is built.
+
+    Entries are ``(archive_name, file_path)``, or ``(archive_name, bytes)``
+    for small generated members.
+    """
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED)
+    try:
+        async for name, source in entries:
+            if isinstance(source, bytes):
+                archive.writestr(name, source)
+                yield sink.drain()
+                continue
+            with archive.open(name, 'w', force_zip64=True) as member:
+                async with aiofiles.open(source, 'rb') as f:
+                    while True:
+                        chunk = await f.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        member.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+    finally:
+        archive.close()
+    yield sink.drain()
+
+
+def _merge_pdfs(paths: list, target):
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for source in paths:
+        writer.append(io.BytesIO(source) if isinstance(source, bytes) else source)
+    writer.write(target)
+    writer.close()
+
+
+async def merge_pdfs(paths: list):
+    """Merge PDFs (paths, or bytes) into a temporary file, returned rewound.
+
+    pypdf keeps the merged document in memory until it is written, so callers
+    cap the number of files; use ZIP for unbounded exports.
+    """
+    spool = tempfile.TemporaryFile()
+    try:
+        await asyncio.to_thread(_merge_pdfs, paths, spool)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+async def stream_file(fileobj) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            chunk = await asyncio.to_thread(fileobj.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+# ============ TABLES ============
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        # 150000.0 -> 150000, as it was typed in
+        return int(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        # Leading quote: shown as text, never run; the importer strips it again
+        return "'" + value
+    return value
+
+
+async def stream_csv(columns: List[str], rows: AsyncIterator[dict], batch_rows: int = 1000) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM: Excel otherwise opens UTF-8 CSV as the local code page
+    buffer.write("\ufeff")
+    writer.writerow(columns)
+    pending = 0
+    async for row in rows:
+        writer.writerow([_csv_value(row.get(column)) for column in columns])
+        pending += 1
+        if pending == batch_rows:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode("utf-8")
+
+
+def _append_rows(sheet, columns: List[str], rows: List[dict]):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    for row in rows:
+        values = []
+        for column in columns:
+            value = row.get(column)
+            if isinstance(value, str):
+                value = ILLEGAL_CHARACTERS_RE.sub("", value)
+                if value.startswith("="):
+                    # Data, not a formula
+                    cell = WriteOnlyCell(sheet, value)
+                    cell.data_type = "s"
+                    value = cell
+            values.append(value)
+        sheet.append(values)
+
+
+async def write_xlsx(columns: List[str], rows: AsyncIterator[dict], title: str = "Sheet1",
+                     batch_rows: int = 1000):
+    """Write rows into a write-only workbook; returns a rewound temporary file."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(columns)
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) == batch_rows:
+            await asyncio.to_thread(_append_rows, sheet, columns, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(_append_rows, sheet, columns, batch)
+
+    spool = tempfile.TemporaryFile()
+    try:
+        await asyncio.to_thread(workbook.save, spool)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
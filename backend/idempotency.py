@@ -0,0 +1,137 @@
+"""Idempotency keys for expensive POSTs.
+
+A request carrying an ``Idempotency-Key`` claims ``<scope>:<key>`` in the
+``idempotency_keys`` collection before doing any work, and stores its JSON
+result there when done. A retry with the same key gets the stored result back
+instead of a new invoice, render or WhatsApp message.
+
+Duplicates that arrive while the first request is still running are
+coalesced: in the same process they await the original's future, across
+processes they poll the claim until it is done. A claim whose owner died is
+taken over once its ``lease`` runs out. Failed operations release their claim
+so the client can retry. Reusing a key with a different payload is an error.
+
+Documents expire through a TTL index on ``expires_at`` (a BSON date, unlike
+the ISO strings used elsewhere, because TTL indexes need one).
+"""
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request."""
+
+
+class IdempotencyInProgress(Exception):
+    """The original request is still running after ``wait_timeout``."""
+
+
+def fingerprint(payload: Any) -> str:
+    raw = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class IdempotencyStore:
+    def __init__(self, collection, ttl: float = 86400.0, lease: float = 120.0,
+                 wait_timeout: float = 60.0, poll_interval: float = 0.25):
+        self.collection = collection
+        self.ttl = ttl
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._pending = {}  # claim id -> (fingerprint, future) for requests running in this process
+
+    async def run(self, scope: str, key: str, payload: Any,
+                  operation: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return ``(result, replayed)``; ``operation`` runs at most once per key."""
+        claim_id = f"{scope}:{key}"
+        request_fingerprint = fingerprint(payload)
+
+        pending = self._pending.get(claim_id)
+        if pending is not None:
+            if pending[0] != request_fingerprint:
+                raise IdempotencyConflict("Idempotency-Key was already used with a different request")
+            # Shield: a client giving up must not cancel the original
+            return await asyncio.shield(pending[1]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[claim_id] = (request_fingerprint, future)
+        try:
+            result, replayed = await self._claim_or_replay(claim_id, scope, key, request_fingerprint, operation)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it; don't warn when there are none
+            raise
+        else:
+            future.set_result(result)
+            return result, replayed
+        finally:
+            del self._pending[claim_id]
+
+    async def _claim_or_replay(self, claim_id: str, scope: str, key: str, request_fingerprint: str,
+                               operation) -> Tuple[Any, bool]:
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = _now()
+            try:
+                await self.collection.insert_one({
+                    "_id": claim_id,
+                    "scope": scope,
+                    "key": key,
+                    "fingerprint": request_fingerprint,
+                    "status": "in_progress",
+                    "created_at": now,
+                    "locked_until": now + timedelta(seconds=self.lease),
+                    "expires_at": now + timedelta(seconds=self.ttl)
+                })
+            except DuplicateKeyError:
+                pass
+            else:
+                return await self._execute(claim_id, operation), False
+
+            claim = await self.collection.find_one({"_id": claim_id})
+            if claim is None:
+                # Released by a failed attempt (or expired) in the meantime
+                continue
+            if claim["fingerprint"] != request_fingerprint:
+                raise IdempotencyConflict("Idempotency-Key was already used with a different request")
+            if claim["status"] == "done":
+                return claim["response"], True
+
+            # Still running elsewhere; take it over only if its owner's lease ran out
+            taken = await self.collection.find_one_and_update(
+                {"_id": claim_id, "status": "in_progress", "locked_until": {"$lte": now}},
+                {"$set": {"locked_until": now + timedelta(seconds=self.lease)}}
+            )
+            if taken is not None:
+                return await self._execute(claim_id, operation), False
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress("A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _execute(self, claim_id: str, operation) -> Any:
+        try:
+            result = await operation()
+        except BaseException:
+            # Nothing to replay: let a retry run the operation again
+            await asyncio.shield(self.collection.delete_one({"_id": claim_id, "status": "in_progress"}))
+            raise
+        await self.collection.update_one(
+            {"_id": claim_id},
+            {"$set": {"status": "done", "response": result, "completed_at": _now()},
+             "$unset": {"locked_until": ""}}
+        )
+        return result
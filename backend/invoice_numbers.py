@@ -0,0 +1,148 @@
+"""Sequential invoice numbers.
+
+Numbers look like ``<prefix>-<period>-<sequence>`` (``INV-20250115-00042``),
+with one counter document per prefix and period in ``db.counters``. Counters
+only move through an atomic ``find_one_and_update`` ``$inc``, so concurrent
+requests and processes never get the same number; the unique index on
+``invoices.invoice_number`` backs this up.
+
+Bulk paths call ``reserve(n)`` first, with ``n`` the invoices they will
+actually create, and get a ``NumberBlock`` of their own: the numbers are
+claimed in one round trip (``max_block`` per update) and handed out locally by
+``block.next()``, so a 5k-invoice run costs a handful of counter updates and
+overlapping runs never draw from each other's block. Afterwards the run calls
+``block.release()``, which moves the counter back over what it didn't use as
+long as no one has claimed numbers past it. Anything that can't go back is
+kept as a spare, and the process's next invoices use it up first. Numbers
+still held when the process stops are skipped, not reissued.
+"""
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from pymongo import ReturnDocument
+
+PERIOD_FORMATS = {
+    "day": "%Y%m%d",
+    "month": "%Y%m",
+    "year": "%Y",
+    "none": None
+}
+
+
+def _take(ranges: deque) -> int:
+    current = ranges[0]
+    sequence = current[0]
+    current[0] += 1
+    if current[0] == current[1]:
+        ranges.popleft()
+    return sequence
+
+
+def _add(ranges: deque, claimed: list):
+    if ranges and ranges[-1][1] == claimed[0]:
+        ranges[-1][1] = claimed[1]
+    else:
+        ranges.append(claimed)
+
+
+class NumberBlock:
+    """Numbers reserved for one bulk run."""
+
+    def __init__(self, numbers: "InvoiceNumbers", key: str):
+        self.numbers = numbers
+        self.key = key
+        self._ranges = deque()  # [next, end) not handed out yet
+
+    @property
+    def remaining(self) -> int:
+        return sum(end - start for start, end in self._ranges)
+
+    async def next(self, now: Optional[datetime] = None) -> str:
+        # Used up, or a new period started mid-run: fall back to a single number
+        if not self._ranges or self.numbers.counter_key(now) != self.key:
+            return await self.numbers.next(now)
+        return self.numbers.format(self.key, _take(self._ranges))
+
+    async def release(self, now: Optional[datetime] = None):
+        """Return unused numbers to the counter where they are still its last ones."""
+        while self._ranges:
+            start, end = self._ranges[-1]
+            returned = await self.numbers.collection.find_one_and_update(
+                {"_id": self.key, "seq": end - 1},
+                {"$inc": {"seq": start - end}}
+            )
+            if returned is None:
+                # Someone claimed past the block; later invoices of this process use it
+                break
+            self._ranges.pop()
+        if self._ranges and self.numbers.counter_key(now) == self.key:
+            spare = self.numbers._spares(self.key)
+            while self._ranges:
+                _add(spare, self._ranges.popleft())
+        # Left over from a period that has ended: skipped
+        self._ranges.clear()
+
+
+class InvoiceNumbers:
+    def __init__(self, collection, prefix: str = "INV", period: str = "day", width: int = 5,
+                 max_block: int = 1000):
+        if period not in PERIOD_FORMATS:
+            raise ValueError(f"period must be one of {', '.join(PERIOD_FORMATS)}")
+        self.collection = collection
+        self.prefix = prefix
+        self.period = period
+        self.width = width
+        self.max_block = max_block
+        self._spare = {}  # counter key -> deque of [next, end) released blocks couldn't return
+
+    def counter_key(self, now: Optional[datetime] = None) -> str:
+        period_format = PERIOD_FORMATS[self.period]
+        if period_format is None:
+            return self.prefix
+        return f"{self.prefix}-{(now or datetime.now()).strftime(period_format)}"
+
+    def format(self, key: str, sequence: int) -> str:
+        return f"{key}-{sequence:0{self.width}d}"
+
+    def _spares(self, key: str) -> deque:
+        spare = self._spare.get(key)
+        if spare is None:
+            # A new period started; numbers left over from the old one are dropped
+            self._spare = {key: deque()}
+            spare = self._spare[key]
+        return spare
+
+    async def _claim(self, key: str, count: int) -> list:
+        counter = await self.collection.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        end = counter["seq"] + 1
+        return [end - count, end]
+
+    async def reserve(self, count: int, now: Optional[datetime] = None) -> NumberBlock:
+        """A block of ``count`` numbers in the current period for the caller alone."""
+        key = self.counter_key(now)
+        block = NumberBlock(self, key)
+        spare = self._spares(key)
+        while spare and block.remaining < count:
+            start, end = spare.popleft()
+            take = min(end - start, count - block.remaining)
+            _add(block._ranges, [start, start + take])
+            if start + take < end:
+                spare.appendleft([start + take, end])
+        while block.remaining < count:
+            _add(block._ranges, await self._claim(key, min(count - block.remaining, self.max_block)))
+        return block
+
+    async def next(self, now: Optional[datetime] = None) -> str:
+        key = self.counter_key(now)
+        spare = self._spares(key)
+        if spare:
+            return self.format(key, _take(spare))
+        # Single invoices claim exactly one number, so they leave no gaps
+        start, _ = await self._claim(key, 1)
+        return self.format(key, start)
@@ -0,0 +1,209 @@
+"""Live dashboard updates over Server-Sent Events.
+
+One MongoDB change stream on ``invoices`` and ``customers`` is shared by every
+connected client. It runs only while someone is subscribed. Changes are
+collected for ``coalesce`` seconds and then fanned out as one ``invoices``
+event (the latest status of each changed invoice) and one ``stats`` event (the
+dashboard counters plus the delta since the last broadcast), so a billing run
+touching thousands of invoices costs each tab a message per window. N viewers
+cost one watcher and one stats read per window instead of N polling loops.
+
+Change streams need a replica set (a single-node one is enough). On a
+standalone server the feed falls back to one shared stats poll every
+``poll_interval`` seconds, without per-invoice events.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+INVOICE_FIELDS = ("id", "invoice_number", "customer_id", "status", "due_date", "amount", "sent_at", "paid_at")
+
+# "The $changeStream stage is only supported on replica sets"
+NOT_A_REPLICA_SET = 40573
+
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def _flatten(value, prefix: str = "") -> dict:
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            out.update(_flatten(item, f"{prefix}{key}."))
+        return out
+    return {prefix[:-1]: value}
+
+
+def stats_delta(old: Optional[dict], new: dict) -> dict:
+    """Numeric differences between two stats snapshots, as dotted paths."""
+    old_flat, new_flat = _flatten(old or {}), _flatten(new)
+    delta = {}
+    for path, value in new_flat.items():
+        before = old_flat.get(path, 0)
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and value != before:
+            delta[path] = value - before
+    return delta
+
+
+class LiveUpdates:
+    def __init__(self, db, load_stats: Callable[..., Awaitable[dict]], coalesce: float = 1.0,
+                 heartbeat: float = 15.0, poll_interval: float = 5.0, queue_size: int = 100):
+        self.db = db
+        self.load_stats = load_stats
+        self.coalesce = coalesce
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._task = None
+        self._stats = None
+        self._resume_token = None
+        self._change_streams = True
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    # ============ SUBSCRIBERS ============
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        # The watcher notices the empty set and stops on its next wake-up
+
+    def _broadcast(self, message: str):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A client that can't keep up gets told to refetch instead of a backlog
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(sse("resync", {}))
+
+    async def stream(self) -> AsyncIterator[str]:
+        queue = self.subscribe()
+        try:
+            stats = await self.load_stats()
+            if self._stats is None:
+                # Deltas are relative to what clients were last sent
+                self._stats = stats
+            yield sse("stats", {"stats": stats, "delta": {}})
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    # Comment line: keeps proxies from closing an idle connection
+                    yield ": ping\n\n"
+        finally:
+            self.unsubscribe(queue)
+
+    async def close(self):
+        self._subscribers.clear()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # ============ FEED ============
+
+    async def _publish_stats(self):
+        try:
+            # Bypass the stats cache: something just changed
+            stats = await self.load_stats(fresh=True)
+        except PyMongoError as e:
+            logger.warning("Live stats refresh failed: %s", e)
+            return
+        delta = stats_delta(self._stats, stats) if self._stats is not None else {}
+        if self._stats is None or delta:
+            self._broadcast(sse("stats", {"stats": stats, "delta": delta}))
+        self._stats = stats
+
+    async def _flush(self, invoices: dict, stats_dirty: bool):
+        if invoices:
+            self._broadcast(sse("invoices", {"changes": list(invoices.values())}))
+        if stats_dirty:
+            await self._publish_stats()
+
+    async def _run(self):
+        backoff = 1.0
+        while self._subscribers:
+            try:
+                if self._change_streams:
+                    await self._watch()
+                else:
+                    await self._poll()
+                backoff = 1.0
+                continue
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == NOT_A_REPLICA_SET:
+                    self._fall_back(e)
+                    continue
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    self._resume_token = None
+                logger.warning("Change stream failed (%s), reconnecting in %.0fs", e, backoff)
+            except PyMongoError as e:
+                logger.warning("Change stream interrupted (%s), reconnecting in %.0fs", e, backoff)
+            except Exception:
+                # A bug, not a missing feature: keep the traceback and keep retrying
+                logger.exception("Live updates feed failed, restarting in %.0fs", backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+        # Nobody missed anything while idle; the next watcher starts from now
+        self._resume_token = None
+        self._stats = None
+
+    def _fall_back(self, error: Exception):
+        logger.warning("Change streams unavailable (%s); polling dashboard stats instead", error)
+        self._change_streams = False
+
+    async def _watch(self):
+        pipeline = [
+            {"$match": {
+                "ns.coll": {"$in": ["invoices", "customers"]},
+                "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+            }},
+            # Only what the events carry; _id is the resume token and must stay
+            {"$project": {
+                "operationType": 1, "ns": 1,
+                **{f"fullDocument.{field}": 1 for field in INVOICE_FIELDS}
+            }}
+        ]
+        invoices, stats_dirty, deadline = {}, False, None
+        async with self.db.watch(pipeline, full_document="updateLookup", resume_after=self._resume_token,
+                                 max_await_time_ms=int(self.coalesce * 1000)) as stream:
+            while self._subscribers:
+                change = await stream.try_next()
+                if change is not None:
+                    stats_dirty = True
+                    document = change.get("fullDocument")
+                    if change["ns"]["coll"] == "invoices" and document and document.get("id"):
+                        invoices[document["id"]] = document
+                    if deadline is None:
+                        deadline = time.monotonic() + self.coalesce
+                self._resume_token = stream.resume_token
+                if deadline is not None and time.monotonic() >= deadline:
+                    await self._flush(invoices, stats_dirty)
+                    invoices, stats_dirty, deadline = {}, False, None
+
+    async def _poll(self):
+        while self._subscribers:
+            await self._publish_stats()
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,283 @@
+"""Durable WhatsApp delivery outbox.
+
+A send request is one insert into ``whatsapp_outbox``; a pool of workers
+drains it. Each worker claims the oldest due message with an atomic
+``find_one_and_update`` that also takes a lease, so messages are never
+delivered by two workers at once, and a message whose worker died (process
+restart, crash) is picked up again once its lease expires. Delivery is
+therefore at-least-once.
+
+A send can outlast a fixed lease (render queue, rate limiter, upload), so the
+worker renews ``locked_until`` every ``lease / 3`` seconds while it is
+sending. Renewals and results only apply while the message still carries the
+worker's ``lease_id``; a worker that finds its lease taken over abandons the
+send.
+
+Failures are retried with exponential backoff (``base_delay * 2^n``, capped
+at ``max_delay``, with jitter). ``PermanentDeliveryError`` and running out of
+``max_attempts`` move a message to ``dead``, where it stays until retried by
+hand. While WhatsApp is disconnected workers wait instead of burning attempts.
+
+Message status: ``queued`` -> ``sending`` -> ``sent`` | ``queued`` (retry) |
+``dead`` | ``skipped`` (``DeliverySkipped``: nothing left to send, e.g. the
+invoice was paid while the message waited). Each message has a ``key`` (``invoice:<id>`` by default, or e.g. one
+per reminder); ``active_key`` is set to it only while queued or sending, and
+its sparse unique index keeps one live message per key.
+"""
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentDeliveryError(Exception):
+    """Retrying can't help (missing invoice, rejected phone number, ...)."""
+
+
+class DeliverySkipped(Exception):
+    """The message no longer needs sending (invoice already paid, ...)."""
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class WhatsAppOutbox:
+    def __init__(self, collection, deliver: Callable[[dict], Awaitable[None]],
+                 is_connected: Callable[[], Awaitable[bool]], workers: int = 4,
+                 max_attempts: int = 8, base_delay: float = 30.0, max_delay: float = 3600.0,
+                 lease: float = 120.0, poll_interval: float = 2.0,
+                 on_result: Optional[Callable[[str], None]] = None):
+        self.collection = collection
+        self.deliver = deliver
+        self.is_connected = is_connected
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.on_result = on_result
+        self._tasks = []
+        self._wake = None
+
+    # ============ PRODUCERS ============
+
+    async def enqueue(self, invoice_id: str, caption: Optional[str] = None,
+                      active_key: Optional[str] = None) -> dict:
+        """Queue an invoice for delivery; returns the live message if one exists."""
+        now = _now().isoformat()
+        key = active_key or f"invoice:{invoice_id}"
+        message = {
+            "id": str(uuid.uuid4()),
+            "invoice_id": invoice_id,
+            "caption": caption,
+            "status": "queued",
+            "key": key,
+            "active_key": key,
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            "updated_at": now
+        }
+        try:
+            await self.collection.insert_one(message)
+        except DuplicateKeyError:
+            existing = await self.collection.find_one({"active_key": message["active_key"]}, {"_id": 0})
+            if existing is not None:
+                return existing
+            # Finished between the insert and the read; queue a fresh one
+            return await self.enqueue(invoice_id, caption, active_key)
+        message.pop("_id", None)
+        self._notify()
+        return message
+
+    async def retry(self, message_id: str) -> Optional[dict]:
+        """Requeue a dead message with a fresh attempt budget."""
+        message = await self.collection.find_one({"id": message_id, "status": "dead"}, {"_id": 0})
+        if message is None:
+            return None
+        now = _now().isoformat()
+        key = message.get("key") or f"invoice:{message['invoice_id']}"
+        try:
+            message = await self.collection.find_one_and_update(
+                {"id": message_id, "status": "dead"},
+                {"$set": {"status": "queued", "attempts": 0, "next_attempt_at": now, "updated_at": now,
+                          "active_key": key},
+                 "$unset": {"last_error": ""}},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The same key was queued again in the meantime
+            return await self.collection.find_one({"active_key": key}, {"_id": 0})
+        if message is None:
+            return None
+        message.pop("_id", None)
+        self._notify()
+        return message
+
+    def _notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    # ============ WORKERS ============
+
+    def start(self):
+        if self._tasks:
+            return
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _idle(self):
+        try:
+            await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def _worker(self):
+        while True:
+            try:
+                if not await self.is_connected():
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                message = await self._claim()
+                if message is None:
+                    await self._idle()
+                    continue
+                await self._process(message)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.warning("WhatsApp outbox worker: %s", e)
+                await asyncio.sleep(self.poll_interval)
+            except Exception:
+                logger.exception("WhatsApp outbox worker failed")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _claim(self) -> Optional[dict]:
+        now = _now()
+        message = await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "next_attempt_at": {"$lte": now.isoformat()}},
+                # Leased by a worker that never finished
+                {"status": "sending", "locked_until": {"$lte": now.isoformat()}}
+            ]},
+            {"$set": {"status": "sending", "updated_at": now.isoformat(), "lease_id": str(uuid.uuid4()),
+                      "locked_until": (now + timedelta(seconds=self.lease)).isoformat()},
+             "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if message is not None:
+            message.pop("_id", None)
+        return message
+
+    def _leased(self, message: dict) -> dict:
+        return {"id": message["id"], "status": "sending", "lease_id": message["lease_id"]}
+
+    async def _heartbeat(self, message: dict):
+        # Returns only once the lease is lost
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            locked_until = _now() + timedelta(seconds=self.lease)
+            try:
+                renewed = await self.collection.update_one(
+                    self._leased(message), {"$set": {"locked_until": locked_until.isoformat()}}
+                )
+            except PyMongoError as e:
+                # The lease still has at least two thirds left; try again next beat
+                logger.warning("Could not renew lease on WhatsApp message %s: %s", message["id"], e)
+                continue
+            if not renewed.matched_count:
+                return
+
+    async def _process(self, message: dict):
+        delivery = asyncio.ensure_future(self.deliver(message))
+        heartbeat = asyncio.ensure_future(self._heartbeat(message))
+        try:
+            await asyncio.wait({delivery, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # Shutting down mid-send: hand the message back without spending the attempt
+            delivery.cancel()
+            heartbeat.cancel()
+            await asyncio.shield(self._release(message))
+            raise
+        heartbeat.cancel()
+        if not delivery.done():
+            logger.warning("Lost the lease on WhatsApp message %s; abandoning this send", message["id"])
+            delivery.cancel()
+            await asyncio.gather(delivery, return_exceptions=True)
+            return
+
+        try:
+            delivery.result()
+        except DeliverySkipped as e:
+            await self._finish(message, "skipped", {"last_error": str(e)})
+        except PermanentDeliveryError as e:
+            await self._dead(message, str(e))
+        except Exception as e:
+            error = getattr(e, "detail", None) or str(e) or type(e).__name__
+            if message["attempts"] >= self.max_attempts:
+                await self._dead(message, error)
+            else:
+                await self._reschedule(message, error)
+        else:
+            await self._finish(message, "sent", {"sent_at": _now().isoformat()})
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _reschedule(self, message: dict, error):
+        now = _now()
+        next_attempt = now + timedelta(seconds=self._backoff(message["attempts"]))
+        await self.collection.update_one(
+            self._leased(message),
+            {"$set": {"status": "queued", "next_attempt_at": next_attempt.isoformat(),
+                      "last_error": error, "updated_at": now.isoformat()},
+             "$unset": {"locked_until": "", "lease_id": ""}}
+        )
+        self._report("retry")
+
+    async def _dead(self, message: dict, error):
+        logger.warning("WhatsApp message %s for invoice %s dead-lettered: %s",
+                       message["id"], message["invoice_id"], error)
+        await self._finish(message, "dead", {"last_error": error})
+
+    async def _finish(self, message: dict, status: str, fields: dict):
+        await self.collection.update_one(
+            self._leased(message),
+            {"$set": {"status": status, "updated_at": _now().isoformat(), **fields},
+             "$unset": {"locked_until": "", "lease_id": "", "active_key": ""}}
+        )
+        self._report(status)
+
+    async def _release(self, message: dict):
+        try:
+            await self.collection.update_one(
+                self._leased(message),
+                {"$set": {"status": "queued", "updated_at": _now().isoformat()},
+                 "$unset": {"locked_until": "", "lease_id": ""},
+                 "$inc": {"attempts": -1}}
+            )
+        except PyMongoError as e:
+            # The lease expires on its own
+            logger.warning("Could not release WhatsApp message %s: %s", message["id"], e)
+
+    def _report(self, result: str):
+        if self.on_result is not None:
+            self.on_result(result)
@@ -0,0 +1,59 @@
+"""Keyset (cursor) pagination over indexed sort keys.
+
+A page is fetched with a range filter on the sort keys of the last document
+of the previous page, so every page costs the same index seek no matter how
+deep the client goes. Cursors are opaque base64url-encoded JSON.
+"""
+import base64
+import json
+from typing import List, Optional, Tuple
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values: list) -> str:
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+
+def keyset_filter(sort: List[Tuple[str, int]], values: list) -> dict:
+    # (k1 > v1) OR (k1 == v1 AND k2 > v2) OR ... with > / < following each direction
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+        clause[field] = {"$gt" if direction > 0 else "$lt": values[i]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+async def keyset_page(collection, query: dict, projection: dict, sort: List[Tuple[str, int]],
+                      after: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+    if after:
+        keyset = keyset_filter(sort, decode_cursor(after, len(sort)))
+        query = {"$and": [query, keyset]} if query else keyset
+
+    docs = await collection.find(query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor([last.get(field) for field, _ in sort])
+
+    return {"items": docs, "next_cursor": next_cursor}
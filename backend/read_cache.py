@@ -0,0 +1,82 @@
+"""In-process read-through cache for hot JSON reads.
+
+Entries keep the serialized response body together with its ETag, so a hit
+skips both the MongoDB read and re-serialization, and a client revalidating
+with ``If-None-Match`` gets a bodiless 304. Entries expire after ``ttl``
+seconds and the least recently used are evicted past ``max_entries``.
+
+Keys are tuples whose first element is a namespace; write endpoints drop a
+single key or a whole namespace. A load that overlaps an invalidation of its
+namespace is returned but not stored, so a racing write can't be masked.
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+
+def dump_json(value: Any) -> bytes:
+    # Same encoding as starlette's JSONResponse
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class CachedBody:
+    __slots__ = ("body", "etag", "loaded_at")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.loaded_at = time.monotonic()
+
+
+class ReadCache:
+    def __init__(self, ttl: float = 30.0, max_entries: int = 2048):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> CachedBody, least recently used first
+        self._versions = {}  # namespace -> invalidation count
+
+    async def get(self, key: tuple, load: Callable[[], Awaitable[Any]]) -> Optional[CachedBody]:
+        """Return the cached body for ``key``, calling ``load`` on a miss.
+
+        ``load`` returns a JSON-serializable value, or None for "not found",
+        which is not cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.loaded_at <= self.ttl:
+            self._entries.move_to_end(key)
+            return entry
+
+        version = self._versions.get(key[0], 0)
+        value = await load()
+        if value is None:
+            self._entries.pop(key, None)
+            return None
+        entry = CachedBody(dump_json(value))
+        if self.ttl > 0 and self._versions.get(key[0], 0) == version:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, namespace: str, *key):
+        self._versions[namespace] = self._versions.get(namespace, 0) + 1
+        if key:
+            self._entries.pop((namespace, *key), None)
+            return
+        for cached in [k for k in self._entries if k[0] == namespace]:
+            del self._entries[cached]
+
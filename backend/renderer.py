@@ -0,0 +1,294 @@
+"""PDF rendering worker pool.
+
+Rendering runs in persistent worker processes, so wkhtmltopdf/weasyprint never
+block the API event loop. weasyprint is only the fallback and is imported by a
+worker the first time it needs it, which keeps worker spawn cheap. HTML goes in
+as a string (wkhtmltopdf reads it on stdin) and the PDF comes back as bytes
+over the worker's pipe; no temporary files are involved.
+
+A render is handed to a worker only once one is idle, so at most ``workers``
+run at a time; up to ``queue_size`` more wait for a worker, and beyond that
+callers get ``RendererBusy`` after ``queue_timeout``. ``timeout`` covers the
+render itself, not the wait. Workers enforce it on their own (wkhtmltopdf's
+subprocess timeout, an interval timer around weasyprint) and stay in service.
+A worker that has not answered ``kill_after`` seconds after dispatch is stuck
+in native code: that process alone is killed and replaced, and the other
+workers keep rendering.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RenderError(Exception):
+    pass
+
+
+class RendererBusy(RenderError):
+    pass
+
+
+class RenderTimeout(RenderError):
+    pass
+
+
+class _WorkerLost(Exception):
+    pass
+
+
+# ============ WORKER PROCESS ============
+
+_weasy_html = None
+_weasy_loaded = False
+
+
+def _weasyprint_html():
+    global _weasy_html, _weasy_loaded
+    if not _weasy_loaded:
+        _weasy_loaded = True
+        try:
+            from weasyprint import HTML
+            _weasy_html = HTML
+        except (ImportError, OSError):
+            # OSError: weasyprint installed but its native libraries (pango) are missing
+            _weasy_html = None
+    return _weasy_html
+
+
+def _warm_worker():
+    # Without wkhtmltopdf, weasyprint is the main path: load it now, not on the first render
+    if shutil.which('wkhtmltopdf') is None:
+        _weasyprint_html()
+    return os.getpid()
+
+
+def _timed_out(timeout: float) -> RenderTimeout:
+    return RenderTimeout(f"PDF rendering exceeded {timeout:.0f}s")
+
+
+@contextmanager
+def _time_limit(seconds: float, timeout: float):
+    # Jobs run on the worker's main thread, where SIGALRM is delivered
+    if not hasattr(signal, "setitimer"):
+        yield
+        return
+
+    def expired(signum, frame):
+        raise _timed_out(timeout)
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, max(seconds, 0.001))
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _render_pdf(html_content: str, timeout: float) -> bytes:
+    deadline = time.monotonic() + timeout
+    try:
+        # Try wkhtmltopdf first, stdin -> stdout
+        result = subprocess.run(['wkhtmltopdf', '--quiet', '--enable-local-file-access', '-', '-'],
+                                input=html_content.encode('utf-8'), check=True,
+                                capture_output=True, timeout=timeout)
+        if result.stdout:
+            return result.stdout
+    except subprocess.TimeoutExpired:
+        raise _timed_out(timeout)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        pass
+
+    # Fallback: use weasyprint, within what is left of the same budget
+    html = _weasyprint_html()
+    if html is None:
+        raise RenderError("PDF generation tools not available. Install wkhtmltopdf or weasyprint.")
+    with _time_limit(deadline - time.monotonic(), timeout):
+        return html(string=html_content).write_pdf()
+
+
+def _worker_main(conn):
+    # Ctrl+C goes to the API process, which stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conn.send(_warm_worker())
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            reply = (True, _render_pdf(*job))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception:
+            # An exception that doesn't pickle; pickling fails before anything is written
+            conn.send((False, RenderError(f"{type(reply[1]).__name__}: {reply[1]}")))
+
+
+# ============ POOL ============
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        try:
+            # Blocks until the worker has loaded what it renders with
+            self.pid = self.conn.recv()
+        except EOFError:
+            raise RenderError("PDF renderer worker failed to start")
+
+    def call(self, html_content: str, timeout: float):
+        try:
+            self.conn.send((html_content, timeout))
+            return self.conn.recv()
+        except (EOFError, OSError):
+            raise _WorkerLost()
+
+    def close(self):
+        # Only once no thread is reading the pipe
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class PdfRenderer:
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None,
+                 timeout: float = 60.0, queue_timeout: float = 30.0, kill_after: Optional[float] = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size if queue_size is not None else self.workers * 4
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.kill_after = kill_after if kill_after is not None else timeout + 5.0
+        self._context = multiprocessing.get_context("spawn")
+        self._threads = None
+        self._workers = set()
+        self._replacing = set()
+        self._idle = None
+        self._slots = None
+        self._in_flight = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self._in_flight - self.workers, 0)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def start(self):
+        if self._idle is not None:
+            return
+        self._slots = asyncio.Semaphore(self.workers + self.queue_size)
+        self._idle = asyncio.Queue()
+        # One pipe reader per worker, so renders never wait on the default executor
+        self._threads = ThreadPoolExecutor(self.workers, thread_name_prefix="pdf-render")
+        loop = asyncio.get_running_loop()
+        # Spawn every worker up front so the first renders don't pay for process start
+        workers = await asyncio.gather(*(loop.run_in_executor(None, _Worker, self._context)
+                                         for _ in range(self.workers)))
+        for worker in workers:
+            self._workers.add(worker)
+            self._idle.put_nowait(worker)
+        logger.info("PDF renderer started with %d workers", self.workers)
+
+    async def shutdown(self):
+        workers, self._workers = self._workers, set()
+        self._idle = None
+        for worker in workers:
+            # Renders still running on it fail with RenderError
+            worker.process.terminate()
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._threads = None
+
+    async def _replace(self, worker: _Worker, idle: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, worker.close)
+        self._workers.discard(worker)
+        while idle is self._idle:
+            try:
+                replacement = await loop.run_in_executor(None, _Worker, self._context)
+            except Exception:
+                logger.exception("Could not start a PDF renderer worker; retrying")
+                await asyncio.sleep(5)
+                continue
+            if idle is not self._idle:
+                # Shut down while it was starting
+                replacement.process.terminate()
+                return
+            self._workers.add(replacement)
+            idle.put_nowait(replacement)
+            return
+
+    async def _dispatch(self, worker: _Worker, idle: asyncio.Queue, html_content: str):
+        reply = asyncio.get_running_loop().run_in_executor(self._threads, worker.call, html_content, self.timeout)
+        healthy = False
+        try:
+            ok, value = await asyncio.wait_for(asyncio.shield(reply), self.kill_after)
+            healthy = True
+        except asyncio.TimeoutError:
+            # Past the worker's own time limit: stuck in native code
+            logger.warning("PDF renderer worker %d is stuck; killing it", worker.pid)
+            worker.process.kill()
+            await asyncio.gather(reply, return_exceptions=True)
+            raise _timed_out(self.timeout)
+        finally:
+            if healthy:
+                idle.put_nowait(worker)
+            else:
+                task = asyncio.create_task(self._replace(worker, idle))
+                self._replacing.add(task)
+                task.add_done_callback(self._replacing.discard)
+        if not ok:
+            raise value
+        return value
+
+    async def render(self, html_content: str) -> bytes:
+        if self._idle is None:
+            await self.start()
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise RendererBusy("PDF renderer queue is full")
+
+        self._in_flight += 1
+        try:
+            for attempt in range(2):
+                idle = self._idle
+                if idle is None:
+                    raise RenderError("PDF renderer is shut down")
+                # The render timeout starts once a worker is free, not while queued
+                worker = await idle.get()
+                # Shielded: a caller going away must not leave a worker half-read
+                dispatch = asyncio.ensure_future(self._dispatch(worker, idle, html_content))
+                # Retrieved even when the caller is gone, so it isn't logged as unhandled
+                dispatch.add_done_callback(lambda task: task.cancelled() or task.exception())
+                try:
+                    return await asyncio.shield(dispatch)
+                except _WorkerLost:
+                    # The worker died (crash, OOM kill); retry once on another
+                    if attempt:
+                        raise RenderError("PDF renderer worker crashed")
+                    logger.warning("PDF renderer worker %d died; retrying the render", worker.pid)
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
@@ -0,0 +1,290 @@
+"""Revenue rollups.
+
+Payments and billing are counted into small bucket documents in
+``revenue_rollups`` as they happen, so a revenue report over any range reads
+one document per day or month instead of scanning invoices:
+
+* ``day:<YYYY-MM-DD>`` and ``month:<YYYY-MM>`` by payment date: ``revenue``
+  and ``payments``;
+* ``month:<YYYY-MM>`` by due date: ``billed_amount``/``billed_count`` when an
+  invoice is created and ``collected_amount``/``collected_count`` when it is
+  paid, which gives the collection rate for invoices due that month.
+
+Every counter is also kept per package under ``packages.<package>``. Updates
+are ``$inc`` upserts; a batch of payments is merged into one ``bulk_write``.
+
+Payments are applied exactly once even across crashes. The payment write
+marks each invoice ``rollup_applied: false``; the batch's increments are then
+applied to each bucket only if the bucket's ``applied`` list doesn't hold the
+batch id yet (the check and the ``$inc`` are one update), and the invoices are
+flagged ``true`` afterwards. ``apply_pending`` (run at startup and hourly)
+finishes batches a crash left unflagged. Markers are kept for a day, then
+dropped unless their batch is still pending.
+
+``rebuild`` recomputes everything from the invoices into a scratch collection
+and renames it over the live one. Payments and invoices recorded while it
+runs are applied to the new collection after the swap.
+"""
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+BUCKETS = ("day", "month")
+
+COUNTERS = ("revenue", "payments", "billed_amount", "billed_count", "collected_amount", "collected_count")
+
+# Billing and collection are only counted per due month
+DAY_COUNTERS = ("revenue", "payments")
+
+INDEXES = [
+    IndexModel([("bucket", ASCENDING), ("start", ASCENDING)]),
+]
+
+# How long a bucket remembers that a payment batch was applied to it
+MARKER_RETENTION = timedelta(days=1)
+
+# Payments and invoices this close to a rebuild's start are re-applied after the swap
+REBUILD_OVERLAP = timedelta(minutes=10)
+
+
+def package_key(package) -> str:
+    # Package names become field names: no dots or leading $
+    key = str(package or "").strip().replace(".", "_").lstrip("$")
+    return key or "unknown"
+
+
+def bucket_start(bucket: str, value: str) -> str:
+    return str(value)[:10] if bucket == "day" else str(value)[:7]
+
+
+def _bucket_id(bucket: str, value: str) -> str:
+    return f"{bucket}:{bucket_start(bucket, value)}"
+
+
+class _Increments:
+    def __init__(self):
+        self._by_id = defaultdict(lambda: defaultdict(int))
+
+    def add(self, bucket: str, value: str, package: str, **counters):
+        doc = self._by_id[_bucket_id(bucket, value)]
+        for name, amount in counters.items():
+            doc[name] += amount
+            doc[f"packages.{package_key(package)}.{name}"] += amount
+
+    def ops(self) -> List[UpdateOne]:
+        ops = []
+        for bucket_id, inc in self._by_id.items():
+            bucket, start = bucket_id.split(":", 1)
+            ops.append(UpdateOne(
+                {"_id": bucket_id},
+                {"$inc": dict(inc), "$setOnInsert": {"bucket": bucket, "start": start}},
+                upsert=True
+            ))
+        return ops
+
+    def marked_ops(self, marker: str, now: str) -> List[UpdateOne]:
+        # Create the buckets first, then increment each one only if it hasn't seen this marker
+        ops = []
+        for bucket_id in self._by_id:
+            bucket, start = bucket_id.split(":", 1)
+            ops.append(UpdateOne({"_id": bucket_id}, {"$setOnInsert": {"bucket": bucket, "start": start}},
+                                 upsert=True))
+        for bucket_id, inc in self._by_id.items():
+            ops.append(UpdateOne(
+                {"_id": bucket_id, "applied.batch": {"$ne": marker}},
+                {"$inc": dict(inc), "$push": {"applied": {"batch": marker, "at": now}}}
+            ))
+        return ops
+
+
+def _add_payment(increments: _Increments, invoice: dict, amount):
+    package = invoice.get("package")
+    for bucket in BUCKETS:
+        increments.add(bucket, invoice["paid_at"], package, revenue=amount, payments=1)
+    increments.add("month", invoice["due_date"], package, collected_amount=amount, collected_count=1)
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# Invoices joined with their customer's package
+_WITH_PACKAGE = [
+    {"$lookup": {
+        "from": "customers",
+        "localField": "customer_id",
+        "foreignField": "id",
+        "as": "customer"
+    }},
+    {"$project": {
+        "_id": 0, "amount": 1, "due_date": 1, "status": 1, "paid_at": 1, "created_at": 1, "rollup_applied": 1,
+        "payment.amount": 1, "payment.batch": 1, "payment.recorded_at": 1,
+        "package": {"$arrayElemAt": ["$customer.package", 0]}
+    }}
+]
+
+
+def _collection_rate(doc: dict) -> Optional[float]:
+    billed = doc.get("billed_amount", 0)
+    return round(doc.get("collected_amount", 0) / billed, 4) if billed else None
+
+
+class RevenueRollups:
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.revenue_rollups
+
+    # ============ UPDATES ============
+
+    async def invoice_billed(self, invoice: dict, package: Optional[str]):
+        increments = _Increments()
+        increments.add("month", invoice["due_date"], package,
+                       billed_amount=invoice["amount"], billed_count=1)
+        await self.collection.bulk_write(increments.ops())
+
+    async def payments_recorded(self, batch: str, payments: Iterable[dict]):
+        """Count a payment batch; each invoice carries ``package`` and its ``payment``.
+
+        The invoices must have been written with ``payment.batch`` and
+        ``rollup_applied: false``; calling this again for the same batch is a
+        no-op.
+        """
+        increments = _Increments()
+        for invoice in payments:
+            _add_payment(increments, invoice, invoice["payment"]["amount"])
+        ops = increments.marked_ops(batch, _now().isoformat())
+        if ops:
+            # Ordered: a bucket's upsert has to run before its increment
+            await self.collection.bulk_write(ops)
+        await self.db.invoices.update_many(
+            {"payment.batch": batch, "rollup_applied": False}, {"$set": {"rollup_applied": True}}
+        )
+
+    async def apply_pending(self) -> int:
+        """Finish payment batches whose rollup step didn't complete; returns how many."""
+        batches = defaultdict(list)
+        async for invoice in self.db.invoices.aggregate([{"$match": {"rollup_applied": False}}, *_WITH_PACKAGE]):
+            batches[invoice["payment"]["batch"]].append(invoice)
+        for batch, invoices in batches.items():
+            await self.payments_recorded(batch, invoices)
+        await self._prune_markers()
+        return len(batches)
+
+    async def _prune_markers(self):
+        cutoff = (_now() - MARKER_RETENTION).isoformat()
+        pending = await self.db.invoices.distinct("payment.batch", {"rollup_applied": False})
+        await self.collection.update_many(
+            {"applied.at": {"$lt": cutoff}},
+            {"$pull": {"applied": {"at": {"$lt": cutoff}, "batch": {"$nin": pending}}}}
+        )
+
+    async def rebuild(self) -> int:
+        # Anything recorded after the cutoff may have gone to the collection being replaced
+        cutoff = (_now() - REBUILD_OVERLAP).isoformat()
+        increments = _Increments()
+        async for invoice in self.db.invoices.aggregate(_WITH_PACKAGE):
+            if not invoice.get("due_date"):
+                continue
+            package = invoice.get("package")
+            increments.add("month", invoice["due_date"], package,
+                           billed_amount=invoice.get("amount", 0), billed_count=1)
+            payment = invoice.get("payment") or {}
+            # Recent and still pending payments are applied after the swap instead
+            if (invoice.get("status") == "paid" and payment.get("recorded_at", "") < cutoff
+                    and invoice.get("rollup_applied") is not False):
+                amount = payment.get("amount", invoice.get("amount", 0))
+                increments.add("month", invoice["due_date"], package,
+                               collected_amount=amount, collected_count=1)
+                if invoice.get("paid_at"):
+                    for bucket in BUCKETS:
+                        increments.add(bucket, invoice["paid_at"], package, revenue=amount, payments=1)
+
+        # Built aside and renamed over the live collection, which never sits half-empty
+        scratch = self.db[f"{self.collection.name}_rebuild_{uuid.uuid4().hex}"]
+        try:
+            ops = increments.ops()
+            if ops:
+                await scratch.bulk_write(ops, ordered=False)
+            await scratch.create_indexes(INDEXES)
+            await scratch.rename(self.collection.name, dropTarget=True)
+        except Exception:
+            await scratch.drop()
+            raise
+
+        await self._reapply_since(cutoff)
+        await self.apply_pending()
+        return await self.collection.count_documents({})
+
+    async def _reapply_since(self, cutoff: str):
+        # Payments: batch markers make this safe against the payment request itself
+        batches = defaultdict(list)
+        query = {"status": "paid", "payment.recorded_at": {"$gte": cutoff}}
+        async for invoice in self.db.invoices.aggregate([{"$match": query}, *_WITH_PACKAGE]):
+            batches[invoice["payment"]["batch"]].append(invoice)
+        for batch, invoices in batches.items():
+            await self.payments_recorded(batch, invoices)
+
+        # Billing has no markers: recount the due months of recent invoices outright
+        months = await self.db.invoices.distinct("due_date", {"created_at": {"$gte": cutoff}})
+        months = sorted({bucket_start("month", due_date) for due_date in months if due_date})
+        for month in months:
+            totals = {"billed_amount": 0, "billed_count": 0}
+            packages = defaultdict(lambda: {"billed_amount": 0, "billed_count": 0})
+            pipeline = [{"$match": {"due_date": {"$regex": f"^{month}"}}}, *_WITH_PACKAGE]
+            async for invoice in self.db.invoices.aggregate(pipeline):
+                counters = packages[package_key(invoice.get("package"))]
+                for target in (totals, counters):
+                    target["billed_amount"] += invoice.get("amount", 0)
+                    target["billed_count"] += 1
+            fields = dict(totals)
+            for package, counters in packages.items():
+                for name, value in counters.items():
+                    fields[f"packages.{package}.{name}"] = value
+            await self.collection.update_one(
+                {"_id": f"month:{month}"},
+                {"$set": fields, "$setOnInsert": {"bucket": "month", "start": month}},
+                upsert=True
+            )
+
+    # ============ REPORTS ============
+
+    async def report(self, start: str, end: str, granularity: str = "month") -> dict:
+        low, high = bucket_start(granularity, start), bucket_start(granularity, end)
+        if granularity == "day" and len(high) == 7:
+            # A month as the end of a daily report means through its last day
+            high += "-31"
+        docs = await self.collection.find(
+            {"bucket": granularity, "start": {"$gte": low, "$lte": high}},
+            {"_id": 0}
+        ).sort("start", 1).to_list(None)
+
+        names = COUNTERS if granularity == "month" else DAY_COUNTERS
+        totals = {name: 0 for name in names}
+        packages = defaultdict(lambda: {name: 0 for name in names})
+        periods = []
+        for doc in docs:
+            period = {"period": doc["start"], **{name: doc.get(name, 0) for name in names}}
+            if granularity == "month":
+                period["collection_rate"] = _collection_rate(doc)
+            periods.append(period)
+            for name in names:
+                totals[name] += doc.get(name, 0)
+            for package, counters in doc.get("packages", {}).items():
+                for name in names:
+                    packages[package][name] += counters.get(name, 0)
+
+        if granularity == "month":
+            totals["collection_rate"] = _collection_rate(totals)
+            for counters in packages.values():
+                counters["collection_rate"] = _collection_rate(counters)
+        return {
+            "start": start,
+            "end": end,
+            "granularity": granularity,
+            "totals": totals,
+            "packages": dict(packages),
+            "periods": periods
+        }
@@ -1,22 +1,49 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, StreamingResponse
+from startup_profile import profile as startup_profile
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Header, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional, Union
 import uuid
 from datetime import datetime, timezone, timedelta
-import pandas as pd
-import io
-import aiofiles
-import requests
+from contextlib import contextmanager
+import re
+import shutil
+import tempfile
 import json
+import time
+import asyncio
+from collections import deque
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from wa_client import WhatsAppClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from billing_scheduler import BillingScheduler, next_due_date
+from dashboard_stats import DashboardStats
+from pagination import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursor, decode_cursor, encode_cursor,
+                        keyset_filter, keyset_page)
+from customer_search import SEARCH_FIELDS, search_filter, search_keys
+from customer_import import CUSTOMER_COLUMNS, READERS, ImportFormatError, detect_format, import_customers_stream
+from template_cache import CompiledTemplate, TemplateCache
+from exports import XLSX_MEDIA_TYPE, merge_pdfs, stream_csv, stream_file, stream_zip, write_xlsx
+from artifacts import ArtifactNotFound, ArtifactNotPersisted, ArtifactStore
+from invoice_numbers import InvoiceNumbers, NumberBlock
+from idempotency import IdempotencyConflict, IdempotencyInProgress, IdempotencyStore
+from read_cache import ReadCache, etag_matches
+from revenue import INDEXES as REVENUE_INDEXES, RevenueRollups
+from live_updates import LiveUpdates
+from outbox import DeliverySkipped, PermanentDeliveryError, WhatsAppOutbox
+from renderer import PdfRenderer, RenderError, RendererBusy, RenderTimeout
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, RequestTimer
+
+startup_profile.record("import", "modules", startup_profile.since_start())
+_module_init_started = time.perf_counter()
 
 ROOT_DIR = Path(__file__).parent    
 load_dotenv(ROOT_DIR / '.env')
@@ -26,6 +53,25 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Compiled invoice templates, keyed by template id
+template_cache = TemplateCache(db, ttl=float(os.environ.get('TEMPLATE_CACHE_TTL', '60')))
+
+# Daily/monthly revenue and collection counters in db.revenue_rollups
+revenue_rollups = RevenueRollups(db)
+
+# Serialized bodies of hot read endpoints, dropped by the matching writes
+read_cache = ReadCache(
+    ttl=float(os.environ.get('READ_CACHE_TTL', '30')),
+    max_entries=int(os.environ.get('READ_CACHE_SIZE', '2048'))
+)
+
+# Dashboard counters (optionally materialized in db.stats)
+dashboard_stats = DashboardStats(
+    db,
+    ttl=float(os.environ.get('DASHBOARD_STATS_TTL', '5')),
+    materialized=os.environ.get('DASHBOARD_STATS_MATERIALIZED', 'false').lower() in ('1', 'true', 'yes')
+)
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -33,14 +79,99 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # WhatsApp Service URL
-WA_SERVICE_URL = "http://localhost:8002"
+WA_SERVICE_URL = os.environ.get('WA_SERVICE_URL', "http://localhost:8002")
+
+# Shared keep-alive client for the WhatsApp service
+wa_client = WhatsAppClient(
+    WA_SERVICE_URL,
+    status_ttl=float(os.environ.get('WA_STATUS_TTL', '5')),
+    max_per_second=float(os.environ.get('WA_MAX_PER_SECOND', '1')),
+    # One send rate for every process using this database
+    rate_limits=db.rate_limits
+)
 
 # Ensure directories exist
 Path("./invoices").mkdir(exist_ok=True)
 Path("./templates").mkdir(exist_ok=True)
 
+# Invoice HTML, plus PDFs rendered on demand and LRU-evicted past the size cap
+invoice_artifacts = ArtifactStore(
+    "./invoices",
+    max_bytes=int(os.environ.get('INVOICE_PDF_CACHE_MB', '1024')) * 1024 * 1024
+)
+
+# Sequential invoice numbers, e.g. INV-20250115-00042
+invoice_numbers = InvoiceNumbers(
+    db.counters,
+    prefix=os.environ.get('INVOICE_NUMBER_PREFIX', 'INV'),
+    period=os.environ.get('INVOICE_NUMBER_PERIOD', 'day'),
+    width=int(os.environ.get('INVOICE_NUMBER_WIDTH', '5'))
+)
+
+# Results of requests sent with an Idempotency-Key, replayed on retries
+idempotency = IdempotencyStore(
+    db.idempotency_keys,
+    ttl=float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24')) * 3600
+)
+
+# Rows per customer import batch
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '1000'))
+
 # Scheduler
 scheduler = AsyncIOScheduler()
+scheduler_tasks = set()
+
+# PDF renderer worker pool
+pdf_renderer = PdfRenderer(
+    workers=int(os.environ['RENDER_WORKERS']) if os.environ.get('RENDER_WORKERS') else None,
+    queue_size=int(os.environ['RENDER_QUEUE_SIZE']) if os.environ.get('RENDER_QUEUE_SIZE') else None,
+    timeout=float(os.environ.get('RENDER_TIMEOUT', '60'))
+)
+
+# Prometheus metrics, exposed on /metrics
+metrics = Registry()
+STAGE_SECONDS = metrics.histogram(
+    "wifi_billing_stage_seconds", "Time spent in each invoice pipeline stage", ("stage",)
+)
+STAGE_FAILURES = metrics.counter(
+    "wifi_billing_stage_failures_total", "Invoice pipeline stages that raised", ("stage",)
+)
+REQUEST_SECONDS = metrics.histogram(
+    "wifi_billing_http_request_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+PDF_RENDERS = metrics.counter("wifi_billing_pdf_renders_total", "PDF renders by result", ("result",))
+WA_SENDS = metrics.counter("wifi_billing_whatsapp_sends_total", "WhatsApp invoice sends by result", ("result",))
+OUTBOX_RESULTS = metrics.counter("wifi_billing_whatsapp_outbox_total",
+                                 "WhatsApp outbox deliveries by result (sent, retry, dead, skipped)", ("result",))
+IMPORTED_ROWS = metrics.counter("wifi_billing_imported_rows_total", "Customer import rows by result", ("result",))
+metrics.gauge("wifi_billing_renderer_queue_depth", "Renders waiting for a worker",
+              lambda: pdf_renderer.queue_depth)
+metrics.gauge("wifi_billing_renderer_in_flight", "Renders queued or running", lambda: pdf_renderer.in_flight)
+metrics.gauge("wifi_billing_whatsapp_connected", "Last known WhatsApp connection state (1 = connected)",
+              lambda: bool((wa_client.last_status or {}).get('connected')))
+metrics.gauge("wifi_billing_invoice_pdf_cache_bytes", "Bytes of cached invoice PDFs on disk",
+              lambda: invoice_artifacts.disk_usage)
+
+@contextmanager
+def _stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+# Customer documents without internal fields
+CUSTOMER_PROJECTION = {"_id": 0, "search_keys": 0}
+
+# Keyset pagination orders; each is backed by an index in INDEXES
+CUSTOMER_SORT = [("customer_id", ASCENDING)]
+INVOICE_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
+TEMPLATE_SORT = [("created_at", ASCENDING), ("id", ASCENDING)]
+OVERDUE_SORT = [("due_date", ASCENDING), ("id", ASCENDING)]
+OUTBOX_SORT = [("created_at", DESCENDING), ("id", DESCENDING)]
 
 # ============ MODELS ============
 
@@ -84,6 +215,20 @@ class CustomerUpdate(BaseModel):
     status: Optional[str] = None
     notes: Optional[str] = None
 
+class CustomerFilter(BaseModel):
+    status: Optional[str] = None
+    package: Optional[str] = None
+    billing_cycle: Optional[str] = None
+    due_from: Optional[str] = None  # next_due_date range, inclusive
+    due_to: Optional[str] = None
+    q: Optional[str] = None
+
+class CustomerBulkUpdate(BaseModel):
+    ids: Optional[List[str]] = None
+    filter: Optional[CustomerFilter] = None
+    set: CustomerUpdate = Field(default_factory=CustomerUpdate)
+    advance_due_date: bool = False  # move next_due_date on by each customer's billing cycle
+
 class InvoiceTemplate(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -101,10 +246,25 @@ class InvoiceRecord(BaseModel):
     due_date: str
     status: str = "pending"  # pending, sent, paid, overdue
     pdf_path: Optional[str] = ""
+    html_path: Optional[str] = ""
     sent_at: Optional[str] = ""
     paid_at: Optional[str] = ""
+    billing_key: Optional[str] = None  # customer id + due date, set by the scheduler
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+class PaymentRecord(BaseModel):
+    amount: Optional[float] = None  # defaults to the invoice amount
+    paid_at: Optional[str] = None  # YYYY-MM-DD or ISO timestamp, defaults to now
+    method: Optional[str] = None
+    reference: Optional[str] = None
+
+class BulkPayment(PaymentRecord):
+    invoice_id: Optional[str] = None
+    invoice_number: Optional[str] = None
+
+class BulkPaymentRequest(BaseModel):
+    payments: List[BulkPayment]
+
 class SendInvoiceRequest(BaseModel):
     customer_id: str
     template_id: Optional[str] = None
@@ -116,17 +276,77 @@ class BulkSendRequest(BaseModel):
     amount: float
     due_date: str
     template_id: Optional[str] = None
+    concurrency: Optional[int] = None
 
 class SchedulerSettings(BaseModel):
     enabled: bool = False
     days_before_due: int = 2
     reminder_days: List[int] = [1, 3]  # Days after due date
-    cron_time: str = "09:00"  # HH:MM format
+    cron_time: str = Field("09:00", pattern=r"^([01]\d|2[0-3]):[0-5]\d$")  # HH:MM format
+    template_id: Optional[str] = None
+    package_prices: Dict[str, float] = {}  # package name -> invoice amount
+    default_amount: Optional[float] = None  # for packages without a price
 
 class WhatsAppSettings(BaseModel):
     provider: str = "baileys"  # baileys or twilio
     enabled: bool = False
 
+class CustomerPage(BaseModel):
+    items: List[Customer]
+    next_cursor: Optional[str] = None
+
+class TemplatePage(BaseModel):
+    items: List[InvoiceTemplate]
+    next_cursor: Optional[str] = None
+
+# Fields a list endpoint may be asked for with fields=
+CUSTOMER_FIELDS = list(Customer.model_fields)
+INVOICE_FIELDS = [*InvoiceRecord.model_fields, "payment"]
+OVERDUE_FIELDS = ["id", "invoice_number", "customer_id", "amount", "due_date", "status", "sent_at",
+                  "customer_name", "customer_phone", "days_overdue"]
+
+# Exactly the Customer model's fields, as response_model used to filter them
+CUSTOMER_LIST_PROJECTION = {"_id": 0, **{f: 1 for f in CUSTOMER_FIELDS}}
+
+async def _page(collection, query: dict, projection: dict, sort: list,
+                after: Optional[str], limit: int) -> dict:
+    try:
+        return await keyset_page(collection, query, projection, sort, after, limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _fields_projection(fields: Optional[str], allowed, always: list) -> Optional[dict]:
+    # fields=a,b,c -> Mongo projection; the id and sort keys are always included for cursors
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return {"_id": 0, **{f: 1 for f in [*always, *requested]}}
+
+async def _idempotent(scope: str, key: Optional[str], payload, operation, status_code: int = 200):
+    # Without a key the operation just runs; with one, retries replay the first result
+    if not key:
+        return await operation()
+    if len(key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is limited to 255 characters")
+    try:
+        result, replayed = await idempotency.run(scope, key, payload, operation)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return JSONResponse(result, status_code=status_code, headers=headers)
+
+def _cached_response(request: Request, cached) -> Response:
+    # no-cache: browsers keep the body but revalidate with If-None-Match every time
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
 # ============ CUSTOMER ENDPOINTS ============
 
 @api_router.get("/")
@@ -137,108 +357,254 @@ async def root():
 async def create_customer(customer: CustomerCreate):
     customer_obj = Customer(**customer.model_dump())
     doc = customer_obj.model_dump()
-    await db.customers.insert_one(doc)
+    doc["search_keys"] = search_keys(doc)
+    try:
+        await db.customers.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="customer_id already exists")
+    await dashboard_stats.customer_created(doc["status"])
     return customer_obj
 
-@api_router.get("/customers", response_model=List[Customer])
-async def get_customers(q: Optional[str] = None, status: Optional[str] = None):
+@api_router.get("/customers", response_model=CustomerPage)
+async def get_customers(q: Optional[str] = None, status: Optional[str] = None,
+                        fields: Optional[str] = None, after: Optional[str] = None,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
     query = {}
     if q:
-        query["$or"] = [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"customer_id": {"$regex": q, "$options": "i"}},
-            {"phone_whatsapp": {"$regex": q, "$options": "i"}},
-            {"wifi_id": {"$regex": q, "$options": "i"}}
-        ]
+        # Prefix match on the indexed search_keys (name words, ids, phone variants)
+        query.update(search_filter(q))
+    if status:
+        query["status"] = status
+    
+    projection = _fields_projection(fields, CUSTOMER_FIELDS, ["id", "customer_id"]) or CUSTOMER_LIST_PROJECTION
+    # Documents are already in Customer shape; skip response_model re-validation
+    return ORJSONResponse(await _page(db.customers, query, projection, CUSTOMER_SORT, after, limit))
+
+# ============ TABLE EXPORTS ============
+
+# Cursor batch and CSV flush size for CSV/XLSX exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+def _due_range(due_from: Optional[str], due_to: Optional[str]) -> Optional[dict]:
+    bounds = {}
+    for op, value in (("$gte", due_from), ("$lte", due_to)):
+        if value:
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", value):
+                raise HTTPException(status_code=400, detail="due_from/due_to must be YYYY-MM-DD")
+            bounds[op] = value
+    return bounds or None
+
+async def _table_export(columns: list, rows, format: str, filename: str, title: str):
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.{format}"'}
+    if format == "csv":
+        return StreamingResponse(stream_csv(columns, rows, EXPORT_BATCH_SIZE),
+                                 media_type="text/csv; charset=utf-8", headers=headers)
+    try:
+        spool = await write_xlsx(columns, rows, title, EXPORT_BATCH_SIZE)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not build workbook: {e}")
+    return StreamingResponse(stream_file(spool), media_type=XLSX_MEDIA_TYPE, headers=headers)
+
+# Registered before /customers/{customer_id} so "export" isn't taken for an id
+@api_router.get("/customers/export")
+async def export_customers(format: str = "csv", status: Optional[str] = None, package: Optional[str] = None,
+                           due_from: Optional[str] = None, due_to: Optional[str] = None):
+    if format not in ("csv", "xlsx"):
+        raise HTTPException(status_code=400, detail="format must be csv or xlsx")
+    query = {}
     if status:
         query["status"] = status
+    if package:
+        query["package"] = package
+    due_range = _due_range(due_from, due_to)
+    if due_range:
+        query["next_due_date"] = due_range
     
-    customers = await db.customers.find(query, {"_id": 0}).to_list(1000)
-    return customers
+    # Same columns as the import, so an export can be edited and re-imported
+    cursor = db.customers.find(query, {"_id": 0, **{c: 1 for c in CUSTOMER_COLUMNS}}) \
+        .sort(CUSTOMER_SORT).batch_size(EXPORT_BATCH_SIZE)
+    filename = f"customers-{datetime.now().strftime('%Y%m%d')}"
+    return await _table_export(CUSTOMER_COLUMNS, cursor, format, filename, "Customers")
 
 @api_router.get("/customers/{customer_id}", response_model=Customer)
-async def get_customer(customer_id: str):
-    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
-    if not customer:
+async def get_customer(customer_id: str, request: Request):
+    async def load():
+        customer = await db.customers.find_one({"id": customer_id}, CUSTOMER_PROJECTION)
+        return Customer(**customer).model_dump(mode="json") if customer else None
+    
+    cached = await read_cache.get(("customer", customer_id), load)
+    if not cached:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return customer
+    return _cached_response(request, cached)
 
 @api_router.put("/customers/{customer_id}", response_model=Customer)
 async def update_customer(customer_id: str, update_data: CustomerUpdate):
-    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
-    if not customer:
+    update_dict = {k: v for k, v in update_data.model_dump().items() if v is not None}
+    if not update_dict:
+        customer = await db.customers.find_one({"id": customer_id}, CUSTOMER_PROJECTION)
+        if not customer:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        return customer
+    
+    # One round trip: the previous document gives the old status, and the
+    # updated one is the previous document with the $set applied
+    before = await db.customers.find_one_and_update(
+        {"id": customer_id}, {"$set": update_dict},
+        projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+    )
+    if not before:
         raise HTTPException(status_code=404, detail="Customer not found")
+    customer = {**before, **update_dict}
     
-    update_dict = {k: v for k, v in update_data.model_dump().items() if v is not None}
-    if update_dict:
-        await db.customers.update_one({"id": customer_id}, {"$set": update_dict})
+    keys = search_keys(customer)
+    if keys != before.get("search_keys"):
+        # Guarded on the values the keys were built from, in case of a concurrent edit
+        await db.customers.update_one(
+            {"id": customer_id, **{f: customer.get(f) for f in SEARCH_FIELDS}},
+            {"$set": {"search_keys": keys}}
+        )
+    if "status" in update_dict:
+        await dashboard_stats.customer_status_changed(before["status"], update_dict["status"])
+    read_cache.invalidate("customer", customer_id)
+    
+    customer.pop("search_keys", None)
+    return customer
+
+def _bulk_query(request: CustomerBulkUpdate) -> dict:
+    clauses = []
+    if request.ids is not None:
+        clauses.append({"id": {"$in": request.ids}})
+    if request.filter:
+        f = request.filter
+        for field in ("status", "package", "billing_cycle"):
+            if getattr(f, field) is not None:
+                clauses.append({field: getattr(f, field)})
+        due = {}
+        if f.due_from:
+            due["$gte"] = f.due_from
+        if f.due_to:
+            due["$lte"] = f.due_to
+        if due:
+            clauses.append({"next_due_date": due})
+        if f.q:
+            clauses.append(search_filter(f.q))
+    clauses = [c for c in clauses if c]
+    if not clauses:
+        # Never touch every customer by accident
+        raise HTTPException(status_code=400, detail="Provide ids or at least one filter")
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+@api_router.patch("/customers/bulk")
+async def bulk_update_customers(request: CustomerBulkUpdate):
+    update_dict = {k: v for k, v in request.set.model_dump().items() if v is not None}
+    if request.advance_due_date and "next_due_date" in update_dict:
+        raise HTTPException(status_code=400, detail="Use either set.next_due_date or advance_due_date")
+    if not update_dict and not request.advance_due_date:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    query = _bulk_query(request)
+    
+    if request.advance_due_date or any(field in update_dict for field in SEARCH_FIELDS):
+        # Per-customer values (next due date, search keys): one UpdateOne per document
+        projection = {"_id": 0, "id": 1, "start_date": 1, "billing_cycle": 1, "next_due_date": 1,
+                      **{f: 1 for f in SEARCH_FIELDS}}
+        ops = []
+        async for customer in db.customers.find(query, projection):
+            changes = dict(update_dict)
+            guard = {"id": customer["id"]}
+            if request.advance_due_date:
+                try:
+                    changes["next_due_date"] = next_due_date(customer, customer["next_due_date"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                # Only from the date that was read, so a concurrent advance isn't doubled
+                guard["next_due_date"] = customer["next_due_date"]
+            if any(field in update_dict for field in SEARCH_FIELDS):
+                changes["search_keys"] = search_keys({**customer, **changes})
+            ops.append(UpdateOne(guard, {"$set": changes}))
+    else:
+        ops = [UpdateMany(query, {"$set": update_dict})]
+    
+    matched = modified = 0
+    if ops:
+        try:
+            result = await db.customers.bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        matched, modified = result.matched_count, result.modified_count
     
-    updated_customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
-    return updated_customer
+    read_cache.invalidate("customer")
+    if "status" in update_dict and modified:
+        # Previous statuses are mixed; recount instead of $inc
+        await dashboard_stats.rebuild()
+    return {"success": True, "matched": matched, "modified": modified}
 
 @api_router.delete("/customers/{customer_id}")
 async def delete_customer(customer_id: str):
-    result = await db.customers.delete_one({"id": customer_id})
-    if result.deleted_count == 0:
+    customer = await db.customers.find_one_and_delete({"id": customer_id}, {"_id": 0, "status": 1})
+    if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
+    await dashboard_stats.customer_deleted(customer.get("status"))
+    read_cache.invalidate("customer", customer_id)
     return {"success": True, "message": "Customer deleted"}
 
+def _spool_upload(fileobj):
+    copy = tempfile.TemporaryFile()
+    fileobj.seek(0)
+    shutil.copyfileobj(fileobj, copy)
+    copy.seek(0)
+    return copy
+
+def _count_imported(summary: dict):
+    read_cache.invalidate("customer")
+    IMPORTED_ROWS.inc(summary["created"], result="created")
+    IMPORTED_ROWS.inc(summary["updated"], result="updated")
+    IMPORTED_ROWS.inc(len(summary["errors"]), result="error")
+
 @api_router.post("/customers/import")
-async def import_customers(file: UploadFile = File(...)):
+async def import_customers(file: UploadFile = File(...), stream: bool = False):
+    file_format = detect_format(file.filename)
+    if not file_format:
+        raise HTTPException(status_code=400, detail="File must be CSV or Excel")
+    
+    source = file.file
+    if stream:
+        # The upload is closed once this handler returns; the stream reads its own copy
+        source = await asyncio.to_thread(_spool_upload, file.file)
+    
     try:
-        contents = await file.read()
-        
-        # Detect file type and read
-        if file.filename.endswith('.csv'):
-            df = pd.read_csv(io.BytesIO(contents))
-        elif file.filename.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(io.BytesIO(contents))
-        else:
-            raise HTTPException(status_code=400, detail="File must be CSV or Excel")
-        
-        # Expected columns
-        required_cols = ['customer_id', 'name', 'address', 'package', 'start_date', 
-                        'next_due_date', 'phone_whatsapp', 'wifi_id']
-        
-        missing_cols = [col for col in required_cols if col not in df.columns]
-        if missing_cols:
-            raise HTTPException(status_code=400, 
-                              detail=f"Missing columns: {', '.join(missing_cols)}")
-        
-        imported = 0
-        errors = []
-        
-        for idx, row in df.iterrows():
+        events = await import_customers_stream(db.customers, source, file_format, IMPORT_CHUNK_SIZE)
+    except ImportFormatError as e:
+        source.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        source.close()
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if stream:
+        # Newline-delimited JSON: one progress line per chunk, then the summary
+        async def ndjson():
             try:
-                customer_data = {
-                    'customer_id': str(row['customer_id']),
-                    'name': str(row['name']),
-                    'address': str(row['address']),
-                    'package': str(row['package']),
-                    'start_date': str(row['start_date']),
-                    'next_due_date': str(row['next_due_date']),
-                    'phone_whatsapp': str(row['phone_whatsapp']),
-                    'wifi_id': str(row['wifi_id']),
-                    'billing_cycle': str(row.get('billing_cycle', 'monthly')),
-                    'status': str(row.get('status', 'active')),
-                    'notes': str(row.get('notes', ''))
-                }
-                
-                customer_obj = Customer(**customer_data)
-                doc = customer_obj.model_dump()
-                await db.customers.insert_one(doc)
-                imported += 1
+                async for event in events:
+                    if event["event"] == "done":
+                        _count_imported(event)
+                        await dashboard_stats.rebuild()
+                    yield json.dumps(event) + "\n"
             except Exception as e:
-                errors.append(f"Row {idx + 2}: {str(e)}")
-        
-        return {
-            "success": True,
-            "imported": imported,
-            "total_rows": len(df),
-            "errors": errors
-        }
+                yield json.dumps({"event": "error", "success": False, "detail": str(e)}) + "\n"
+            finally:
+                source.close()
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    
+    try:
+        async for event in events:
+            pass
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    _count_imported(event)
+    # Imports upsert with unknown previous statuses; recount instead of $inc
+    await dashboard_stats.rebuild()
+    event.pop("event")
+    return event
 
 # ============ TEMPLATE ENDPOINTS ============
 
@@ -250,295 +616,928 @@ async def create_template(template: InvoiceTemplate):
     
     doc = template.model_dump()
     await db.templates.insert_one(doc)
+    template_cache.invalidate(template.id)
+    # Setting a default changes other templates too
+    read_cache.invalidate("templates")
     return template
 
-@api_router.get("/templates", response_model=List[InvoiceTemplate])
-async def get_templates():
-    templates = await db.templates.find({}, {"_id": 0}).to_list(100)
-    return templates
+@api_router.get("/templates", response_model=TemplatePage)
+async def get_templates(request: Request, after: Optional[str] = None,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    async def load():
+        page = await _page(db.templates, {}, {"_id": 0}, TEMPLATE_SORT, after, limit)
+        return TemplatePage(**page).model_dump(mode="json")
+    
+    return _cached_response(request, await read_cache.get(("templates", "page", after, limit), load))
 
 @api_router.get("/templates/{template_id}", response_model=InvoiceTemplate)
-async def get_template(template_id: str):
-    template = await db.templates.find_one({"id": template_id}, {"_id": 0})
-    if not template:
+async def get_template(template_id: str, request: Request):
+    async def load():
+        template = await db.templates.find_one({"id": template_id}, {"_id": 0})
+        return InvoiceTemplate(**template).model_dump(mode="json") if template else None
+    
+    cached = await read_cache.get(("templates", "id", template_id), load)
+    if not cached:
         raise HTTPException(status_code=404, detail="Template not found")
-    return template
+    return _cached_response(request, cached)
 
 @api_router.delete("/templates/{template_id}")
 async def delete_template(template_id: str):
     result = await db.templates.delete_one({"id": template_id})
+    template_cache.invalidate(template_id)
+    read_cache.invalidate("templates")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Template not found")
     return {"success": True}
 
 # ============ INVOICE GENERATION ============
 
-@api_router.post("/invoices/generate")
-async def generate_invoice(request: SendInvoiceRequest):
-    # Get customer
-    customer = await db.customers.find_one({"id": request.customer_id}, {"_id": 0})
-    if not customer:
-        raise HTTPException(status_code=404, detail="Customer not found")
-    
-    # Get template
-    if request.template_id:
-        template = await db.templates.find_one({"id": request.template_id}, {"_id": 0})
-    else:
-        template = await db.templates.find_one({"is_default": True}, {"_id": 0})
-    
+async def _get_template(template_id: Optional[str] = None) -> CompiledTemplate:
+    with _stage("template_lookup"):
+        template = await template_cache.get(template_id or None)
     if not template:
         raise HTTPException(status_code=404, detail="No template found")
+    return template
+
+async def _build_invoice(customer: dict, template: CompiledTemplate, amount: float, due_date: str,
+                         billing_key: Optional[str] = None, numbers: Optional[NumberBlock] = None) -> dict:
+    # Next number from the atomic counter (or the block a bulk run reserved)
+    with _stage("invoice_number"):
+        invoice_number = await (numbers or invoice_numbers).next()
     
-    # Generate invoice number
-    invoice_number = f"INV-{datetime.now().strftime('%Y%m%d')}-{str(uuid.uuid4())[:8].upper()}"
-    
-    # Replace placeholders in HTML
-    html_content = template['html_content']
-    html_content = html_content.replace('{{name}}', customer['name'])
-    html_content = html_content.replace('{{customer_id}}', customer['customer_id'])
-    html_content = html_content.replace('{{address}}', customer['address'])
-    html_content = html_content.replace('{{package}}', customer['package'])
-    html_content = html_content.replace('{{wifi_id}}', customer['wifi_id'])
-    html_content = html_content.replace('{{amount}}', f"Rp {request.amount:,.0f}")
-    html_content = html_content.replace('{{due_date}}', request.due_date)
-    html_content = html_content.replace('{{invoice_number}}', invoice_number)
-    html_content = html_content.replace('{{date}}', datetime.now().strftime('%d/%m/%Y'))
-    
-    # Save HTML temporarily
-    html_path = f"./invoices/{invoice_number}.html"
-    pdf_path = f"./invoices/{invoice_number}.pdf"
-    
-    async with aiofiles.open(html_path, 'w', encoding='utf-8') as f:
-        await f.write(html_content)
-    
-    # Generate PDF using wkhtmltopdf (simpler alternative to Puppeteer)
-    import subprocess
-    try:
-        # Try wkhtmltopdf first
-        subprocess.run(['wkhtmltopdf', '--enable-local-file-access', 
-                       html_path, pdf_path], check=True, capture_output=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        # Fallback: use weasyprint
-        try:
-            from weasyprint import HTML
-            HTML(string=html_content).write_pdf(pdf_path)
-        except ImportError:
-            raise HTTPException(status_code=500, 
-                              detail="PDF generation tools not available. Install wkhtmltopdf or weasyprint.")
+    # Fill placeholders in one pass; any customer field can be used as {{field}}
+    with _stage("template_render"):
+        html_content = template.render({
+            **customer,
+            'amount': f"Rp {amount:,.0f}",
+            'due_date': due_date,
+            'invoice_number': invoice_number,
+            'date': datetime.now().strftime('%d/%m/%Y')
+        })
+    
+    # Only the HTML is stored now; the PDF is rendered on first download/send
+    with _stage("html_write"):
+        html_path = await invoice_artifacts.write_html(invoice_number, html_content)
+    pdf_path = invoice_artifacts.path(invoice_number, "pdf")
     
     # Save invoice record
     invoice_record = InvoiceRecord(
-        customer_id=request.customer_id,
+        customer_id=customer['id'],
         invoice_number=invoice_number,
-        amount=request.amount,
-        due_date=request.due_date,
+        amount=amount,
+        due_date=due_date,
         pdf_path=pdf_path,
-        status="generated"
+        html_path=html_path,
+        status="generated",
+        billing_key=billing_key
     )
-    await db.invoices.insert_one(invoice_record.model_dump())
+    # Manual invoices have no billing_key at all, so the sparse unique index skips them
+    invoice = invoice_record.model_dump(exclude={"billing_key"} if billing_key is None else None)
+    with _stage("invoice_insert"):
+        await db.invoices.insert_one(invoice)
+    await dashboard_stats.invoice_created(invoice['status'], due_date, amount)
+    await revenue_rollups.invoice_billed(invoice, customer.get('package'))
+    invoice.pop("_id", None)
+    return invoice
+
+@contextmanager
+def _pdf_errors():
+    try:
+        yield
+    except ArtifactNotFound:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    except RendererBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except RenderTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except RenderError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def _render_pdf(html_content: str) -> bytes:
+    try:
+        with _stage("pdf_render"):
+            pdf = await pdf_renderer.render(html_content)
+    except RendererBusy:
+        PDF_RENDERS.inc(result="rejected")
+        raise
+    except RenderTimeout:
+        PDF_RENDERS.inc(result="timeout")
+        raise
+    except Exception:
+        PDF_RENDERS.inc(result="error")
+        raise
+    PDF_RENDERS.inc(result="ok")
+    return pdf
+
+async def _invoice_pdf(invoice_number: str) -> Union[str, bytes]:
+    # Render in the worker pool on first use (wkhtmltopdf, weasyprint fallback).
+    # A path is pinned against eviction until unpinned; bytes mean the disk write failed
+    with _pdf_errors():
+        try:
+            return await invoice_artifacts.ensure_pdf(invoice_number, _render_pdf)
+        except ArtifactNotPersisted as e:
+            return e.pdf
+
+def _unpin_pdf(source: Union[str, bytes]):
+    if isinstance(source, str):
+        invoice_artifacts.unpin(source)
+
+async def _invoice_pdf_bytes(invoice_number: str) -> bytes:
+    # In-memory path for sends: HTML string in, PDF bytes out, disk write afterwards
+    with _pdf_errors():
+        return await invoice_artifacts.pdf_bytes(invoice_number, _render_pdf)
+
+@api_router.post("/invoices/generate")
+async def generate_invoice(request: SendInvoiceRequest, idempotency_key: Optional[str] = Header(None)):
+    async def generate():
+        # Get customer
+        with _stage("customer_lookup"):
+            customer = await db.customers.find_one({"id": request.customer_id}, CUSTOMER_PROJECTION)
+        if not customer:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        
+        # Get template
+        template = await _get_template(request.template_id)
+        
+        invoice = await _build_invoice(customer, template, request.amount, request.due_date)
+        
+        return {
+            "success": True,
+            "invoice_number": invoice['invoice_number'],
+            "pdf_path": invoice['pdf_path'],
+            "invoice_id": invoice['id']
+        }
     
-    return {
-        "success": True,
-        "invoice_number": invoice_number,
-        "pdf_path": pdf_path,
-        "invoice_id": invoice_record.id
-    }
+    return await _idempotent("invoices.generate", idempotency_key, request.model_dump(), generate)
 
 @api_router.get("/invoices/download/{invoice_number}")
 async def download_invoice(invoice_number: str):
-    pdf_path = f"./invoices/{invoice_number}.pdf"
-    if not os.path.exists(pdf_path):
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    return FileResponse(pdf_path, filename=f"{invoice_number}.pdf")
+    pdf = await _invoice_pdf(invoice_number)
+    if isinstance(pdf, bytes):
+        return Response(pdf, media_type="application/pdf",
+                        headers={"Content-Disposition": f'attachment; filename="{invoice_number}.pdf"'})
+    return FileResponse(pdf, filename=f"{invoice_number}.pdf", background=BackgroundTask(_unpin_pdf, pdf))
+
+# ============ INVOICE EXPORT ============
+
+EXPORT_PREFETCH = int(os.environ.get('EXPORT_PREFETCH', '4'))
+EXPORT_MERGE_MAX = int(os.environ.get('EXPORT_MERGE_MAX', '500'))
+
+INVOICE_EXPORT_COLUMNS = ['invoice_number', 'customer_id', 'name', 'package', 'amount', 'due_date', 'status',
+                          'created_at', 'sent_at', 'paid_at', 'paid_amount', 'payment_method', 'payment_reference']
+
+def _export_query(period: Optional[str], status: Optional[str], customer_ids: Optional[str],
+                  due_from: Optional[str] = None, due_to: Optional[str] = None) -> dict:
+    query = {}
+    if period:
+        if not re.fullmatch(r"\d{4}-\d{2}", period):
+            raise HTTPException(status_code=400, detail="period must be YYYY-MM")
+        # Billing period = due date month; ISO strings compare in date order
+        query["due_date"] = {"$gte": f"{period}-01", "$lt": f"{period}-32"}
+    due_range = _due_range(due_from, due_to)
+    if due_range:
+        bounds = query.setdefault("due_date", {})
+        if "$gte" in due_range:
+            bounds["$gte"] = max(bounds.get("$gte", ""), due_range["$gte"])
+        if "$lte" in due_range:
+            bounds["$lte"] = due_range["$lte"]
+    if status:
+        query["status"] = status
+    if customer_ids:
+        query["customer_id"] = {"$in": [c.strip() for c in customer_ids.split(',') if c.strip()]}
+    return query
+
+def _customer_lookup(package: Optional[str] = None) -> list:
+    # Package is matched on the joined customer: a list of the package's customer ids
+    # would grow with the customer base and could pass the 16 MB command limit
+    stages = [{"$lookup": {
+        "from": "customers",
+        "localField": "customer_id",
+        "foreignField": "id",
+        "as": "customer"
+    }}]
+    if package:
+        stages.append({"$match": {"customer.package": package}})
+    return stages
+
+def _invoice_rows(query: dict, package: Optional[str] = None):
+    # One pass: the customer's code, name and package come from the indexed customers.id
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"invoice_number": 1}},
+        *_customer_lookup(package),
+        {"$project": {
+            "_id": 0, "invoice_number": 1, "amount": 1, "due_date": 1, "status": 1,
+            "created_at": 1, "sent_at": 1, "paid_at": 1,
+            "customer_id": {"$arrayElemAt": ["$customer.customer_id", 0]},
+            "name": {"$arrayElemAt": ["$customer.name", 0]},
+            "package": {"$arrayElemAt": ["$customer.package", 0]},
+            "paid_amount": "$payment.amount",
+            "payment_method": "$payment.method",
+            "payment_reference": "$payment.reference"
+        }}
+    ]
+    return db.invoices.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE)
+
+def _export_numbers(query: dict, package: Optional[str]):
+    if not package:
+        return db.invoices.find(query, {"_id": 0, "invoice_number": 1}).sort("invoice_number", 1).batch_size(500)
+    return db.invoices.aggregate([
+        {"$match": query},
+        {"$sort": {"invoice_number": 1}},
+        *_customer_lookup(package),
+        {"$project": {"_id": 0, "invoice_number": 1}}
+    ], allowDiskUse=True, batchSize=500)
+
+async def _export_count(query: dict, package: Optional[str], limit: int) -> int:
+    if not package:
+        return await db.invoices.count_documents(query, limit=limit)
+    counted = await db.invoices.aggregate([
+        {"$match": query}, *_customer_lookup(package), {"$limit": limit}, {"$count": "count"}
+    ]).to_list(1)
+    return counted[0]["count"] if counted else 0
+
+async def _export_entries(query: dict, package: Optional[str], errors: list, hold: bool = False):
+    # Render up to EXPORT_PREFETCH PDFs ahead of the one being streamed.
+    # Each entry is unpinned once the next one is asked for, unless the caller holds them
+    cursor = _export_numbers(query, package)
+    window = deque()
+    current = None
+    
+    async def take():
+        invoice_number, task = window.popleft()
+        try:
+            return f"{invoice_number}.pdf", await task
+        except HTTPException as e:
+            errors.append(f"{invoice_number}: {e.detail}")
+            return None
+    
+    try:
+        async for invoice in cursor:
+            number = invoice['invoice_number']
+            window.append((number, asyncio.ensure_future(_invoice_pdf(number))))
+            if len(window) > EXPORT_PREFETCH:
+                entry = await take()
+                if entry:
+                    current = entry[1]
+                    yield entry
+                    if not hold:
+                        _unpin_pdf(current)
+                    current = None
+        while window:
+            entry = await take()
+            if entry:
+                current = entry[1]
+                yield entry
+                if not hold:
+                    _unpin_pdf(current)
+                current = None
+    finally:
+        if current is not None and not hold:
+            _unpin_pdf(current)
+        for _, task in window:
+            task.cancel()
+            if task.done() and not task.cancelled() and task.exception() is None:
+                _unpin_pdf(task.result())
+
+@api_router.get("/invoices/export")
+async def export_invoices(period: Optional[str] = None, status: Optional[str] = None,
+                          customer_ids: Optional[str] = None, format: str = "zip",
+                          package: Optional[str] = None, due_from: Optional[str] = None,
+                          due_to: Optional[str] = None):
+    query = _export_query(period, status, customer_ids, due_from, due_to)
+    filename = f"invoices-{period or datetime.now().strftime('%Y%m%d')}"
+    errors = []
+    
+    if format in ("csv", "xlsx"):
+        return await _table_export(INVOICE_EXPORT_COLUMNS, _invoice_rows(query, package), format, filename, "Invoices")
+    
+    if format == "zip":
+        async def entries():
+            async for entry in _export_entries(query, package, errors):
+                yield entry
+            if errors:
+                yield "export_errors.txt", "\n".join(errors).encode('utf-8')
+        return StreamingResponse(
+            stream_zip(entries()), media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.zip"'}
+        )
+    
+    if format == "pdf":
+        count = await _export_count(query, package, EXPORT_MERGE_MAX + 1)
+        if count == 0:
+            raise HTTPException(status_code=404, detail="No invoices found")
+        if count > EXPORT_MERGE_MAX:
+            raise HTTPException(status_code=400,
+                                detail=f"Merged PDF is limited to {EXPORT_MERGE_MAX} invoices; use format=zip")
+        sources = []
+        try:
+            async for _, source in _export_entries(query, package, errors, hold=True):
+                sources.append(source)
+            if errors:
+                raise HTTPException(status_code=500, detail=errors)
+            try:
+                merged = await merge_pdfs(sources)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Could not merge invoices: {e}")
+        finally:
+            for source in sources:
+                _unpin_pdf(source)
+        return StreamingResponse(
+            stream_file(merged), media_type="application/pdf",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.pdf"'}
+        )
+    
+    raise HTTPException(status_code=400, detail="format must be zip, pdf, csv or xlsx")
 
 @api_router.get("/invoices")
-async def get_invoices(customer_id: Optional[str] = None, status: Optional[str] = None):
+async def get_invoices(customer_id: Optional[str] = None, status: Optional[str] = None,
+                       fields: Optional[str] = None, after: Optional[str] = None,
+                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
     query = {}
     if customer_id:
         query["customer_id"] = customer_id
     if status:
         query["status"] = status
     
-    invoices = await db.invoices.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return invoices
+    projection = _fields_projection(fields, INVOICE_FIELDS, ["id", "created_at"]) or {"_id": 0}
+    return ORJSONResponse(await _page(db.invoices, query, projection, INVOICE_SORT, after, limit))
+
+# ============ PAYMENTS ============
+
+PAYMENT_COLUMNS = ['invoice_number', 'amount', 'paid_at', 'method', 'reference']
+
+def _parse_amount(value: str) -> Optional[float]:
+    value = re.sub(r"(?i)^rp\.?", "", value or "").replace(" ", "")
+    if not value:
+        return None
+    # Indonesian notation: 1.500.000,50
+    if re.fullmatch(r"\d{1,3}(\.\d{3})+(,\d+)?", value):
+        value = value.replace(".", "").replace(",", ".")
+    return float(value.replace(",", ""))
+
+def _paid_at(value: Optional[str], now: datetime) -> str:
+    if not value:
+        return now.isoformat()
+    # Validates and normalizes both dates and timestamps
+    return datetime.fromisoformat(value.strip().replace("Z", "+00:00")).isoformat()
+
+async def _record_payments(payments: List[BulkPayment]) -> dict:
+    result = {"recorded": 0, "already_paid": [], "not_found": [], "invalid": []}
+    ids = [p.invoice_id for p in payments if p.invoice_id]
+    numbers = [p.invoice_number for p in payments if p.invoice_number and not p.invoice_id]
+    invoices = await db.invoices.find(
+        {"$or": [{"id": {"$in": ids}}, {"invoice_number": {"$in": numbers}}]},
+        {"_id": 0, "id": 1, "invoice_number": 1, "customer_id": 1, "amount": 1, "due_date": 1, "status": 1}
+    ).to_list(None)
+    by_id = {inv['id']: inv for inv in invoices}
+    by_number = {inv['invoice_number']: inv for inv in invoices}
+    
+    # Claims carry a batch id, so the invoices this call actually paid can be read back
+    batch = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    ops, claimed = [], {}
+    for payment in payments:
+        ref = payment.invoice_id or payment.invoice_number
+        invoice = by_id.get(payment.invoice_id) if payment.invoice_id else by_number.get(payment.invoice_number)
+        if not invoice:
+            result["not_found"].append(ref)
+            continue
+        if invoice['status'] == "paid" or invoice['id'] in claimed:
+            result["already_paid"].append(invoice['invoice_number'])
+            continue
+        try:
+            paid_at = _paid_at(payment.paid_at, now)
+        except ValueError:
+            result["invalid"].append({"invoice": ref, "error": f"Invalid paid_at {payment.paid_at!r}"})
+            continue
+        claimed[invoice['id']] = invoice
+        # rollup_applied: false travels with the payment, so the revenue step can always be finished later
+        ops.append(UpdateOne(
+            {"id": invoice['id'], "status": {"$ne": "paid"}},
+            {"$set": {
+                "status": "paid",
+                "paid_at": paid_at,
+                "rollup_applied": False,
+                "payment": {
+                    "amount": payment.amount if payment.amount is not None else invoice['amount'],
+                    "method": payment.method,
+                    "reference": payment.reference,
+                    "batch": batch,
+                    "recorded_at": now.isoformat()
+                }
+            }}
+        ))
+    if not ops:
+        return result
+    
+    await db.invoices.bulk_write(ops, ordered=False)
+    paid = await db.invoices.find(
+        {"id": {"$in": list(claimed)}, "payment.batch": batch},
+        {"_id": 0, "id": 1, "customer_id": 1, "due_date": 1, "paid_at": 1, "payment": 1}
+    ).to_list(None)
+    paid_ids = {inv['id'] for inv in paid}
+    # Paid concurrently by another request between our read and the claim
+    result["already_paid"] += [inv['invoice_number'] for inv_id, inv in claimed.items() if inv_id not in paid_ids]
+    result["recorded"] = len(paid)
+    
+    if paid:
+        customers = await db.customers.find(
+            {"id": {"$in": list({inv['customer_id'] for inv in paid})}}, {"_id": 0, "id": 1, "package": 1}
+        ).to_list(None)
+        packages = {c['id']: c.get('package') for c in customers}
+        for inv in paid:
+            inv['package'] = packages.get(inv['customer_id'])
+        await revenue_rollups.payments_recorded(batch, paid)
+        await dashboard_stats.invoice_statuses_changed(
+            (claimed[inv['id']]['status'], "paid", inv['due_date'], claimed[inv['id']]['amount']) for inv in paid
+        )
+    return result
+
+@api_router.post("/invoices/{invoice_id}/payment")
+async def record_payment(invoice_id: str, payment: PaymentRecord):
+    result = await _record_payments([BulkPayment(invoice_id=invoice_id, **payment.model_dump())])
+    if result["not_found"]:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if result["invalid"]:
+        raise HTTPException(status_code=400, detail=result["invalid"][0]["error"])
+    if result["already_paid"]:
+        raise HTTPException(status_code=409, detail="Invoice already paid")
+    return {"success": True, "invoice_id": invoice_id}
+
+@api_router.post("/payments/bulk")
+async def record_payments_bulk(request: BulkPaymentRequest):
+    return {"success": True, **await _record_payments(request.payments)}
+
+@api_router.post("/payments/import")
+async def import_payments(file: UploadFile = File(...)):
+    # Bank mutation export: invoice_number plus optional amount, paid_at, method, reference
+    file_format = detect_format(file.filename)
+    if not file_format:
+        raise HTTPException(status_code=400, detail="File must be CSV or Excel")
+    
+    reader = READERS[file_format](file.file, IMPORT_CHUNK_SIZE)
+    sentinel = object()
+    summary = {"total_rows": 0, "recorded": 0, "already_paid": [], "not_found": [], "invalid": []}
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, reader, sentinel)
+            if chunk is sentinel:
+                break
+            if 'invoice_number' not in chunk.columns:
+                raise HTTPException(status_code=400, detail="Missing columns: invoice_number")
+            
+            payments = []
+            for row in chunk.reindex(columns=PAYMENT_COLUMNS, fill_value='').itertuples(index=False):
+                summary["total_rows"] += 1
+                number = str(row.invoice_number or '').strip()
+                if not number:
+                    continue
+                try:
+                    amount = _parse_amount(str(row.amount or ''))
+                except ValueError:
+                    summary["invalid"].append({"invoice": number, "error": f"Invalid amount {row.amount!r}"})
+                    continue
+                payments.append(BulkPayment(
+                    invoice_number=number, amount=amount, paid_at=str(row.paid_at or '').strip() or None,
+                    method=str(row.method or '').strip() or None, reference=str(row.reference or '').strip() or None
+                ))
+            
+            result = await _record_payments(payments)
+            summary["recorded"] += result["recorded"]
+            for key in ("already_paid", "not_found", "invalid"):
+                summary[key] += result[key]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not read payment file: {e}")
+    finally:
+        reader.close()
+    
+    return {"success": True, **summary}
+
+# ============ REVENUE REPORTS ============
+
+@api_router.get("/reports/revenue")
+async def get_revenue_report(start: str = Query(..., pattern=r"^\d{4}-\d{2}(-\d{2})?$"),
+                             end: str = Query(..., pattern=r"^\d{4}-\d{2}(-\d{2})?$"),
+                             granularity: str = Query("month", pattern="^(day|month)$")):
+    return await revenue_rollups.report(start, end, granularity)
+
+@api_router.post("/reports/revenue/rebuild")
+async def rebuild_revenue_report():
+    return {"success": True, "buckets": await revenue_rollups.rebuild()}
 
 # ============ WHATSAPP ENDPOINTS ============
 
 @api_router.get("/whatsapp/status")
 async def whatsapp_status():
-    try:
-        response = requests.get(f"{WA_SERVICE_URL}/health", timeout=5)
-        return response.json()
-    except Exception as e:
-        return {"status": "error", "message": str(e), "connected": False}
+    return await wa_client.status()
 
 @api_router.get("/whatsapp/qr")
 async def whatsapp_qr():
     try:
-        response = requests.get(f"{WA_SERVICE_URL}/qr", timeout=5)
-        return response.json()
+        return await wa_client.get_qr()
     except Exception as e:
         raise HTTPException(status_code=503, detail=str(e))
 
 @api_router.post("/whatsapp/reconnect")
 async def whatsapp_reconnect():
     try:
-        response = requests.post(f"{WA_SERVICE_URL}/reconnect", timeout=5)
-        return response.json()
+        return await wa_client.reconnect()
     except Exception as e:
         raise HTTPException(status_code=503, detail=str(e))
 
-@api_router.post("/whatsapp/send-invoice")
-async def send_invoice_whatsapp(invoice_id: str, background_tasks: BackgroundTasks):
-    # Get invoice
-    invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
+async def _deliver_invoice(invoice: dict, customer: dict, caption: Optional[str] = None):
+    caption = caption or f"Halo {customer['name']},\n\nBerikut invoice tagihan WiFi Anda:\n\nNomor Invoice: {invoice['invoice_number']}\nJumlah: Rp {invoice['amount']:,.0f}\nJatuh Tempo: {invoice['due_date']}\n\nTerima kasih!"
+    
+    # Send document
+    content = await _invoice_pdf_bytes(invoice['invoice_number'])
+    try:
+        with _stage("whatsapp_upload"):
+            response = await wa_client.send_document(
+                customer['phone_whatsapp'], caption, f"{invoice['invoice_number']}.pdf", content
+            )
+    except Exception:
+        WA_SENDS.inc(result="error")
+        raise
+    
+    if response.status_code != 200:
+        WA_SENDS.inc(result="failed")
+        # 4xx from the service means the request itself is bad (e.g. phone number); keep it
+        status_code = response.status_code if 400 <= response.status_code < 500 else 502
+        try:
+            detail = response.json()
+        except ValueError:
+            detail = response.text
+        raise HTTPException(status_code=status_code, detail=detail)
+    WA_SENDS.inc(result="sent")
     
-    # Get customer
-    customer = await db.customers.find_one({"id": invoice['customer_id']}, {"_id": 0})
+    # Update invoice status; a payment recorded while the message was uploading wins
+    with _stage("status_update"):
+        previous = await db.invoices.find_one_and_update(
+            {"id": invoice['id'], "status": {"$ne": "paid"}},
+            {"$set": {
+                "status": "sent",
+                "sent_at": datetime.now(timezone.utc).isoformat()
+            }},
+            projection={"_id": 0, "status": 1}, return_document=ReturnDocument.BEFORE
+        )
+    if previous is not None:
+        await dashboard_stats.invoice_status_changed(previous['status'], "sent", invoice['due_date'], invoice['amount'])
+
+async def _deliver_outbox_message(message: dict):
+    with _stage("invoice_lookup"):
+        invoice = await db.invoices.find_one({"id": message['invoice_id']}, {"_id": 0})
+    if not invoice:
+        raise PermanentDeliveryError("Invoice not found")
+    if invoice['status'] == "paid":
+        # Queued sends, retries and reminders alike: nothing to bill any more
+        raise DeliverySkipped("Invoice already paid")
+    with _stage("customer_lookup"):
+        customer = await db.customers.find_one({"id": invoice['customer_id']}, CUSTOMER_PROJECTION)
     if not customer:
-        raise HTTPException(status_code=404, detail="Customer not found")
+        raise PermanentDeliveryError("Customer not found")
+    
+    try:
+        await _deliver_invoice(invoice, customer, caption=message.get('caption'))
+    except HTTPException as e:
+        # Timeouts and rate limits are worth retrying; other client errors are not
+        if 400 <= e.status_code < 500 and e.status_code not in (408, 429):
+            raise PermanentDeliveryError(_error_detail(e))
+        raise
+
+# Persistent send queue drained by rate-limited workers
+whatsapp_outbox = WhatsAppOutbox(
+    db.whatsapp_outbox,
+    deliver=_deliver_outbox_message,
+    is_connected=wa_client.is_connected,
+    workers=int(os.environ.get('OUTBOX_WORKERS', '4')),
+    max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8')),
+    base_delay=float(os.environ.get('OUTBOX_RETRY_DELAY', '30')),
+    max_delay=float(os.environ.get('OUTBOX_RETRY_MAX_DELAY', '3600')),
+    on_result=lambda result: OUTBOX_RESULTS.inc(result=result)
+)
+
+@api_router.post("/whatsapp/send-invoice", status_code=202)
+async def send_invoice_whatsapp(invoice_id: str, idempotency_key: Optional[str] = Header(None)):
+    async def send():
+        with _stage("invoice_lookup"):
+            invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 1})
+        if not invoice:
+            raise HTTPException(status_code=404, detail="Invoice not found")
+        
+        message = await whatsapp_outbox.enqueue(invoice_id)
+        return {"success": True, "message": "Invoice queued for sending", "outbox_id": message['id'],
+                "status": message['status']}
+    
+    return await _idempotent("whatsapp.send-invoice", idempotency_key, {"invoice_id": invoice_id}, send,
+                             status_code=202)
+
+@api_router.get("/whatsapp/outbox")
+async def get_whatsapp_outbox(status: Optional[str] = None, invoice_id: Optional[str] = None,
+                              after: Optional[str] = None,
+                              limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    query = {}
+    if status:
+        query["status"] = status
+    if invoice_id:
+        query["invoice_id"] = invoice_id
+    return await _page(db.whatsapp_outbox, query, {"_id": 0}, OUTBOX_SORT, after, limit)
+
+@api_router.get("/whatsapp/outbox/{message_id}")
+async def get_whatsapp_outbox_message(message_id: str):
+    message = await db.whatsapp_outbox.find_one({"id": message_id}, {"_id": 0})
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message
+
+@api_router.post("/whatsapp/outbox/{message_id}/retry")
+async def retry_whatsapp_outbox_message(message_id: str):
+    message = await whatsapp_outbox.retry(message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="Dead-lettered message not found")
+    return message
+
+# ============ BULK SEND JOBS ============
+
+BULK_SEND_CONCURRENCY = int(os.environ.get('BULK_SEND_CONCURRENCY', '4'))
+
+# Live jobs of this process; jobs are persisted to db.bulk_jobs once everything is queued
+bulk_jobs = {}
+
+def _error_detail(e: Exception) -> str:
+    if isinstance(e, HTTPException):
+        return e.detail if isinstance(e.detail, str) else json.dumps(e.detail)
+    return str(e)
+
+async def _job_progress(job: dict) -> dict:
+    # Delivery happens in the outbox; read each queued message's current state
+    outbox_ids = [r['outbox_id'] for r in job['results'] if r.get('outbox_id')]
+    messages = {}
+    if outbox_ids:
+        async for message in db.whatsapp_outbox.find(
+            {"id": {"$in": outbox_ids}}, {"_id": 0, "id": 1, "status": 1, "last_error": 1, "updated_at": 1}
+        ):
+            messages[message['id']] = message
     
-    # Check WhatsApp status
-    wa_status = await whatsapp_status()
-    if not wa_status.get('connected'):
-        raise HTTPException(status_code=503, detail="WhatsApp not connected")
+    results, succeeded, failed, skipped, pending, last_update = [], 0, 0, 0, 0, None
+    for result in job['results']:
+        message = messages.get(result.get('outbox_id'))
+        if message:
+            result = {**result, "status": message['status']}
+            if message['status'] == "sent":
+                result["success"] = True
+            elif message['status'] == "dead":
+                result.update(status="failed", success=False, error=message.get('last_error'))
+            elif message['status'] == "skipped":
+                result.update(success=False, error=message.get('last_error'))
+            if message['status'] in ("sent", "dead", "skipped"):
+                last_update = max(last_update or "", message['updated_at'])
+        if result['status'] == "sent":
+            succeeded += 1
+        elif result['status'] == "failed":
+            failed += 1
+        elif result['status'] == "skipped":
+            skipped += 1
+        else:
+            pending += 1
+        results.append(result)
     
-    # Send via WhatsApp
+    status, finished_at = job['status'], job.get('finished_at')
+    if status == "sending" and not pending:
+        status, finished_at = "completed", max(last_update or "", job['queued_at'])
+    started = datetime.fromisoformat(job['started_at'])
+    ended = datetime.fromisoformat(finished_at) if finished_at else datetime.now(timezone.utc)
+    elapsed = max((ended - started).total_seconds(), 0.0)
+    processed = succeeded + failed + skipped
+    return {
+        **{k: v for k, v in job.items() if k != 'task'},
+        "status": status,
+        "finished_at": finished_at,
+        "results": results,
+        "succeeded": succeeded,
+        "failed": failed,
+        "skipped": skipped,
+        "processed": processed,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_minute": round(processed / elapsed * 60, 2) if elapsed else 0.0
+    }
+
+async def _run_bulk_send(job: dict, request: BulkSendRequest, concurrency: int):
+    # Builds the invoices and queues them; the outbox workers do the sending
     try:
-        caption = f"Halo {customer['name']},\n\nBerikut invoice tagihan WiFi Anda:\n\nNomor Invoice: {invoice['invoice_number']}\nJumlah: Rp {invoice['amount']:,.0f}\nJatuh Tempo: {invoice['due_date']}\n\nTerima kasih!"
+        template = await _get_template(request.template_id)
         
-        # Send document
-        with open(invoice['pdf_path'], 'rb') as f:
-            files = {'file': (f"{invoice['invoice_number']}.pdf", f, 'application/pdf')}
-            data = {
-                'phone': customer['phone_whatsapp'],
-                'caption': caption
-            }
-            response = requests.post(f"{WA_SERVICE_URL}/send-document", 
-                                   files=files, data=data, timeout=30)
+        customers = await db.customers.find(
+            {"id": {"$in": request.customer_ids}}, CUSTOMER_PROJECTION
+        ).to_list(None)
+        customers_by_id = {c['id']: c for c in customers}
+        numbers = await invoice_numbers.reserve(sum(1 for cid in request.customer_ids if cid in customers_by_id))
         
-        if response.status_code == 200:
-            # Update invoice status
-            await db.invoices.update_one(
-                {"id": invoice_id},
-                {"$set": {
-                    "status": "sent",
-                    "sent_at": datetime.now(timezone.utc).isoformat()
-                }}
-            )
-            return {"success": True, "message": "Invoice sent successfully"}
-        else:
-            raise HTTPException(status_code=500, detail=response.json())
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def process(index: int, customer_id: str):
+            result = job['results'][index]
+            async with semaphore:
+                try:
+                    customer = customers_by_id.get(customer_id)
+                    if not customer:
+                        raise HTTPException(status_code=404, detail="Customer not found")
+                    
+                    invoice = await _build_invoice(customer, template, request.amount, request.due_date,
+                                                   numbers=numbers)
+                    result["invoice_number"] = invoice['invoice_number']
+                    
+                    message = await whatsapp_outbox.enqueue(invoice['id'])
+                    result["outbox_id"] = message['id']
+                    result["status"] = message['status']
+                except Exception as e:
+                    result["status"] = "failed"
+                    result["success"] = False
+                    result["error"] = _error_detail(e)
+        
+        try:
+            await asyncio.gather(*(process(i, cid) for i, cid in enumerate(request.customer_ids)))
+        finally:
+            # Numbers reserved for invoices that failed go back to the counter
+            await numbers.release()
+        job['status'] = "sending"
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.exception("Bulk send job %s failed", job['id'])
+        job['status'] = "failed"
+        job['error'] = _error_detail(e)
+        job['finished_at'] = datetime.now(timezone.utc).isoformat()
+    finally:
+        job['queued_at'] = datetime.now(timezone.utc).isoformat()
+        await db.bulk_jobs.replace_one(
+            {"id": job['id']}, {k: v for k, v in job.items() if k != 'task'}, upsert=True
+        )
+        bulk_jobs.pop(job['id'], None)
 
-@api_router.post("/whatsapp/bulk-send")
+@api_router.post("/whatsapp/bulk-send", status_code=202)
 async def bulk_send_invoices(request: BulkSendRequest):
-    results = []
-    for customer_id in request.customer_ids:
-        try:
-            # Generate invoice
-            invoice_req = SendInvoiceRequest(
-                customer_id=customer_id,
-                amount=request.amount,
-                due_date=request.due_date,
-                template_id=request.template_id
-            )
-            invoice_result = await generate_invoice(invoice_req)
-            
-            # Send via WhatsApp
-            send_result = await send_invoice_whatsapp(invoice_result['invoice_id'], BackgroundTasks())
-            results.append({
-                "customer_id": customer_id,
-                "success": True,
-                "invoice_number": invoice_result['invoice_number']
-            })
-        except Exception as e:
-            results.append({
-                "customer_id": customer_id,
-                "success": False,
-                "error": str(e)
-            })
-    
-    return {"results": results}
+    concurrency = request.concurrency or BULK_SEND_CONCURRENCY
+    if concurrency < 1:
+        raise HTTPException(status_code=400, detail="concurrency must be at least 1")
+    
+    job = {
+        "id": str(uuid.uuid4()),
+        "status": "running",
+        "total": len(request.customer_ids),
+        "concurrency": concurrency,
+        "results": [
+            {"customer_id": customer_id, "status": "pending"}
+            for customer_id in request.customer_ids
+        ],
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "queued_at": None,
+        "finished_at": None
+    }
+    bulk_jobs[job['id']] = job
+    job['task'] = asyncio.create_task(_run_bulk_send(job, request, concurrency))
+    
+    return {"job_id": job['id'], "status": job['status'], "total": job['total']}
+
+@api_router.get("/whatsapp/bulk-send/{job_id}")
+async def get_bulk_send_job(job_id: str):
+    job = bulk_jobs.get(job_id)
+    if not job:
+        job = await db.bulk_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return await _job_progress(job)
 
 # ============ DASHBOARD STATS ============
 
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats():
-    # Total customers
-    total_customers = await db.customers.count_documents({})
-    active_customers = await db.customers.count_documents({"status": "active"})
-    
-    # Invoices
-    total_invoices = await db.invoices.count_documents({})
-    pending_invoices = await db.invoices.count_documents({"status": "pending"})
-    sent_invoices = await db.invoices.count_documents({"status": "sent"})
-    paid_invoices = await db.invoices.count_documents({"status": "paid"})
-    
-    # Overdue (compare with today)
+    return await dashboard_stats.get()
+
+async def _live_stats(fresh: bool = False) -> dict:
+    if fresh:
+        dashboard_stats.invalidate()
+    return await dashboard_stats.get()
+
+# One shared change stream for every open dashboard
+live_updates = LiveUpdates(
+    db, _live_stats,
+    coalesce=float(os.environ.get('LIVE_UPDATES_COALESCE', '1')),
+    poll_interval=float(os.environ.get('LIVE_UPDATES_POLL_INTERVAL', '5'))
+)
+
+@api_router.get("/events")
+async def live_events():
+    # Server-Sent Events: "stats" (counters + delta), "invoices" (status changes), "resync"
+    return StreamingResponse(
+        live_updates.stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.post("/dashboard/stats/rebuild")
+async def rebuild_dashboard_stats():
+    await dashboard_stats.rebuild()
+    return await dashboard_stats.get()
+
+@api_router.get("/dashboard/overdue")
+async def get_overdue_customers(fields: Optional[str] = None, after: Optional[str] = None,
+                                limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
     today = datetime.now().strftime('%Y-%m-%d')
-    overdue_invoices = await db.invoices.count_documents({
+    requested = _fields_projection(fields, OVERDUE_FIELDS, ["id", "due_date"])
+    
+    # Most overdue first; served by the (status, due_date) index
+    match = {
         "status": {"$in": ["pending", "sent"]},
         "due_date": {"$lt": today}
-    })
+    }
+    if after:
+        try:
+            match = {"$and": [match, keyset_filter(OVERDUE_SORT, decode_cursor(after, len(OVERDUE_SORT)))]}
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    # Revenue
+    project = {
+        "_id": 0,
+        "id": 1,
+        "invoice_number": 1,
+        "customer_id": 1,
+        "amount": 1,
+        "due_date": 1,
+        "status": 1,
+        "sent_at": 1,
+        "customer_name": "$customer.name",
+        "customer_phone": "$customer.phone_whatsapp"
+    }
+    if requested:
+        # customer_name is always fetched: it tells whether the customer still exists
+        project = {k: v for k, v in project.items() if k in requested or k == "customer_name"}
+    
+    # Join customer name/phone server-side instead of one find_one per invoice
     pipeline = [
-        {"$match": {"status": "paid"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+        {"$match": match},
+        {"$sort": dict(OVERDUE_SORT)},
+        {"$limit": limit + 1},
+        {"$lookup": {
+            "from": "customers",
+            "localField": "customer_id",
+            "foreignField": "id",
+            "as": "customer"
+        }},
+        {"$unwind": {"path": "$customer", "preserveNullAndEmptyArrays": True}},
+        {"$project": project}
     ]
-    revenue_result = await db.invoices.aggregate(pipeline).to_list(1)
-    total_revenue = revenue_result[0]['total'] if revenue_result else 0
-    
-    return {
-        "customers": {
-            "total": total_customers,
-            "active": active_customers
-        },
-        "invoices": {
-            "total": total_invoices,
-            "pending": pending_invoices,
-            "sent": sent_invoices,
-            "paid": paid_invoices,
-            "overdue": overdue_invoices
-        },
-        "revenue": total_revenue
-    }
-
-@api_router.get("/dashboard/overdue")
-async def get_overdue_customers():
-    today = datetime.now().strftime('%Y-%m-%d')
+    invoices = await db.invoices.aggregate(pipeline).to_list(limit + 1)
     
-    # Get overdue invoices with customer info
-    invoices = await db.invoices.find({
-        "status": {"$in": ["pending", "sent"]},
-        "due_date": {"$lt": today}
-    }, {"_id": 0}).to_list(1000)
+    next_cursor = None
+    if len(invoices) > limit:
+        invoices = invoices[:limit]
+        next_cursor = encode_cursor([invoices[-1].get(field) for field, _ in OVERDUE_SORT])
     
-    # Enrich with customer data
+    today_date = datetime.strptime(today, '%Y-%m-%d').date()
+    with_days = not requested or "days_overdue" in requested
+    keep_name = not requested or "customer_name" in requested
     result = []
     for invoice in invoices:
-        customer = await db.customers.find_one({"id": invoice['customer_id']}, {"_id": 0})
-        if customer:
-            result.append({
-                **invoice,
-                "customer_name": customer['name'],
-                "customer_phone": customer['phone_whatsapp']
-            })
+        # Invoices whose customer was deleted are skipped, as before
+        if invoice.get("customer_name") is None:
+            continue
+        if with_days:
+            try:
+                invoice["days_overdue"] = (today_date - datetime.strptime(invoice["due_date"], '%Y-%m-%d').date()).days
+            except (TypeError, ValueError):
+                invoice["days_overdue"] = None
+        if not keep_name:
+            del invoice["customer_name"]
+        result.append(invoice)
     
-    return result
+    return ORJSONResponse({"items": result, "next_cursor": next_cursor})
 
 # ============ SCHEDULER SETTINGS ============
 
-@api_router.get("/scheduler/settings")
-async def get_scheduler_settings():
+async def _load_scheduler_settings() -> SchedulerSettings:
     settings = await db.settings.find_one({"type": "scheduler"}, {"_id": 0})
-    if not settings:
-        return SchedulerSettings().model_dump()
-    return settings
+    return SchedulerSettings(**settings) if settings else SchedulerSettings()
+
+billing_scheduler = BillingScheduler(
+    db, scheduler,
+    load_settings=_load_scheduler_settings,
+    get_template=_get_template,
+    build_invoice=_build_invoice,
+    enqueue=whatsapp_outbox.enqueue,
+    reserve_invoice_numbers=invoice_numbers.reserve,
+    customers_changed=lambda: read_cache.invalidate("customer"),
+    batch_size=int(os.environ.get('SCHEDULER_BATCH_SIZE', '100')),
+    concurrency=int(os.environ.get('SCHEDULER_CONCURRENCY', str(BULK_SEND_CONCURRENCY))),
+    batch_pause=float(os.environ.get('SCHEDULER_BATCH_PAUSE', '1'))
+)
+
+@api_router.get("/scheduler/settings")
+async def get_scheduler_settings(request: Request):
+    async def load():
+        settings = await db.settings.find_one({"type": "scheduler"}, {"_id": 0})
+        return settings or SchedulerSettings().model_dump()
+    
+    return _cached_response(request, await read_cache.get(("scheduler_settings",), load))
 
 @api_router.post("/scheduler/settings")
 async def update_scheduler_settings(settings: SchedulerSettings):
@@ -547,14 +1546,111 @@ async def update_scheduler_settings(settings: SchedulerSettings):
         {"$set": settings.model_dump()},
         upsert=True
     )
+    read_cache.invalidate("scheduler_settings")
     
-    # Restart scheduler if enabled
-    if settings.enabled:
-        # TODO: Implement actual scheduler logic
-        pass
+    # Reschedule (or remove) the daily billing run
+    billing_scheduler.apply_settings(settings)
     
     return {"success": True}
 
+@api_router.post("/scheduler/run", status_code=202)
+async def run_scheduler_now():
+    task = asyncio.create_task(billing_scheduler.run())
+    scheduler_tasks.add(task)
+    task.add_done_callback(scheduler_tasks.discard)
+    return {"success": True, "message": "Billing run started"}
+
+@api_router.get("/scheduler/runs")
+async def get_scheduler_runs(limit: int = Query(20, ge=1, le=100)):
+    return await db.scheduler_runs.find({}, {"_id": 0}).sort("started_at", -1).to_list(limit)
+
+# ============ INDEXES ============
+
+INDEXES = {
+    "customers": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("customer_id", ASCENDING)], unique=True),
+        IndexModel([("search_keys", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("customer_id", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("next_due_date", ASCENDING)]),
+    ],
+    "invoices": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("invoice_number", ASCENDING)], unique=True),
+        IndexModel([("billing_key", ASCENDING)], unique=True, sparse=True),
+        IndexModel([("status", ASCENDING), ("due_date", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Only the few payments whose revenue step is unfinished
+        IndexModel([("rollup_applied", ASCENDING), ("payment.batch", ASCENDING)],
+                   partialFilterExpression={"rollup_applied": False}),
+    ],
+    "revenue_rollups": REVENUE_INDEXES,
+    "templates": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("is_default", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "settings": [
+        IndexModel([("type", ASCENDING)], unique=True),
+    ],
+    "whatsapp_outbox": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("active_key", ASCENDING)], unique=True, sparse=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("invoice_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "idempotency_keys": [
+        # TTL: MongoDB deletes each document once its expires_at has passed
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "bulk_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "scheduler_runs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("started_at", DESCENDING)]),
+    ],
+}
+
+async def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except PyMongoError as e:
+            # e.g. existing duplicate customer_id values block a unique index
+            logger.error("Could not create indexes on %s: %s", collection, e)
+
+async def backfill_search_keys(batch_size: int = 1000):
+    cursor = db.customers.find({"search_keys": {"$exists": False}}, {"_id": 1, **{f: 1 for f in SEARCH_FIELDS}})
+    ops = []
+    updated = 0
+    async for customer in cursor:
+        ops.append(UpdateOne({"_id": customer["_id"]}, {"$set": {"search_keys": search_keys(customer)}}))
+        if len(ops) == batch_size:
+            await db.customers.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await db.customers.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    if updated:
+        logger.info("Backfilled search keys for %d customers", updated)
+
+# ============ METRICS ============
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+@api_router.get("/system/startup")
+async def get_startup_profile():
+    return startup_profile.report()
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -564,8 +1660,12 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Idempotent-Replayed"],
 )
 
+# Per-route latency; outermost so CORS and error handling are included
+app.add_middleware(RequestTimer, histogram=REQUEST_SECONDS)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -573,15 +1673,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("WiFi Billing System started")
-    # Create default template if not exists
-    template_count = await db.templates.count_documents({})
-    if template_count == 0:
-        default_template = InvoiceTemplate(
-            name="Template Default",
-            html_content="""
+async def _ensure_default_template():
+    if await db.templates.find_one({}, {"_id": 1}):
+        return
+    default_template = InvoiceTemplate(
+        name="Template Default",
+        html_content="""
 <!DOCTYPE html>
 <html>
 <head>
@@ -653,11 +1750,71 @@ async def startup_event():
 </body>
 </html>
             """,
-            is_default=True
-        )
-        await db.templates.insert_one(default_template.model_dump())
-        logger.info("Default template created")
+        is_default=True
+    )
+    await db.templates.insert_one(default_template.model_dump())
+    read_cache.invalidate("templates")
+    logger.info("Default template created")
+
+async def _start_scheduler():
+    scheduler.start()
+    billing_scheduler.apply_settings(await _load_scheduler_settings())
+    # Finishes payment batches whose revenue step was interrupted
+    scheduler.add_job(revenue_rollups.apply_pending, "interval", hours=1, id="revenue-pending",
+                      replace_existing=True, max_instances=1, coalesce=True)
+
+async def _scan_pdf_cache():
+    await asyncio.to_thread(invoice_artifacts.scan)
+
+async def _warm_up():
+    # Runs after the app accepts requests; anything here also works cold, just slower
+    steps = [("default_template", _ensure_default_template), ("scheduler", _start_scheduler)]
+    if dashboard_stats.materialized:
+        steps.append(("dashboard_stats", dashboard_stats.rebuild))
+    steps += [
+        ("pdf_renderer", pdf_renderer.start),
+        ("pdf_cache_scan", _scan_pdf_cache),
+        ("revenue_pending", revenue_rollups.apply_pending),
+        ("search_keys_backfill", backfill_search_keys),
+    ]
+    for name, step in steps:
+        try:
+            with startup_profile.step("warmup", name):
+                await step()
+        except Exception:
+            logger.exception("Warmup step %s failed", name)
+    startup_profile.warm()
+    logger.info("Startup profile: %s", startup_profile.summary())
+
+warmup_tasks = set()
+
+@app.on_event("startup")
+async def startup_event():
+    # Only what requests can't do without; the rest is warmed up in the background
+    with startup_profile.step("startup", "indexes"):
+        await ensure_indexes()
+    with startup_profile.step("startup", "whatsapp_client"):
+        await wa_client.start()
+    # Picks up messages left queued (or mid-send) by the previous process
+    whatsapp_outbox.start()
+    startup_profile.ready()
+    logger.info("WiFi Billing System started in %.2fs", startup_profile.ready_after)
+    task = asyncio.create_task(_warm_up())
+    warmup_tasks.add(task)
+    task.add_done_callback(warmup_tasks.discard)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in list(warmup_tasks):
+        task.cancel()
+    # Started by warmup, which may not have got that far
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await live_updates.close()
+    await whatsapp_outbox.stop()
+    await invoice_artifacts.drain()
+    await pdf_renderer.shutdown()
+    await wa_client.close()
     client.close()
+
+startup_profile.record("init", "module", time.perf_counter() - _module_init_started)
@@ -0,0 +1,81 @@
+"""Startup timing.
+
+Records where a cold start goes: importing the app's modules, building the
+module-level objects, each ``startup_event`` step (before the first request
+is served) and each background warmup step (after). Heavy optional modules
+are loaded through ``lazy_import`` so their first-use cost shows up too.
+
+The report is served on ``/api/system/startup`` and logged once warmup ends.
+For a per-module import breakdown, use ``python -m benchmarks.cold_start``.
+"""
+import importlib
+import sys
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class StartupProfile:
+    def __init__(self, started: Optional[float] = None):
+        self.started = time.perf_counter() if started is None else started
+        self.steps = []  # (phase, name, seconds, error)
+        self.ready_after = None
+        self.warm_after = None
+
+    def record(self, phase: str, name: str, seconds: float, error: Optional[str] = None):
+        self.steps.append((phase, name, seconds, error))
+
+    @contextmanager
+    def step(self, phase: str, name: str):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.record(phase, name, time.perf_counter() - start, error)
+
+    def since_start(self) -> float:
+        return time.perf_counter() - self.started
+
+    def ready(self):
+        self.ready_after = self.since_start()
+
+    def warm(self):
+        self.warm_after = self.since_start()
+
+    def report(self) -> dict:
+        phases = {}
+        for phase, name, seconds, error in self.steps:
+            entry = phases.setdefault(phase, {"seconds": 0.0, "steps": []})
+            entry["seconds"] = round(entry["seconds"] + seconds, 4)
+            step = {"name": name, "seconds": round(seconds, 4)}
+            if error:
+                step["error"] = error
+            entry["steps"].append(step)
+        return {
+            "ready_after_seconds": None if self.ready_after is None else round(self.ready_after, 4),
+            "warm_after_seconds": None if self.warm_after is None else round(self.warm_after, 4),
+            "phases": phases
+        }
+
+    def summary(self) -> str:
+        report = self.report()
+        parts = [f"{phase} {entry['seconds']:.3f}s" for phase, entry in report["phases"].items()]
+        return (f"ready after {report['ready_after_seconds']}s, warm after {report['warm_after_seconds']}s "
+                f"({', '.join(parts)})")
+
+
+# Shared by the app and the modules it loads lazily
+profile = StartupProfile()
+
+
+def lazy_import(name: str):
+    """Import ``name`` on first use, recording the cost under the "lazy" phase."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with profile.step("lazy", name):
+        return importlib.import_module(name)
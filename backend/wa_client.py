@@ -0,0 +1,178 @@
+"""Shared keep-alive client for the Baileys WhatsApp service.
+
+All calls to WA_SERVICE_URL go through one pooled httpx.AsyncClient. The
+service's /health result is cached for a short TTL and refreshed in the
+background, so sends don't pay for a health round trip each time.
+
+Document sends are paced to ``max_per_second`` across every caller (single
+sends, the outbox workers, bulk jobs and the scheduler), so bursts don't get
+the number flagged by WhatsApp. Given a ``rate_limits`` collection, the send
+slots are booked in MongoDB, so the limit holds for all API processes and
+replicas together rather than for each one.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import httpx
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces calls at least ``1 / rate`` seconds apart; 0 disables it."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        # Book the next free slot before sleeping, so concurrent callers queue up
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class SharedRateLimiter(RateLimiter):
+    """``RateLimiter`` whose next free slot lives in a MongoDB document.
+
+    Slots are booked with a compare-and-set on ``next_at`` (epoch seconds), so
+    concurrent processes queue up behind each other instead of each getting
+    the full rate. Hosts are assumed to keep their clocks in sync (NTP).
+    """
+
+    def __init__(self, collection, rate: float, key: str = "whatsapp_send"):
+        super().__init__(rate)
+        self.collection = collection
+        self.key = key
+
+    async def _book(self) -> float:
+        while True:
+            now = time.time()
+            state = await self.collection.find_one({"_id": self.key})
+            if state is None:
+                try:
+                    await self.collection.insert_one({"_id": self.key, "next_at": now + self.interval})
+                except DuplicateKeyError:
+                    continue
+                return now
+            slot = max(now, state["next_at"])
+            booked = await self.collection.update_one(
+                {"_id": self.key, "next_at": state["next_at"]}, {"$set": {"next_at": slot + self.interval}}
+            )
+            if booked.modified_count:
+                return slot
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        slot = await self._book()
+        wait = slot - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class WhatsAppClient:
+    def __init__(self, base_url: str, status_ttl: float = 5.0, timeout: float = 5.0,
+                 send_timeout: float = 30.0, max_connections: int = 20, max_per_second: float = 0.0,
+                 rate_limits=None):
+        self.base_url = base_url
+        self.status_ttl = status_ttl
+        self.timeout = timeout
+        self.send_timeout = send_timeout
+        self.max_connections = max_connections
+        self.send_limiter = (SharedRateLimiter(rate_limits, max_per_second) if rate_limits is not None
+                             else RateLimiter(max_per_second))
+        self._client = None
+        self._status = None
+        self._status_at = 0.0
+        self._status_lock = None
+        self._refresh_task = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections)
+            )
+        return self._client
+
+    async def start(self):
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _refresh_loop(self):
+        while True:
+            await self.refresh_status()
+            await asyncio.sleep(self.status_ttl)
+
+    async def refresh_status(self) -> dict:
+        try:
+            response = await self.client.get("/health")
+            status = response.json()
+        except Exception as e:
+            status = {"status": "error", "message": str(e), "connected": False}
+        self._status = status
+        self._status_at = time.monotonic()
+        return status
+
+    def invalidate_status(self):
+        self._status_at = 0.0
+
+    async def status(self, max_age: Optional[float] = None) -> dict:
+        max_age = self.status_ttl if max_age is None else max_age
+        if self._status is not None and time.monotonic() - self._status_at <= max_age:
+            return self._status
+
+        if self._status_lock is None:
+            self._status_lock = asyncio.Lock()
+        async with self._status_lock:
+            # Another caller may have refreshed while we waited
+            if self._status is not None and time.monotonic() - self._status_at <= max_age:
+                return self._status
+            return await self.refresh_status()
+
+    @property
+    def last_status(self) -> Optional[dict]:
+        # Last known /health result without a round trip; None before the first check
+        return self._status
+
+    async def is_connected(self) -> bool:
+        return bool((await self.status()).get('connected'))
+
+    async def get_qr(self) -> dict:
+        response = await self.client.get("/qr")
+        return response.json()
+
+    async def reconnect(self) -> dict:
+        response = await self.client.post("/reconnect")
+        self.invalidate_status()
+        return response.json()
+
+    async def send_document(self, phone: str, caption: str, filename: str, content: bytes) -> httpx.Response:
+        files = {'file': (filename, content, 'application/pdf')}
+        data = {'phone': phone, 'caption': caption}
+        await self.send_limiter.acquire()
+        response = await self.client.post("/send-document", files=files, data=data,
+                                          timeout=self.send_timeout)
+        if response.status_code >= 500:
+            # The service may have lost its session; re-check before the next send
+            self.invalidate_status()
+        return response
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture(scope="session")
+def server_module(tmp_path_factory):
+    # Same in-process database as benchmarks/cold_start.py
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "wifi_billing_test")
+    import motor.motor_asyncio
+    from mongomock_motor import AsyncMongoMockClient
+    motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    # Invoice files use paths relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    try:
+        import server
+        yield server
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def server(server_module):
+    asyncio.run(server_module.client.drop_database(server_module.db.name))
+    # In-memory state that would otherwise outlive the dropped database
+    server_module.template_cache.invalidate()
+    server_module.dashboard_stats.invalidate()
+    return server_module
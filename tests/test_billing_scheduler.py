@@ -0,0 +1,160 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from billing_scheduler import BillingScheduler, current_cycle
+
+TODAY = date(2024, 6, 12)
+
+
+def customer(number, next_due_date="2024-06-13", package="10 Mbps"):
+    return {"id": f"cust-{number}", "customer_id": f"C{number:03d}", "name": f"Customer {number}",
+            "address": "Jl. Mawar 1", "package": package, "start_date": "2024-01-13", "billing_cycle": "monthly",
+            "next_due_date": next_due_date, "phone_whatsapp": "628123", "wifi_id": f"WIFI-{number}",
+            "status": "active"}
+
+
+@pytest.fixture
+def billing(server):
+    settings = server.SchedulerSettings(days_before_due=2, reminder_days=[1, 3],
+                                        package_prices={"10 Mbps": 150000.0})
+
+    def make(scheduler_class=BillingScheduler):
+        async def load_settings():
+            return settings
+
+        return scheduler_class(
+            server.db, None,
+            load_settings=load_settings,
+            get_template=server._get_template,
+            build_invoice=server._build_invoice,
+            enqueue=server.whatsapp_outbox.enqueue,
+            reserve_invoice_numbers=server.invoice_numbers.reserve,
+            batch_size=2, batch_pause=0
+        )
+
+    async def setup(*customers):
+        await server.ensure_indexes()
+        await server._ensure_default_template()
+        if customers:
+            await server.db.customers.insert_many([dict(c) for c in customers])
+
+    return server, make, setup
+
+
+def test_current_cycle_skips_to_the_latest_due_date():
+    assert current_cycle(customer(1, "2024-06-13"), "2024-06-14") == ("2024-06-13", 0)
+    assert current_cycle(customer(1, "2024-01-13"), "2024-06-14") == ("2024-06-13", 5)
+    # Clamped month ends return to the billing day
+    stale = {**customer(1, "2024-02-29"), "start_date": "2023-01-31"}
+    assert current_cycle(stale, "2024-06-14") == ("2024-05-31", 3)
+
+
+def test_repeated_and_overlapping_runs_bill_each_cycle_once(billing):
+    server, make, setup = billing
+
+    async def scenario():
+        await setup(*(customer(i) for i in range(5)))
+        first = await make().run(TODAY)
+        # Another process running the same day at the same time, then a replay
+        overlapping = await asyncio.gather(make().run(TODAY), make().run(TODAY))
+        replay = await make().run(TODAY)
+        invoices = await server.db.invoices.find({}, {"_id": 0}).to_list(None)
+        customers = await server.db.customers.find({}, {"_id": 0}).to_list(None)
+        messages = await server.db.whatsapp_outbox.count_documents({})
+        return first, overlapping + [replay], invoices, customers, messages
+
+    first, later, invoices, customers, messages = asyncio.run(scenario())
+    assert first["invoices"]["generated"] == 5
+    assert all(log["invoices"]["generated"] == 0 for log in later)
+    assert sorted(inv["billing_key"] for inv in invoices) == [f"cust-{i}:2024-06-13" for i in range(5)]
+    assert len({inv["invoice_number"] for inv in invoices}) == 5
+    assert {c["next_due_date"] for c in customers} == {"2024-07-13"}
+    assert messages == 5
+
+
+def test_stale_due_date_is_billed_for_its_current_cycle_only(billing):
+    server, make, setup = billing
+
+    async def scenario():
+        await setup(customer(1, "2024-01-13"))
+        logs = [await make().run(date(2024, 6, day)) for day in (12, 13, 14)]
+        invoices = await server.db.invoices.find({}, {"_id": 0}).to_list(None)
+        return logs, invoices, await server.db.customers.find_one({"id": "cust-1"})
+
+    logs, invoices, stored = asyncio.run(scenario())
+    assert [inv["due_date"] for inv in invoices] == ["2024-06-13"]
+    assert logs[0]["invoices"]["cycles_skipped"] == 5
+    assert logs[0]["invoices"]["past_due"] == 1
+    assert [log["invoices"]["generated"] for log in logs] == [1, 0, 0]
+    assert stored["next_due_date"] == "2024-07-13"
+
+
+def test_payment_before_delivery_is_neither_sent_nor_requeued(billing):
+    server, make, setup = billing
+
+    async def scenario():
+        await setup(customer(1))
+        await make().run(TODAY)
+        invoice = await server.db.invoices.find_one({}, {"_id": 0})
+        await server._record_payments([server.BulkPayment(invoice_id=invoice["id"])])
+        # The queued send reaches a worker after the payment
+        await server.whatsapp_outbox._process(await server.whatsapp_outbox._claim())
+        rerun = await make().run(TODAY)
+        return (await server.db.invoices.find({}, {"_id": 0}).to_list(None),
+                await server.db.whatsapp_outbox.find({}, {"_id": 0}).to_list(None), rerun)
+
+    invoices, messages, rerun = asyncio.run(scenario())
+    assert [inv["status"] for inv in invoices] == ["paid"]
+    assert [m["status"] for m in messages] == ["skipped"]
+    assert rerun["invoices"]["queued"] == 0
+
+
+def test_reminders_are_claimed_once_per_invoice(billing):
+    server, make, setup = billing
+
+    async def scenario():
+        await setup(customer(1, "2024-06-05"), customer(2, "2024-06-05"))
+        # Billed and sent a week ago; nothing since
+        await make().run(date(2024, 6, 5))
+        await server.db.invoices.update_many({}, {"$set": {"status": "sent"}})
+        logs = await asyncio.gather(make().run(TODAY), make().run(TODAY))
+        again = await make().run(date(2024, 6, 13))
+        reminders = await server.db.whatsapp_outbox.find(
+            {"key": {"$regex": "^reminder:"}}, {"_id": 0}
+        ).to_list(None)
+        invoices = await server.db.invoices.find({}, {"_id": 0}).to_list(None)
+        return logs + [again], reminders, invoices
+
+    logs, reminders, invoices = asyncio.run(scenario())
+    # 7 days overdue: only the 3-day reminder goes out, the 1-day one is marked done
+    assert sorted(m["key"].rsplit(":", 1)[1] for m in reminders) == ["3", "3"]
+    assert sum(log["reminders"]["queued"] for log in logs) == 2
+    assert all(sorted(inv["reminders_sent"]) == [1, 3] for inv in invoices)
+
+
+def test_invoice_paid_mid_run_gets_no_reminder(billing):
+    server, make, setup = billing
+
+    class PaidAfterQuery(BillingScheduler):
+        async def _batches(self, collection, query, projection):
+            async for batch in super()._batches(collection, query, projection):
+                if "reminders_sent" in query:
+                    for invoice in batch:
+                        await server._record_payments([server.BulkPayment(invoice_id=invoice["id"])])
+                yield batch
+
+    async def scenario():
+        await setup(customer(1, "2024-06-05"))
+        await make().run(date(2024, 6, 5))
+        await server.db.invoices.update_many({}, {"$set": {"status": "sent"}})
+        log = await make(PaidAfterQuery).run(TODAY)
+        return (log, await server.db.invoices.find_one({}, {"_id": 0}),
+                await server.db.whatsapp_outbox.count_documents({"key": {"$regex": "^reminder:"}}))
+
+    log, invoice, reminders = asyncio.run(scenario())
+    assert invoice["status"] == "paid"
+    assert reminders == 0
+    assert log["reminders"]["queued"] == 0
+    assert not invoice.get("reminders_sent")
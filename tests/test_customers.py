@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+def customer(customer_id, name="Budi"):
+    return {"customer_id": customer_id, "name": name, "address": "Jl. Mawar 1", "package": "10 Mbps",
+            "start_date": "2025-01-01", "next_due_date": "2025-02-01", "phone_whatsapp": "628123",
+            "wifi_id": "WIFI-1"}
+
+
+def test_duplicate_customer_id_is_a_conflict(server):
+    async def scenario():
+        await server.ensure_indexes()
+        created = await server.create_customer(server.CustomerCreate(**customer("C001")))
+        with pytest.raises(HTTPException) as error:
+            await server.create_customer(server.CustomerCreate(**customer("C001", name="Siti")))
+        return created, error.value, await server.db.customers.count_documents({})
+
+    created, error, count = asyncio.run(scenario())
+    assert created.customer_id == "C001"
+    assert error.status_code == 409
+    assert error.detail == "customer_id already exists"
+    assert count == 1
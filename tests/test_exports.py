@@ -0,0 +1,41 @@
+import asyncio
+
+
+def seed(server):
+    customers = [{"id": f"cust-{i}", "customer_id": f"C{i:03d}", "name": f"Customer {i}",
+                  "package": "20 Mbps" if i % 3 == 0 else "10 Mbps"} for i in range(9)]
+    invoices = [{"id": f"inv-{i}-{month}", "invoice_number": f"INV-2024{month:02d}-{i:05d}", "customer_id": f"cust-{i}",
+                 "amount": 150000.0, "due_date": f"2024-{month:02d}-10", "status": "sent"}
+                for i in range(9) for month in (5, 6)]
+    return server.db.customers.insert_many(customers), server.db.invoices.insert_many(invoices)
+
+
+def test_package_filter_is_joined_not_listed(server):
+    async def scenario():
+        for insert in seed(server):
+            await insert
+        query = server._export_query("2024-06", None, None)
+        rows = [row async for row in server._invoice_rows(query, "20 Mbps")]
+        numbers = [doc["invoice_number"] async for doc in server._export_numbers(query, "20 Mbps")]
+        count = await server._export_count(query, "20 Mbps", 100)
+        capped = await server._export_count(query, "20 Mbps", 2)
+        everything = await server._export_count(query, None, 100)
+        return query, rows, numbers, count, capped, everything
+
+    query, rows, numbers, count, capped, everything = asyncio.run(scenario())
+    # No customer id list in the filter itself
+    assert "customer_id" not in query
+    assert [row["customer_id"] for row in rows] == ["C000", "C003", "C006"]
+    assert {row["package"] for row in rows} == {"20 Mbps"}
+    assert numbers == ["INV-202406-00000", "INV-202406-00003", "INV-202406-00006"]
+    assert (count, capped, everything) == (3, 2, 9)
+
+
+def test_package_filter_combines_with_customer_ids(server):
+    async def scenario():
+        for insert in seed(server):
+            await insert
+        query = server._export_query(None, None, "cust-0,cust-1")
+        return [doc["invoice_number"] async for doc in server._export_numbers(query, "20 Mbps")]
+
+    assert asyncio.run(scenario()) == ["INV-202405-00000", "INV-202406-00000"]
@@ -0,0 +1,143 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from idempotency import IdempotencyConflict, IdempotencyInProgress, IdempotencyStore, fingerprint
+
+
+def make_collection():
+    return AsyncMongoMockClient()["test"]["idempotency_keys"]
+
+
+class Operation:
+    def __init__(self, result=None, error=None, delay=0.0):
+        self.result = result
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_retry_replays_the_stored_result():
+    async def scenario():
+        store = IdempotencyStore(make_collection())
+        operation = Operation({"id": "inv-1"})
+        first = await store.run("invoices", "key-1", {"customer_id": "c1"}, operation)
+        second = await store.run("invoices", "key-1", {"customer_id": "c1"}, operation)
+        # Keys are per scope
+        other = await store.run("send", "key-1", {"customer_id": "c1"}, operation)
+        return first, second, other, operation.calls
+
+    first, second, other, calls = asyncio.run(scenario())
+    assert first == ({"id": "inv-1"}, False)
+    assert second == ({"id": "inv-1"}, True)
+    assert other == ({"id": "inv-1"}, False)
+    assert calls == 2
+
+
+def test_same_key_with_another_payload_is_a_conflict():
+    async def scenario():
+        store = IdempotencyStore(make_collection())
+        await store.run("invoices", "key-1", {"customer_id": "c1"}, Operation({"id": "inv-1"}))
+        await store.run("invoices", "key-1", {"customer_id": "c2"}, Operation({"id": "inv-2"}))
+
+    with pytest.raises(IdempotencyConflict):
+        asyncio.run(scenario())
+
+
+def test_concurrent_duplicates_share_one_run():
+    async def scenario():
+        store = IdempotencyStore(make_collection())
+        operation = Operation({"id": "inv-1"}, delay=0.1)
+        results = await asyncio.gather(*(
+            store.run("invoices", "key-1", {"customer_id": "c1"}, operation) for _ in range(5)
+        ))
+        return results, operation.calls
+
+    results, calls = asyncio.run(scenario())
+    assert calls == 1
+    assert sorted(replayed for _, replayed in results) == [False, True, True, True, True]
+    assert all(result == {"id": "inv-1"} for result, _ in results)
+
+
+def test_other_process_waits_for_the_original_then_replays():
+    async def scenario():
+        collection = make_collection()
+        original = IdempotencyStore(collection)
+        duplicate = IdempotencyStore(collection, poll_interval=0.02)
+        slow = Operation({"id": "inv-1"}, delay=0.1)
+        never = Operation({"id": "inv-2"})
+        return await asyncio.gather(
+            original.run("invoices", "key-1", {"customer_id": "c1"}, slow),
+            duplicate.run("invoices", "key-1", {"customer_id": "c1"}, never)
+        ), never.calls
+
+    (first, second), calls = asyncio.run(scenario())
+    assert first == ({"id": "inv-1"}, False)
+    assert second == ({"id": "inv-1"}, True)
+    assert calls == 0
+
+
+def test_claim_of_a_dead_owner_is_taken_over_after_its_lease():
+    async def scenario():
+        collection = make_collection()
+        store = IdempotencyStore(collection, lease=0.1, poll_interval=0.02)
+        # Left behind by a process that crashed mid-request
+        now = datetime.now(timezone.utc)
+        await collection.insert_one({
+            "_id": "invoices:key-1",
+            "fingerprint": fingerprint({"customer_id": "c1"}),
+            "status": "in_progress",
+            "locked_until": now + timedelta(seconds=0.1),
+            "expires_at": now + timedelta(days=1)
+        })
+        operation = Operation({"id": "inv-1"})
+        result = await store.run("invoices", "key-1", {"customer_id": "c1"}, operation)
+        return result, operation.calls, await collection.find_one({"_id": "invoices:key-1"})
+
+    result, calls, claim = asyncio.run(scenario())
+    assert result == ({"id": "inv-1"}, False)
+    assert calls == 1
+    assert claim["status"] == "done"
+
+
+def test_running_claim_times_out_as_in_progress():
+    async def scenario():
+        collection = make_collection()
+        original = IdempotencyStore(collection)
+        duplicate = IdempotencyStore(collection, wait_timeout=0.05, poll_interval=0.01)
+        running = asyncio.create_task(
+            original.run("invoices", "key-1", {"customer_id": "c1"}, Operation({"id": "inv-1"}, delay=0.3))
+        )
+        await asyncio.sleep(0.01)
+        try:
+            await duplicate.run("invoices", "key-1", {"customer_id": "c1"}, Operation())
+        finally:
+            await running
+
+    with pytest.raises(IdempotencyInProgress):
+        asyncio.run(scenario())
+
+
+def test_failure_releases_the_claim_for_a_retry():
+    async def scenario():
+        collection = make_collection()
+        store = IdempotencyStore(collection)
+        with pytest.raises(RuntimeError):
+            await store.run("invoices", "key-1", {"customer_id": "c1"}, Operation(error=RuntimeError("render failed")))
+        released = await collection.find_one({"_id": "invoices:key-1"})
+        retry = await store.run("invoices", "key-1", {"customer_id": "c1"}, Operation({"id": "inv-1"}))
+        return released, retry
+
+    released, retry = asyncio.run(scenario())
+    assert released is None
+    assert retry == ({"id": "inv-1"}, False)
+
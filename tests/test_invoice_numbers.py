@@ -0,0 +1,161 @@
+import asyncio
+from datetime import datetime
+
+from mongomock_motor import AsyncMongoMockClient
+
+from invoice_numbers import InvoiceNumbers
+
+NOW = datetime(2025, 1, 15, 9, 30)
+
+
+def sequences(numbers):
+    return sorted(int(number.rsplit("-", 1)[1]) for number in numbers)
+
+
+def run(scenario):
+    async def main():
+        counters = AsyncMongoMockClient()["test"]["counters"]
+        return await scenario(counters)
+    return asyncio.run(main())
+
+
+def test_concurrent_allocators_never_share_or_skip_numbers():
+    async def scenario(counters):
+        # Two processes sharing the counter, each with many concurrent requests
+        first, second = InvoiceNumbers(counters), InvoiceNumbers(counters)
+        numbers = await asyncio.gather(*(
+            (first if i % 2 else second).next(NOW) for i in range(200)
+        ))
+        return numbers, await counters.find_one({"_id": "INV-20250115"})
+
+    numbers, counter = run(scenario)
+    assert len(set(numbers)) == 200
+    assert sequences(numbers) == list(range(1, 201))
+    assert counter["seq"] == 200
+    assert all(number.startswith("INV-20250115-") for number in numbers)
+
+
+def test_reserved_block_is_claimed_in_few_updates_and_handed_out_in_order():
+    async def scenario(counters):
+        numbers = InvoiceNumbers(counters, max_block=1000)
+        block = await numbers.reserve(2500, NOW)
+        held = [list(r) for r in block._ranges]
+        issued = [await block.next(NOW) for _ in range(2500)]
+        # Past the block: one number at a time from the counter
+        extra = await block.next(NOW)
+        return held, issued, extra, await counters.find_one({"_id": "INV-20250115"})
+
+    held, issued, extra, counter = run(scenario)
+    assert held == [[1, 2501]]
+    assert sequences(issued) == list(range(1, 2501))
+    assert issued == sorted(issued)
+    assert extra == "INV-20250115-02501"
+    assert counter["seq"] == 2501
+
+
+def test_unused_reservation_is_returned_to_the_counter():
+    async def scenario(counters):
+        bulk, single = InvoiceNumbers(counters), InvoiceNumbers(counters)
+        block = await bulk.reserve(10, NOW)
+        used = [await block.next(NOW) for _ in range(4)]
+        # The other six invoices failed
+        await block.release(NOW)
+        later = await single.next(NOW)
+        return used, later
+
+    used, later = run(scenario)
+    assert sequences(used) == [1, 2, 3, 4]
+    assert later == "INV-20250115-00005"
+
+
+def test_numbers_that_cannot_be_returned_are_used_next():
+    async def scenario(counters):
+        bulk, single = InvoiceNumbers(counters), InvoiceNumbers(counters)
+        block = await bulk.reserve(5, NOW)
+        used = await block.next(NOW)
+        interleaved = await single.next(NOW)
+        # Rolling the counter back now would reissue the interleaved number
+        await block.release(NOW)
+        spare = [await bulk.next(NOW) for _ in range(3)]
+        next_block = await bulk.reserve(3, NOW)
+        from_block = [await next_block.next(NOW) for _ in range(3)]
+        await next_block.release(NOW)
+        return used, interleaved, spare, from_block, await counters.find_one({"_id": "INV-20250115"})
+
+    used, interleaved, spare, from_block, counter = run(scenario)
+    assert used == "INV-20250115-00001"
+    assert interleaved == "INV-20250115-00006"
+    assert sequences(spare) == [2, 3, 4]
+    # The last spare number, then two fresh ones
+    assert sequences(from_block) == [5, 7, 8]
+    assert counter["seq"] == 8
+
+
+def test_overlapping_bulk_runs_keep_their_own_blocks():
+    async def scenario(counters):
+        numbers = InvoiceNumbers(counters)
+        first = await numbers.reserve(10, NOW)
+        # A second run starting while the first is still going claims its own numbers
+        second = await numbers.reserve(10, NOW)
+        first_numbers = [await first.next(NOW) for _ in range(6)]
+        await first.release(NOW)
+        second_numbers = [await second.next(NOW) for _ in range(10)]
+        await second.release(NOW)
+        after = await numbers.next(NOW)
+        return first_numbers, second_numbers, after, await counters.find_one({"_id": "INV-20250115"})
+
+    first_numbers, second_numbers, after, counter = run(scenario)
+    assert sequences(first_numbers) == [1, 2, 3, 4, 5, 6]
+    assert sequences(second_numbers) == list(range(11, 21))
+    # 7-10 could not go back to the counter (the second block is above them), so they are reused
+    assert after == "INV-20250115-00007"
+    assert counter["seq"] == 20
+
+
+def test_concurrent_reservations_stay_gap_free_after_release():
+    async def scenario(counters):
+        allocators = [InvoiceNumbers(counters, max_block=7) for _ in range(3)]
+
+        async def run_batch(allocator, reserve, create):
+            block = await allocator.reserve(reserve, NOW)
+            try:
+                return [await block.next(NOW) for _ in range(create)]
+            finally:
+                await block.release(NOW)
+
+        numbers = await asyncio.gather(
+            run_batch(allocators[0], 20, 20),
+            run_batch(allocators[1], 15, 9),
+            run_batch(allocators[2], 12, 12),
+            run_batch(allocators[1], 8, 3)
+        )
+        counter = await counters.find_one({"_id": "INV-20250115"})
+        held = [sequence for allocator in allocators
+                for start, end in allocator._spare.get("INV-20250115", ())
+                for sequence in range(start, end)]
+        return [number for batch in numbers for number in batch], held, counter
+
+    issued, held, counter = run(scenario)
+    assert len(set(issued)) == len(issued) == 44
+    # Every number up to the counter was either issued or is kept for a later invoice
+    assert sorted(sequences(issued) + held) == list(range(1, counter["seq"] + 1))
+
+
+def test_new_period_starts_a_new_counter():
+    async def scenario(counters):
+        numbers = InvoiceNumbers(counters, period="month")
+        block = await numbers.reserve(3, datetime(2025, 1, 31))
+        january = await block.next(datetime(2025, 1, 31))
+        february = await block.next(datetime(2025, 2, 1))
+        second = await numbers.next(datetime(2025, 2, 1))
+        # Someone claimed past January's block; its numbers are not kept into February
+        await numbers.reserve(1, datetime(2025, 1, 31))
+        await block.release(datetime(2025, 2, 1))
+        after = await numbers.next(datetime(2025, 2, 1))
+        return january, february, second, after, block.remaining
+
+    january, february, second, after, remaining = run(scenario)
+    assert january == "INV-202501-00001"
+    assert february == "INV-202502-00001"
+    assert (second, after) == ("INV-202502-00002", "INV-202502-00003")
+    assert remaining == 0
@@ -0,0 +1,124 @@
+import asyncio
+import json
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from live_updates import LiveUpdates, NOT_A_REPLICA_SET
+
+
+class FakeChangeStream:
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def try_next(self):
+        if not self.changes:
+            await asyncio.sleep(0.01)
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = {"_data": change["_id"]}
+        return change
+
+
+class FakeDatabase:
+    """``watch`` plays each item in ``streams``: a list of changes or an exception."""
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.watches = 0
+
+    def watch(self, pipeline, **kwargs):
+        self.watches += 1
+        stream = self.streams.pop(0) if self.streams else []
+        if isinstance(stream, BaseException):
+            raise stream
+        return FakeChangeStream(stream)
+
+
+def invoice_change(token, invoice_id, status):
+    return {"_id": token, "operationType": "update", "ns": {"coll": "invoices"},
+            "fullDocument": {"id": invoice_id, "status": status}}
+
+
+def make_feed(db):
+    calls = {"stats": 0}
+
+    async def load_stats(fresh=False):
+        calls["stats"] += 1
+        return {"invoices": {"paid": calls["stats"]}}
+
+    return LiveUpdates(db, load_stats, coalesce=0.05, poll_interval=0.05), calls
+
+
+async def next_event(queue, name, timeout=3.0):
+    while True:
+        message = await asyncio.wait_for(queue.get(), timeout)
+        if message.startswith(f"event: {name}\n"):
+            return json.loads(message.split("data: ", 1)[1])
+
+
+def test_changes_are_coalesced_into_one_event():
+    async def scenario():
+        db = FakeDatabase([
+            invoice_change("1", "inv-a", "sent"),
+            invoice_change("2", "inv-b", "sent"),
+            invoice_change("3", "inv-a", "paid")
+        ])
+        feed, _ = make_feed(db)
+        queue = feed.subscribe()
+        try:
+            invoices = await next_event(queue, "invoices")
+            stats = await next_event(queue, "stats")
+        finally:
+            await feed.close()
+        return invoices, stats, feed
+
+    invoices, stats, feed = asyncio.run(scenario())
+    assert sorted((c["id"], c["status"]) for c in invoices["changes"]) == [("inv-a", "paid"), ("inv-b", "sent")]
+    assert stats["stats"] == {"invoices": {"paid": 1}}
+    assert feed._change_streams
+
+
+def test_standalone_server_falls_back_to_polling():
+    async def scenario():
+        db = FakeDatabase(OperationFailure("not a replica set", code=NOT_A_REPLICA_SET))
+        feed, calls = make_feed(db)
+        queue = feed.subscribe()
+        try:
+            await next_event(queue, "stats")
+            await next_event(queue, "stats")
+        finally:
+            await feed.close()
+        return db, feed, calls
+
+    db, feed, calls = asyncio.run(scenario())
+    assert not feed._change_streams
+    assert db.watches == 1
+    assert calls["stats"] >= 2
+
+
+def test_other_errors_retry_the_change_stream():
+    async def scenario():
+        db = FakeDatabase(
+            AutoReconnect("connection reset"),
+            RuntimeError("bug in a handler"),
+            [invoice_change("1", "inv-a", "paid")]
+        )
+        feed, _ = make_feed(db)
+        queue = feed.subscribe()
+        try:
+            invoices = await next_event(queue, "invoices", timeout=10.0)
+        finally:
+            await feed.close()
+        return db, feed, invoices
+
+    db, feed, invoices = asyncio.run(scenario())
+    assert feed._change_streams
+    assert db.watches == 3
+    assert invoices["changes"] == [{"id": "inv-a", "status": "paid"}]
@@ -0,0 +1,212 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from mongomock_motor import AsyncMongoMockClient
+
+from outbox import DeliverySkipped, PermanentDeliveryError, WhatsAppOutbox
+
+
+async def connected():
+    return True
+
+
+async def make_outbox(deliver, **options):
+    collection = AsyncMongoMockClient()["test"]["whatsapp_outbox"]
+    await collection.create_index("id", unique=True)
+    await collection.create_index("active_key", unique=True, sparse=True)
+    return WhatsAppOutbox(collection, deliver, connected, **options)
+
+
+async def message(outbox, message_id):
+    return await outbox.collection.find_one({"id": message_id}, {"_id": 0})
+
+
+def iso(seconds_from_now):
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds_from_now)).isoformat()
+
+
+def test_enqueue_keeps_one_live_message_per_key():
+    async def scenario():
+        outbox = await make_outbox(None)
+        first = await outbox.enqueue("inv-1")
+        again = await outbox.enqueue("inv-1")
+        reminder = await outbox.enqueue("inv-1", "Reminder", active_key="reminder:inv-1:7")
+        return first, again, reminder, await outbox.collection.count_documents({})
+
+    first, again, reminder, count = asyncio.run(scenario())
+    assert again["id"] == first["id"]
+    assert reminder["id"] != first["id"]
+    assert count == 2
+
+
+def test_expired_lease_is_reclaimed_and_the_old_worker_cannot_finish():
+    async def scenario():
+        outbox = await make_outbox(None, lease=60)
+        queued = await outbox.enqueue("inv-1")
+        stale = await outbox._claim()
+        # The first worker died mid-send: its lease runs out
+        await outbox.collection.update_one({"id": queued["id"]}, {"$set": {"locked_until": iso(-1)}})
+        reclaimed = await outbox._claim()
+        await outbox._finish(stale, "sent", {"sent_at": iso(0)})
+        after_stale = await message(outbox, queued["id"])
+        await outbox._finish(reclaimed, "sent", {"sent_at": iso(0)})
+        return stale, reclaimed, after_stale, await message(outbox, queued["id"])
+
+    stale, reclaimed, after_stale, done = asyncio.run(scenario())
+    assert reclaimed["id"] == stale["id"]
+    assert reclaimed["lease_id"] != stale["lease_id"]
+    assert reclaimed["attempts"] == 2
+    assert after_stale["status"] == "sending"
+    assert done["status"] == "sent"
+    assert "active_key" not in done and "lease_id" not in done
+
+
+def test_live_lease_is_not_reclaimed():
+    async def scenario():
+        outbox = await make_outbox(None, lease=60)
+        await outbox.enqueue("inv-1")
+        return await outbox._claim(), await outbox._claim()
+
+    claimed, second = asyncio.run(scenario())
+    assert claimed is not None
+    assert second is None
+
+
+def test_failures_back_off_then_dead_letter_and_retry_by_hand():
+    async def failing(message):
+        raise RuntimeError("gateway timeout")
+
+    async def scenario():
+        outbox = await make_outbox(failing, max_attempts=2, base_delay=30, max_delay=60)
+        queued = await outbox.enqueue("inv-1")
+
+        await outbox._process(await outbox._claim())
+        retrying = await message(outbox, queued["id"])
+        # Not due yet: the backoff keeps it from being claimed again right away
+        early = await outbox._claim()
+
+        await outbox.collection.update_one({"id": queued["id"]}, {"$set": {"next_attempt_at": iso(-1)}})
+        await outbox._process(await outbox._claim())
+        dead = await message(outbox, queued["id"])
+
+        retried = await outbox.retry(queued["id"])
+        return retrying, early, dead, retried
+
+    retrying, early, dead, retried = asyncio.run(scenario())
+    assert retrying["status"] == "queued"
+    assert retrying["last_error"] == "gateway timeout"
+    assert iso(14) <= retrying["next_attempt_at"] <= iso(31)
+    assert early is None
+    assert dead["status"] == "dead"
+    assert dead["attempts"] == 2
+    assert "active_key" not in dead
+    assert retried["status"] == "queued"
+    assert retried["attempts"] == 0
+    assert retried["active_key"] == "invoice:inv-1"
+    assert "last_error" not in retried
+
+
+def test_permanent_errors_skip_the_retries():
+    async def rejected(message):
+        raise PermanentDeliveryError("Invoice not found")
+
+    async def scenario():
+        outbox = await make_outbox(rejected, max_attempts=8)
+        queued = await outbox.enqueue("inv-1")
+        await outbox._process(await outbox._claim())
+        return await message(outbox, queued["id"])
+
+    dead = asyncio.run(scenario())
+    assert dead["status"] == "dead"
+    assert dead["attempts"] == 1
+    assert dead["last_error"] == "Invoice not found"
+
+
+def test_heartbeat_keeps_a_slow_send_leased():
+    deliveries = []
+
+    async def slow(message):
+        deliveries.append(message["id"])
+        await asyncio.sleep(0.6)
+
+    async def scenario():
+        outbox = await make_outbox(slow, workers=2, lease=0.3, poll_interval=0.05)
+        queued = await outbox.enqueue("inv-1")
+        outbox.start()
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                if (await message(outbox, queued["id"]))["status"] == "sent":
+                    break
+        finally:
+            await outbox.stop()
+        return await message(outbox, queued["id"])
+
+    sent = asyncio.run(scenario())
+    assert sent["status"] == "sent"
+    assert sent["attempts"] == 1
+    assert len(deliveries) == 1
+
+
+def test_lost_lease_abandons_the_send():
+    cancelled = asyncio.Event()
+
+    async def hanging(message):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def scenario():
+        outbox = await make_outbox(hanging, lease=0.3)
+        queued = await outbox.enqueue("inv-1")
+        claimed = await outbox._claim()
+        process = asyncio.create_task(outbox._process(claimed))
+        await asyncio.sleep(0.05)
+        # Another worker took the message over
+        await outbox.collection.update_one({"id": queued["id"]}, {"$set": {"lease_id": "someone-else"}})
+        await asyncio.wait_for(process, 2)
+        return await message(outbox, queued["id"])
+
+    taken = asyncio.run(scenario())
+    assert cancelled.is_set()
+    assert taken["status"] == "sending"
+    assert taken["lease_id"] == "someone-else"
+
+
+def test_shutdown_mid_send_hands_the_message_back():
+    async def hanging(message):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        outbox = await make_outbox(hanging, lease=60)
+        queued = await outbox.enqueue("inv-1")
+        process = asyncio.create_task(outbox._process(await outbox._claim()))
+        await asyncio.sleep(0.05)
+        process.cancel()
+        await asyncio.gather(process, return_exceptions=True)
+        return await message(outbox, queued["id"])
+
+    released = asyncio.run(scenario())
+    assert released["status"] == "queued"
+    assert released["attempts"] == 0
+    assert "lease_id" not in released
+
+
+def test_skipped_delivery_finishes_without_retrying():
+    async def paid(message):
+        raise DeliverySkipped("Invoice already paid")
+
+    async def scenario():
+        outbox = await make_outbox(paid)
+        queued = await outbox.enqueue("inv-1")
+        await outbox._process(await outbox._claim())
+        again = await outbox.enqueue("inv-1")
+        return await message(outbox, queued["id"]), again
+
+    skipped, again = asyncio.run(scenario())
+    assert skipped["status"] == "skipped"
+    assert skipped["last_error"] == "Invoice already paid"
+    assert "active_key" not in skipped
+    assert again["id"] != skipped["id"]
@@ -0,0 +1,113 @@
+import asyncio
+import base64
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_filter, keyset_page
+
+SORT = [("created_at", -1), ("id", 1)]
+
+
+def make_invoices(count, same_time_every=3):
+    # Groups of invoices share a created_at so the id tiebreaker decides their order
+    return [{"id": f"inv-{i:03d}", "created_at": f"2024-01-{(i // same_time_every) + 1:02d}", "status": "sent"}
+            for i in range(count)]
+
+
+async def walk(collection, query=None, limit=4, sort=SORT):
+    ids, after, pages = [], None, 0
+    while True:
+        page = await keyset_page(collection, query or {}, {"_id": 0}, sort, after, limit)
+        pages += 1
+        ids.extend(doc["id"] for doc in page["items"])
+        after = page["next_cursor"]
+        if after is None:
+            return ids, pages
+
+
+def run_with_collection(docs, scenario):
+    async def main():
+        collection = AsyncMongoMockClient()["test"]["invoices"]
+        if docs:
+            await collection.insert_many([dict(doc) for doc in docs])
+        return await scenario(collection)
+    return asyncio.run(main())
+
+
+def expected_order(docs, sort=SORT):
+    ordered = list(docs)
+    for field, direction in reversed(sort):
+        ordered.sort(key=lambda doc: doc[field], reverse=direction < 0)
+    return [doc["id"] for doc in ordered]
+
+
+def test_cursor_round_trip_strips_padding():
+    values = ["2024-01-01T00:00:00+00:00", "inv-1", 3, None]
+    cursor = encode_cursor(values)
+    assert "=" not in cursor
+    assert decode_cursor(cursor, 4) == values
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 at all!",
+    base64.urlsafe_b64encode(b"{not json").decode(),
+    encode_cursor({"created_at": "x"}),
+    encode_cursor(["only-one-value"]),
+    encode_cursor(["too", "many", "values"]),
+])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, 2)
+
+
+def test_keyset_filter_follows_each_direction():
+    assert keyset_filter([("id", 1)], ["b"]) == {"id": {"$gt": "b"}}
+    assert keyset_filter(SORT, ["2024-01-02", "inv-4"]) == {"$or": [
+        {"created_at": {"$lt": "2024-01-02"}},
+        {"created_at": "2024-01-02", "id": {"$gt": "inv-4"}}
+    ]}
+
+
+def test_pages_cover_every_document_once_across_ties():
+    docs = make_invoices(10)
+    ids, pages = run_with_collection(docs, walk)
+    assert ids == expected_order(docs)
+    assert pages == 3
+
+
+def test_last_full_page_has_no_next_cursor():
+    docs = make_invoices(8)
+    ids, pages = run_with_collection(docs, walk)
+    assert len(ids) == 8
+    assert pages == 2
+
+
+def test_empty_collection_returns_one_empty_page():
+    async def scenario(collection):
+        return await keyset_page(collection, {}, {"_id": 0}, SORT)
+
+    assert run_with_collection([], scenario) == {"items": [], "next_cursor": None}
+
+
+def test_cursor_is_combined_with_the_query():
+    docs = make_invoices(10)
+    for doc in docs[::2]:
+        doc["status"] = "paid"
+
+    ids, _ = run_with_collection(docs, lambda collection: walk(collection, {"status": "paid"}, limit=2))
+    assert ids == expected_order([doc for doc in docs if doc["status"] == "paid"])
+
+
+def test_inserts_behind_the_cursor_do_not_shift_later_pages():
+    docs = make_invoices(6)
+
+    async def scenario(collection):
+        first = await keyset_page(collection, {}, {"_id": 0}, SORT, limit=3)
+        # Newer than everything already served: an offset-based page two would repeat an item
+        await collection.insert_one({"id": "inv-new", "created_at": "2024-12-31", "status": "sent"})
+        second = await keyset_page(collection, {}, {"_id": 0}, SORT, first["next_cursor"], 3)
+        return first["items"] + second["items"]
+
+    items = run_with_collection(docs, scenario)
+    assert [doc["id"] for doc in items] == expected_order(docs)
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from renderer import PdfRenderer, RenderTimeout
+
+# Stands in for wkhtmltopdf: "sleep:<seconds>" in the HTML makes it slow
+FAKE_WKHTMLTOPDF = f"""#!{sys.executable}
+import re, sys, time
+html = sys.stdin.read()
+match = re.search(r"sleep:([0-9.]+)", html)
+if match:
+    time.sleep(float(match.group(1)))
+sys.stdout.write("%PDF-fake " + html)
+"""
+
+
+@pytest.fixture(autouse=True)
+def fake_wkhtmltopdf(tmp_path, monkeypatch):
+    path = tmp_path / "wkhtmltopdf"
+    path.write_text(FAKE_WKHTMLTOPDF)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+def pids(renderer):
+    return {worker.pid for worker in renderer._workers}
+
+
+def test_waiting_for_a_worker_does_not_count_against_the_timeout():
+    async def scenario():
+        renderer = PdfRenderer(workers=2, queue_size=6, timeout=2.0)
+        await renderer.start()
+        try:
+            started = time.monotonic()
+            # Four rounds of two: the last ones wait ~3s, longer than the timeout
+            pdfs = await asyncio.gather(*(renderer.render(f"<p>{i} sleep:0.75</p>") for i in range(8)))
+            return pdfs, time.monotonic() - started
+        finally:
+            await renderer.shutdown()
+
+    pdfs, elapsed = asyncio.run(scenario())
+    assert [pdf.startswith(b"%PDF-fake") for pdf in pdfs] == [True] * 8
+    assert elapsed >= 3.0
+
+
+def test_worker_enforces_the_timeout_and_stays_in_service():
+    async def scenario():
+        renderer = PdfRenderer(workers=1, timeout=0.5)
+        await renderer.start()
+        try:
+            before = pids(renderer)
+            with pytest.raises(RenderTimeout):
+                await renderer.render("<p>sleep:5</p>")
+            after = await renderer.render("<p>ok</p>")
+            return before, pids(renderer), after
+        finally:
+            await renderer.shutdown()
+
+    before, after_pids, pdf = asyncio.run(scenario())
+    assert after_pids == before
+    assert pdf == b"%PDF-fake <p>ok</p>"
+
+
+def test_stuck_worker_is_killed_without_disturbing_the_others():
+    async def scenario():
+        # kill_after shorter than the worker's own limit stands in for a hang in native code
+        renderer = PdfRenderer(workers=2, timeout=30.0, kill_after=0.5)
+        await renderer.start()
+        try:
+            before = pids(renderer)
+            stuck, healthy = await asyncio.gather(
+                renderer.render("<p>sleep:10</p>"),
+                renderer.render("<p>sleep:0.3</p>"),
+                return_exceptions=True
+            )
+            for _ in range(50):
+                if len(renderer._workers) == 2 and renderer._idle.qsize() == 2:
+                    break
+                await asyncio.sleep(0.1)
+            after = pids(renderer)
+            again = await renderer.render("<p>ok</p>")
+            return before, after, stuck, healthy, again
+        finally:
+            await renderer.shutdown()
+
+    before, after, stuck, healthy, again = asyncio.run(scenario())
+    assert isinstance(stuck, RenderTimeout)
+    assert healthy == b"%PDF-fake <p>sleep:0.3</p>"
+    assert len(after) == 2
+    assert len(before & after) == 1
+    assert again == b"%PDF-fake <p>ok</p>"
+
+
+def test_crashed_worker_is_replaced_and_the_render_retried():
+    async def scenario():
+        renderer = PdfRenderer(workers=1, timeout=5.0)
+        await renderer.start()
+        try:
+            worker = next(iter(renderer._workers))
+            render = asyncio.create_task(renderer.render("<p>sleep:1</p>"))
+            await asyncio.sleep(0.3)
+            worker.process.kill()
+            return await render
+        finally:
+            await renderer.shutdown()
+
+    assert asyncio.run(scenario()) == b"%PDF-fake <p>sleep:1</p>"
+
+
+def test_time_limit_interrupts_in_process_rendering():
+    from renderer import _time_limit
+
+    started = time.monotonic()
+    with pytest.raises(RenderTimeout):
+        with _time_limit(0.2, 60.0):
+            time.sleep(5)
+    assert time.monotonic() - started < 2
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+AMOUNTS = (100000.0, 150000.0, 250000.0)
+
+
+@pytest.fixture
+def revenue(server):
+    async def setup():
+        await server.ensure_indexes()
+        await server._ensure_default_template()
+        template = await server._get_template(None)
+        invoices = []
+        for number, amount in enumerate(AMOUNTS):
+            customer = {"id": f"cust-{number}", "customer_id": f"C{number:03d}", "name": f"Customer {number}",
+                        "address": "Jl. Mawar 1", "package": "10 Mbps", "phone_whatsapp": "628123",
+                        "wifi_id": f"WIFI-{number}", "status": "active"}
+            await server.db.customers.insert_one(dict(customer))
+            invoices.append(await server._build_invoice(customer, template, amount, "2024-06-13"))
+        return invoices
+
+    def pay(*invoices, paid_at="2024-06-10"):
+        return server._record_payments([server.BulkPayment(invoice_id=inv["id"], paid_at=paid_at)
+                                        for inv in invoices])
+
+    async def report():
+        month = await server.revenue_rollups.report("2024-06", "2024-06")
+        day = await server.revenue_rollups.report("2024-06-01", "2024-06-30", "day")
+        return month["totals"], month["packages"]["10 Mbps"], day["totals"]
+
+    return server, setup, pay, report
+
+
+def expected(paid):
+    collected = sum(AMOUNTS[:paid])
+    month = {"revenue": collected, "payments": paid, "billed_amount": sum(AMOUNTS),
+             "billed_count": len(AMOUNTS), "collected_amount": collected, "collected_count": paid,
+             "collection_rate": round(collected / sum(AMOUNTS), 4)}
+    return month, month, {"revenue": collected, "payments": paid}
+
+
+def test_concurrent_and_replayed_payments_count_once(revenue):
+    server, setup, pay, report = revenue
+
+    async def scenario():
+        invoices = await setup()
+        concurrent = await asyncio.gather(pay(*invoices[:2]), pay(*invoices[:2]))
+        replay = await pay(*invoices[:2])
+        return concurrent + [replay], await report()
+
+    results, totals = asyncio.run(scenario())
+    assert sum(result["recorded"] for result in results) == 2
+    assert sum(len(result["already_paid"]) for result in results) == 4
+    assert totals == expected(2)
+
+
+def test_batch_applied_twice_counts_once(revenue):
+    server, setup, pay, report = revenue
+
+    async def scenario():
+        invoices = await setup()
+        await pay(*invoices[:2])
+        paid = await server.db.invoices.find({"status": "paid"}, {"_id": 0}).to_list(None)
+        for invoice in paid:
+            invoice["package"] = "10 Mbps"
+        batch = paid[0]["payment"]["batch"]
+        # The same batch again, sequentially and concurrently
+        await server.revenue_rollups.payments_recorded(batch, paid)
+        await asyncio.gather(*(server.revenue_rollups.payments_recorded(batch, paid) for _ in range(3)))
+        return await report()
+
+    assert asyncio.run(scenario()) == expected(2)
+
+
+def test_apply_pending_finishes_an_interrupted_batch_once(revenue, monkeypatch):
+    server, setup, pay, report = revenue
+
+    async def crash(batch, payments):
+        raise RuntimeError("process stopped before the rollup step")
+
+    async def scenario():
+        invoices = await setup()
+        with monkeypatch.context() as patch:
+            patch.setattr(server.revenue_rollups, "payments_recorded", crash)
+            with pytest.raises(RuntimeError):
+                await pay(invoices[0])
+        before = await report()
+        # Increments applied but the invoices never flagged: a second crash point
+        await pay(invoices[1])
+        await server.db.invoices.update_one({"id": invoices[1]["id"]}, {"$set": {"rollup_applied": False}})
+
+        applied = [await server.revenue_rollups.apply_pending() for _ in range(2)]
+        pending = await server.db.invoices.count_documents({"rollup_applied": False})
+        return before, applied, pending, await report()
+
+    before, applied, pending, after = asyncio.run(scenario())
+    assert before == expected(0)
+    assert applied == [2, 0]
+    assert pending == 0
+    assert after == expected(2)
+
+
+def test_rebuild_matches_incremental_counts(revenue):
+    server, setup, pay, report = revenue
+
+    async def scenario():
+        invoices = await setup()
+        await pay(*invoices[:2])
+        incremental = await report()
+        await server.revenue_rollups.rebuild()
+        await server.revenue_rollups.rebuild()
+        return incremental, await report()
+
+    incremental, rebuilt = asyncio.run(scenario())
+    assert incremental == expected(2)
+    assert rebuilt == incremental
+
+
+def test_payment_during_rebuild_counts_once(revenue):
+    server, setup, pay, report = revenue
+
+    async def scenario():
+        invoices = await setup()
+        await pay(invoices[0])
+        await asyncio.gather(server.revenue_rollups.rebuild(), pay(invoices[1]))
+        return await report()
+
+    assert asyncio.run(scenario()) == expected(2)
@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+from mongomock_motor import AsyncMongoMockClient
+
+from wa_client import RateLimiter, SharedRateLimiter
+
+
+def test_processes_sharing_the_database_share_one_rate():
+    async def scenario():
+        collection = AsyncMongoMockClient()["test"]["rate_limits"]
+        # Two API processes, each with its own limiter object
+        limiters = [SharedRateLimiter(collection, rate=20), SharedRateLimiter(collection, rate=20)]
+        times = []
+
+        async def send(limiter):
+            await limiter.acquire()
+            times.append(time.time())
+
+        started = time.time()
+        await asyncio.gather(*(send(limiters[i % 2]) for i in range(10)))
+        return started, sorted(times)
+
+    started, times = asyncio.run(scenario())
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    # 10 sends at 20/s take ~0.45s in total, not half that as two separate limiters would allow
+    assert times[-1] - started >= 0.4
+    assert min(gaps) >= 0.04
+
+
+def test_zero_rate_disables_limiting():
+    async def scenario():
+        collection = AsyncMongoMockClient()["test"]["rate_limits"]
+        limiter = SharedRateLimiter(collection, rate=0)
+        started = time.monotonic()
+        await asyncio.gather(*(limiter.acquire() for _ in range(50)))
+        return time.monotonic() - started, await collection.count_documents({})
+
+    elapsed, documents = asyncio.run(scenario())
+    assert elapsed < 0.1
+    assert documents == 0
+
+
+def test_local_limiter_spaces_calls():
+    async def scenario():
+        limiter = RateLimiter(rate=20)
+        started = time.monotonic()
+        await asyncio.gather(*(limiter.acquire() for _ in range(5)))
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.18
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from outbox import DeliverySkipped
+
+
+class Response:
+    status_code = 200
+
+
+def customer_and_invoice(status):
+    customer = {"id": "cust-1", "customer_id": "C001", "name": "Budi", "phone_whatsapp": "628123",
+                "package": "10 Mbps", "status": "active"}
+    invoice = {"id": "inv-1", "invoice_number": "INV-20250115-00001", "customer_id": "cust-1",
+               "amount": 150000.0, "due_date": "2025-01-15", "status": status}
+    return customer, invoice
+
+
+@pytest.fixture
+def delivery(server, monkeypatch):
+    sent, stats = [], []
+
+    async def pdf_bytes(invoice_number):
+        return b"%PDF-1.4"
+
+    async def status_changed(old, new, due_date, amount):
+        stats.append((old, new))
+
+    monkeypatch.setattr(server, "_invoice_pdf_bytes", pdf_bytes)
+    monkeypatch.setattr(server.dashboard_stats, "invoice_status_changed", status_changed)
+    return server, sent, stats
+
+
+def test_paid_invoice_is_not_sent(delivery, monkeypatch):
+    server, sent, stats = delivery
+
+    async def send_document(phone, caption, filename, content):
+        sent.append(filename)
+        return Response()
+
+    monkeypatch.setattr(server.wa_client, "send_document", send_document)
+
+    async def scenario():
+        customer, invoice = customer_and_invoice("paid")
+        await server.db.customers.insert_one(customer)
+        await server.db.invoices.insert_one(invoice)
+        with pytest.raises(DeliverySkipped):
+            await server._deliver_outbox_message({"id": "msg-1", "invoice_id": "inv-1"})
+        return await server.db.invoices.find_one({"id": "inv-1"})
+
+    invoice = asyncio.run(scenario())
+    assert invoice["status"] == "paid"
+    assert sent == []
+    assert stats == []
+
+
+def test_payment_during_upload_keeps_the_invoice_paid(delivery, monkeypatch):
+    server, sent, stats = delivery
+
+    async def send_document(phone, caption, filename, content):
+        sent.append(filename)
+        await server.db.invoices.update_one({"id": "inv-1"}, {"$set": {"status": "paid"}})
+        return Response()
+
+    monkeypatch.setattr(server.wa_client, "send_document", send_document)
+
+    async def scenario():
+        customer, invoice = customer_and_invoice("pending")
+        await server.db.customers.insert_one(customer)
+        await server.db.invoices.insert_one(invoice)
+        await server._deliver_outbox_message({"id": "msg-1", "invoice_id": "inv-1"})
+        return await server.db.invoices.find_one({"id": "inv-1"})
+
+    invoice = asyncio.run(scenario())
+    assert invoice["status"] == "paid"
+    assert sent == ["INV-20250115-00001.pdf"]
+    assert stats == []
+
+
+def test_delivery_reports_the_status_it_replaced(delivery, monkeypatch):
+    server, sent, stats = delivery
+
+    async def send_document(phone, caption, filename, content):
+        sent.append(filename)
+        return Response()
+
+    monkeypatch.setattr(server.wa_client, "send_document", send_document)
+
+    async def scenario():
+        customer, invoice = customer_and_invoice("pending")
+        await server.db.customers.insert_one(customer)
+        await server.db.invoices.insert_one(invoice)
+        await server._deliver_outbox_message({"id": "msg-1", "invoice_id": "inv-1"})
+        return await server.db.invoices.find_one({"id": "inv-1"})
+
+    invoice = asyncio.run(scenario())
+    assert invoice["status"] == "sent"
+    assert stats == [("pending", "sent")]